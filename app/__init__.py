@@ -1,10 +1,30 @@
 from flask import Flask, redirect, url_for
 from flask_login import LoginManager
+from app.cli import register_cli
 from app.config import Config
 from app.models import db, User
+from app.models.engine import configure_database, tune_sqlite
+from app.models.schema import upgrade_schema
 from app.routes.auth import auth_bp, init_auth
-from app.routes.api import api_bp
+from app.routes.api import api_bp, execute_job
 from app.routes import main_bp
+from app.services.auth_cache import auth_cache
+from app.services.batching import batch_runner, embedding_coalescer
+from app.services.circuit_breaker import circuit_breakers
+from app.services.hedging import hedger
+from app.services.http_pool import upstream_pool
+from app.services.jobs import job_queue
+from app.services.metrics import metrics
+from app.services.passthrough import passthrough
+from app.services.quota import quota_store
+from app.services.rate_limit import rate_limiter
+from app.services.response_cache import response_cache
+from app.services.retention import retention
+from app.services.retry import retry_policy
+from app.services.routing import router
+from app.services.semantic_cache import semantic_cache
+from app.services.tokens import token_estimator
+from app.services.usage_writer import usage_writer
 
 login_manager = LoginManager()
 
@@ -12,8 +32,29 @@ def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
     
+    configure_database(app)
     db.init_app(app)
+    with app.app_context():
+        tune_sqlite(db.engine, app.config)
     login_manager.init_app(app)
+    metrics.init_app(app)
+    passthrough.init_app(app)
+    upstream_pool.init_app(app)
+    auth_cache.init_app(app)
+    usage_writer.init_app(app)
+    response_cache.init_app(app)
+    semantic_cache.init_app(app)
+    router.init_app(app)
+    circuit_breakers.init_app(app)
+    retry_policy.init_app(app)
+    hedger.init_app(app)
+    quota_store.init_app(app)
+    token_estimator.init_app(app)
+    rate_limiter.init_app(app)
+    batch_runner.init_app(app)
+    embedding_coalescer.init_app(app)
+    job_queue.init_app(app, handler=execute_job)
+    retention.init_app(app)
     login_manager.login_view = 'auth.login'
     login_manager.login_message = '请先登录'
     login_manager.login_message_category = 'info'
@@ -23,6 +64,7 @@ def create_app(config_class=Config):
     app.register_blueprint(auth_bp, url_prefix='/auth')
     app.register_blueprint(api_bp, url_prefix='/v1')
     app.register_blueprint(main_bp)
+    register_cli(app)
     
     @app.route('/')
     def index():
@@ -34,5 +76,6 @@ def create_app(config_class=Config):
     
     with app.app_context():
         db.create_all()
+        upgrade_schema(db)
     
     return app
@@ -0,0 +1,337 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.datastructures import Headers
+
+from app import create_app
+from app.config import Config
+from app.services.chat import (
+    ChatRequest, admit_key, finish_attempt, rate_limited_result, upstream_failed, upstream_error
+)
+from app.services.circuit_breaker import circuit_breakers
+from app.services.hedging import hedger
+from app.services.metrics import metrics
+from app.services.passthrough import passthrough
+from app.services.quota import quota_store, SCOPE_KEY
+from app.services.rate_limit import rate_limiter
+from app.services.retry import retry_policy, transient
+from app.services.routing import router
+from app.services.usage_writer import usage_writer
+from app.services.streaming import sse_data
+from app.services.tokens import token_estimator
+from app.services.upstream import adapter_for, UPSTREAM_TIMEOUT
+
+
+def http2_available():
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class AsyncGateway:
+    # /v1/chat 走 asyncio 非阻塞上游调用，其余路由交给 Flask (WSGI) 处理
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+        self.client = None
+        self.db_executor = ThreadPoolExecutor(
+            max_workers=flask_app.config['ASYNC_DB_THREADS'],
+            thread_name_prefix='gateway-db'
+        )
+
+    def create_client(self):
+        config = self.flask_app.config
+        return httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=config['ASYNC_MAX_CONNECTIONS'],
+                max_keepalive_connections=config['UPSTREAM_POOL_MAXSIZE']
+            ),
+            timeout=UPSTREAM_TIMEOUT,
+            http2=config['UPSTREAM_HTTP2'] and http2_available()
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] == '/v1/chat':
+            await self.chat_with_metrics(scope, receive, send)
+        else:
+            await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.client = self.create_client()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.client is not None:
+                    await self.client.aclose()
+                self.db_executor.shutdown(wait=True)
+                usage_writer.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def run_db(self, func, *args):
+        def call():
+            with self.flask_app.app_context():
+                return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.db_executor, call)
+
+    async def chat_with_metrics(self, scope, receive, send):
+        # 与 Flask 路由相同的 HTTP 指标，端点名沿用 api.chat
+        started = time.perf_counter()
+
+        async def send_with_metrics(message):
+            if message['type'] == 'http.response.start':
+                metrics.inc('gateway_http_requests_total', endpoint='api.chat', code=str(message['status']))
+                metrics.observe('gateway_http_request_duration_seconds', time.perf_counter() - started, endpoint='api.chat')
+            await send(message)
+
+        with metrics.in_flight('gateway_http_requests_in_flight', endpoint='api.chat'):
+            await self.chat(scope, receive, send_with_metrics)
+
+    async def chat(self, scope, receive, send):
+        # 各步骤与 Flask 路由共用 (app/services/chat.py)，访问数据库和本机 SQLite 的步骤放到线程池中执行
+        if self.client is None:
+            self.client = self.create_client()
+
+        headers = Headers([(k.decode('latin-1'), v.decode('latin-1')) for k, v in scope['headers']])
+        chat_request, reply = ChatRequest.parse(headers, await self.read_body(receive))
+        if reply:
+            return await self.send_json(send, *reply)
+        reply = await self.run_db(chat_request.authenticate)
+        if reply:
+            return await self.send_json(send, *reply)
+        state = await rate_limiter.acquire_async(*chat_request.rate_limit(), executor=self.db_executor)
+        reply = await self.run_db(chat_request.admit, state)
+        if reply:
+            return await self.send_json(send, *reply)
+        # 生成向量和查询索引也在线程池中执行
+        reply = await self.run_db(chat_request.cached)
+        if reply:
+            return await self.send_json(send, *reply)
+
+        def upstream(api_key, stream=False, rate_wait=False):
+            return self.call_api(
+                chat_request.user_id, api_key, chat_request.messages, chat_request.model, chat_request.temperature,
+                chat_request.max_tokens, stream, rate_wait, chat_request.deadline, chat_request.body
+            )
+
+        api_keys = chat_request.api_keys
+        hedged, losers = False, []
+        if hedger.applies(api_keys, chat_request.stream):
+            api_key, result, hedged, losers = await hedger.run_async(upstream, api_keys[0], api_keys[1])
+            for loser_key, loser in losers:
+                await self.run_db(chat_request.hedge_lost, loser_key, loser)
+            if result['success']:
+                api_keys = []
+            else:
+                stop = await self.run_db(chat_request.attempt_failed, api_key, result)
+                api_keys = [] if stop else api_keys[2:] if hedged else api_keys[1:]
+                hedged = False
+
+        for api_key in api_keys:
+            result = await upstream(api_key, chat_request.stream, api_key is api_keys[-1])
+            if result['success']:
+                break
+            if await self.run_db(chat_request.attempt_failed, api_key, result):
+                break
+
+        if not result['success']:
+            return await self.send_json(send, *await self.run_db(chat_request.failed, api_key, result))
+        if chat_request.stream:
+            streamed = chat_request.stream_started(result)
+            # 客户端断开时任务被取消或 send 抛出异常，记为 cancelled；读取上游出错记为 error
+            status = 'cancelled'
+            try:
+                await self.send_stream(send, result, chat_request.rate_headers)
+                status = 'success'
+            except httpx.HTTPError:
+                status = 'error'
+                raise
+            finally:
+                await asyncio.shield(self.run_db(chat_request.stream_finished, api_key, result, streamed, status))
+            return
+        headers = await self.run_db(chat_request.completed, api_key, result, hedged)
+        await self.send_result(send, result, headers)
+
+    async def call_api(self, user_id, api_key, messages, model=None, temperature=0.7, max_tokens=None, stream=False,
+                       rate_wait=False, deadline=None, body=None):
+        # 与同步版本相同的重试策略和透传方式
+        if deadline is None:
+            deadline = retry_policy.deadline_for()
+        return await retry_policy.run_async(
+            lambda timeout: self.attempt_api(
+                user_id, api_key, messages, model, temperature, max_tokens, stream, rate_wait, timeout, body
+            ),
+            deadline, provider=api_key.provider, key_id=str(api_key.id)
+        )
+
+    async def attempt_api(self, user_id, api_key, messages, model, temperature, max_tokens, stream, rate_wait, timeout,
+                          body=None):
+        model = model or api_key.model
+        # 配额预留和结算都是本机 SQLite 的 BEGIN IMMEDIATE 事务，遇到写锁时会等待，放到线程池中执行
+        estimate = token_estimator.estimate(messages, max_tokens, api_key.provider, model)
+        state = await rate_limiter.acquire_async(
+            SCOPE_KEY, api_key.id, api_key.rpm_limit, api_key.tpm_limit, estimate, None if rate_wait else 0,
+            self.db_executor
+        )
+        if state is not None and not state.allowed:
+            return upstream_failed(api_key, rate_limited_result(state, api_key))
+        admitting = asyncio.ensure_future(self.run_db(admit_key, user_id, api_key, estimate))
+        try:
+            reservation, refused = await asyncio.shield(admitting)
+        except asyncio.CancelledError:
+            # 线程池中的预留不会随协程一起取消，完成后再归还
+            admitting.add_done_callback(lambda done: self.abandon(api_key, done))
+            raise
+        if refused:
+            return refused
+        started = router.begin(api_key.id)
+        timing = {'sent': time.perf_counter(), 'connect': 0, 'ttfb': 0}
+        try:
+            with metrics.in_flight('gateway_upstream_in_flight', provider=api_key.provider, key_id=str(api_key.id)):
+                result = await self._call_api(
+                    api_key, messages, model, temperature, max_tokens, stream, timing, timeout, body
+                )
+        except asyncio.CancelledError:
+            # 对冲落败被取消，不计入延迟统计和熔断失败次数，归还预留的Token
+            router.discard(api_key.id)
+            circuit_breakers.release(api_key)
+            # 已被取消的协程不能再等待，归还交给线程池在后台完成
+            self.db_executor.submit(quota_store.release, reservation)
+            raise
+        return await self.run_db(
+            finish_attempt, api_key, result, reservation, started,
+            timing['connect'], timing['ttfb'], time.perf_counter() - timing['sent']
+        )
+
+    def abandon(self, api_key, admitting):
+        if admitting.cancelled() or admitting.exception() is not None:
+            return
+        reservation, refused = admitting.result()
+        if not refused:
+            circuit_breakers.release(api_key)
+            self.db_executor.submit(quota_store.release, reservation)
+
+    async def _call_api(self, api_key, messages, model, temperature, max_tokens, stream, timing, timeout, body=None):
+        async def trace(event, info):
+            # httpcore 的连接事件只在新建连接时出现，TLS 握手计入连接耗时
+            if event == 'connection.connect_tcp.started':
+                timing['connecting'] = time.perf_counter()
+            elif event in ('connection.connect_tcp.complete', 'connection.start_tls.complete'):
+                timing['connect'] = time.perf_counter() - timing['connecting']
+
+        try:
+            adapter = adapter_for(api_key)
+            url, headers, content, raw = passthrough.request(
+                adapter, body, messages, model, temperature, max_tokens, stream
+            )
+            request = self.client.build_request(
+                'POST', url, headers=headers, content=content, timeout=timeout, extensions={'trace': trace}
+            )
+            # 总是先只读响应头，以便区分首字节时间和读取响应体的时间
+            response = await self.client.send(request, stream=True)
+            timing['ttfb'] = time.perf_counter() - timing['sent']
+            if not stream:
+                await response.aread()
+
+            if response.status_code != 200:
+                if stream:
+                    await response.aread()
+                    await response.aclose()
+                return upstream_error(response)
+
+            if stream:
+                relay = passthrough.relay(model) if raw else adapter.relay(model)
+                return {'success': True, 'response': response, 'relay': relay, 'usage': relay.usage, 'raw': raw}
+            if raw:
+                return passthrough.parse_response(adapter, response.content)
+            return adapter.parse_response(passthrough.loads(response.content))
+
+        except Exception as e:
+            # 只有连接阶段的错误可以重试，读超时和读取中断可能已经计费
+            return {'success': False, 'message': str(e), 'retryable': transient(e)}
+
+    async def send_stream(self, send, result, extra_headers=None):
+        response, relay = result['response'], result['relay']
+        headers = [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no')
+        ]
+        for name, value in (extra_headers or {}).items():
+            headers.append((name.lower().encode('latin-1'), value.encode('latin-1')))
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': headers
+        })
+        try:
+            if result.get('raw'):
+                # 透传: 收到多少字节就转发多少
+                async for chunk in response.aiter_bytes():
+                    await send({'type': 'http.response.body', 'body': relay.feed_bytes(chunk), 'more_body': True})
+                    if relay.done:
+                        break
+                for event in relay.finish_bytes():
+                    await send({'type': 'http.response.body', 'body': event, 'more_body': True})
+            else:
+                async for line in response.aiter_lines():
+                    data = sse_data(line)
+                    if data is None:
+                        continue
+                    for event in relay.feed(data):
+                        await send({'type': 'http.response.body', 'body': event.encode('utf-8'), 'more_body': True})
+                    if relay.done:
+                        break
+                for event in relay.finish():
+                    await send({'type': 'http.response.body', 'body': event.encode('utf-8'), 'more_body': True})
+        finally:
+            await response.aclose()
+        await send({'type': 'http.response.body', 'body': b''})
+
+    @staticmethod
+    async def read_body(receive):
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                return body
+
+    @classmethod
+    async def send_result(cls, send, result, extra_headers=None):
+        # 透传的响应体原样返回
+        if 'body' in result:
+            return await cls.send_body(send, 200, result['body'], extra_headers)
+        return await cls.send_json(send, 200, result['response'], extra_headers)
+
+    @classmethod
+    async def send_json(cls, send, status, payload, extra_headers=None):
+        await cls.send_body(send, status, passthrough.dumps(payload), extra_headers)
+
+    @staticmethod
+    async def send_body(send, status, body, extra_headers=None):
+        headers = [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode())
+        ]
+        for name, value in (extra_headers or {}).items():
+            headers.append((name.lower().encode('latin-1'), value.encode('latin-1')))
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': headers
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+
+def create_asgi_app(config_class=Config):
+    return AsyncGateway(create_app(config_class))
@@ -0,0 +1,49 @@
+import click
+
+from app.models import db
+from app.models.schema import copy_database
+from app.services.retention import retention
+from app.services.rollups import rebuild
+
+
+def register_cli(app):
+    @app.cli.command('backfill-rollups', help='根据 usage_records 重建按小时和按天的用量汇总表')
+    @click.option('--batch-size', default=5000, show_default=True, help='每批读取的原始记录数')
+    def backfill_rollups(batch_size):
+        def log(processed, total):
+            click.echo(f'\r已处理 {processed} 条记录 (截止ID {total})', nl=False)
+
+        processed = rebuild(batch_size=batch_size, log=log)
+        click.echo(f'\n汇总表重建完成，共处理 {processed} 条记录')
+
+    @app.cli.command('archive-usage', help='把超过保留天数的用量记录归档到 gzip CSV 文件并从数据库删除')
+    @click.option('--days', type=int, help='保留天数，默认使用 RETENTION_DAYS')
+    @click.option('--vacuum', is_flag=True, help='归档后执行整库 VACUUM (SQLite 会同时切换为增量回收模式，期间锁库)')
+    def archive_usage(days, vacuum):
+        if days:
+            retention.days = days
+        archived = retention.run_once(vacuum=vacuum)
+        if archived is None:
+            click.echo('另一个进程正在执行归档')
+            return
+        for day, deleted in archived:
+            click.echo(f'{day}: 归档并删除 {deleted} 条记录')
+        click.echo(f'归档完成，文件目录: {retention.archive_dir}')
+
+    @app.cli.command('copy-database', help='把当前数据库 (DATABASE_URL) 的全部数据复制到另一个空数据库，例如从 SQLite 迁移到 PostgreSQL')
+    @click.argument('target_url')
+    @click.option('--batch-size', default=5000, show_default=True, help='每批复制的行数')
+    def copy_database_command(target_url, batch_size):
+        current = []
+
+        def log(table, copied):
+            if current and current[-1] != table:
+                click.echo()
+            current.append(table)
+            click.echo(f'\r{table}: 已复制 {copied} 行', nl=False)
+
+        try:
+            copied = copy_database(db, target_url, batch_size=batch_size, log=log)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        click.echo('\n复制完成: ' + ', '.join(f'{table} {count} 行' for table, count in copied.items()))
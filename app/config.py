@@ -3,7 +3,163 @@ from datetime import timedelta
 
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'dev-secret-key-change-in-production'
-    SQLALCHEMY_DATABASE_URI = 'sqlite:///api_gateway_new.db'
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///api_gateway_new.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     PERMANENT_SESSION_LIFETIME = timedelta(days=7)
     JSON_AS_ASCII = False
+    
+    # 上游连接池
+    UPSTREAM_POOL_CONNECTIONS = int(os.environ.get('UPSTREAM_POOL_CONNECTIONS', 4))
+    UPSTREAM_POOL_MAXSIZE = int(os.environ.get('UPSTREAM_POOL_MAXSIZE', 32))
+    UPSTREAM_POOL_BLOCK = os.environ.get('UPSTREAM_POOL_BLOCK', 'true').lower() == 'true'
+    UPSTREAM_KEEPALIVE = os.environ.get('UPSTREAM_KEEPALIVE', 'true').lower() == 'true'
+    UPSTREAM_HTTP2 = os.environ.get('UPSTREAM_HTTP2', 'false').lower() == 'true'
+    
+    # 异步(ASGI)模式
+    ASYNC_MAX_CONNECTIONS = int(os.environ.get('ASYNC_MAX_CONNECTIONS', 2000))
+    ASYNC_DB_THREADS = int(os.environ.get('ASYNC_DB_THREADS', 8))
+    
+    # 请求透传: PASSTHROUGH_PROVIDERS 中的 OpenAI 兼容提供商直接转发客户端的原始请求体和上游的响应体；
+    # JSON_BACKEND 为 auto 时安装了 orjson 就用它解析和序列化 JSON
+    PASSTHROUGH_ENABLED = os.environ.get('PASSTHROUGH_ENABLED', 'true').lower() == 'true'
+    PASSTHROUGH_PROVIDERS = os.environ.get('PASSTHROUGH_PROVIDERS', 'openai,moonshot,deepseek,zhipu,azure')
+    JSON_BACKEND = os.environ.get('JSON_BACKEND', 'auto')
+    
+    # 认证缓存
+    AUTH_CACHE_TTL = int(os.environ.get('AUTH_CACHE_TTL', 60))
+    AUTH_CACHE_MAX_ENTRIES = int(os.environ.get('AUTH_CACHE_MAX_ENTRIES', 10000))
+    AUTH_CACHE_SHARED = os.environ.get('AUTH_CACHE_SHARED', 'true').lower() == 'true'
+    
+    # 用量记录批量写入
+    USAGE_WRITER_ENABLED = os.environ.get('USAGE_WRITER_ENABLED', 'true').lower() == 'true'
+    USAGE_BATCH_SIZE = int(os.environ.get('USAGE_BATCH_SIZE', 200))
+    USAGE_FLUSH_INTERVAL = float(os.environ.get('USAGE_FLUSH_INTERVAL', 1.0))
+    USAGE_QUEUE_SIZE = int(os.environ.get('USAGE_QUEUE_SIZE', 10000))
+    USAGE_ENQUEUE_TIMEOUT = float(os.environ.get('USAGE_ENQUEUE_TIMEOUT', 0.5))
+    # 失败请求记录: 每个进程每秒最多写入 USAGE_FAILURE_RATE 条失败明细，超出部分只累加汇总表的失败次数
+    USAGE_FAILURE_RATE = float(os.environ.get('USAGE_FAILURE_RATE', 20))
+    USAGE_FAILURE_BURST = int(os.environ.get('USAGE_FAILURE_BURST', 100))
+    USAGE_ERROR_MAX_CHARS = int(os.environ.get('USAGE_ERROR_MAX_CHARS', 500))
+    # 重试后仍写入失败的批次保存到本机目录，数据库恢复后重放 (默认 instance/usage_spill)
+    USAGE_SPILL_DIR = os.environ.get('USAGE_SPILL_DIR')
+    
+    # 响应缓存 (仅 temperature 为 0 的非流式请求)
+    RESPONSE_CACHE_ENABLED = os.environ.get('RESPONSE_CACHE_ENABLED', 'false').lower() == 'true'
+    RESPONSE_CACHE_BACKEND = os.environ.get('RESPONSE_CACHE_BACKEND', 'memory')
+    RESPONSE_CACHE_PATH = os.environ.get('RESPONSE_CACHE_PATH')
+    RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 3600))
+    RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+    RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 10000))
+    
+    # 语义缓存 (非流式请求): 最后一条用户消息与历史请求足够相似时直接返回缓存的响应；
+    # 未配置 SEMANTIC_CACHE_EMBEDDING_URL 时使用本地特征哈希向量，此时阈值须不低于 0.98，否则不启用
+    SEMANTIC_CACHE_ENABLED = os.environ.get('SEMANTIC_CACHE_ENABLED', 'false').lower() == 'true'
+    SEMANTIC_CACHE_THRESHOLD = float(os.environ.get('SEMANTIC_CACHE_THRESHOLD', 0.9))
+    SEMANTIC_CACHE_TTL = int(os.environ.get('SEMANTIC_CACHE_TTL', 86400))
+    SEMANTIC_CACHE_MAX_ENTRIES = int(os.environ.get('SEMANTIC_CACHE_MAX_ENTRIES', 100000))
+    SEMANTIC_CACHE_MAX_ENTRIES_PER_USER = int(os.environ.get('SEMANTIC_CACHE_MAX_ENTRIES_PER_USER', 1000))
+    SEMANTIC_CACHE_DIR = os.environ.get('SEMANTIC_CACHE_DIR')
+    SEMANTIC_CACHE_DIM = int(os.environ.get('SEMANTIC_CACHE_DIM', 256))
+    SEMANTIC_CACHE_EMBEDDING_URL = os.environ.get('SEMANTIC_CACHE_EMBEDDING_URL')
+    SEMANTIC_CACHE_EMBEDDING_MODEL = os.environ.get('SEMANTIC_CACHE_EMBEDDING_MODEL', 'text-embedding-3-small')
+    SEMANTIC_CACHE_EMBEDDING_KEY = os.environ.get('SEMANTIC_CACHE_EMBEDDING_KEY')
+    SEMANTIC_CACHE_EMBEDDING_TIMEOUT = float(os.environ.get('SEMANTIC_CACHE_EMBEDDING_TIMEOUT', 2))
+    
+    # 上游Key路由: priority / latency / weighted_rr / least_inflight
+    ROUTING_POLICY = os.environ.get('ROUTING_POLICY', 'priority')
+    ROUTING_WINDOW_SIZE = int(os.environ.get('ROUTING_WINDOW_SIZE', 200))
+    ROUTING_WINDOW_SECONDS = int(os.environ.get('ROUTING_WINDOW_SECONDS', 300))
+    ROUTING_UNHEALTHY_ERROR_RATE = float(os.environ.get('ROUTING_UNHEALTHY_ERROR_RATE', 0.5))
+    
+    # 熔断器: key 按单个上游Key熔断，base_url 按同一上游地址熔断
+    CIRCUIT_BREAKER_ENABLED = os.environ.get('CIRCUIT_BREAKER_ENABLED', 'true').lower() == 'true'
+    CIRCUIT_BREAKER_SCOPE = os.environ.get('CIRCUIT_BREAKER_SCOPE', 'key')
+    CIRCUIT_BREAKER_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_BREAKER_FAILURE_THRESHOLD', 5))
+    CIRCUIT_BREAKER_RECOVERY_TIMEOUT = int(os.environ.get('CIRCUIT_BREAKER_RECOVERY_TIMEOUT', 30))
+    CIRCUIT_BREAKER_HALF_OPEN_CALLS = int(os.environ.get('CIRCUIT_BREAKER_HALF_OPEN_CALLS', 1))
+    
+    # 上游重试: 瞬时故障在同一Key上按指数退避重试，总耗时不超过 RETRY_DEADLINE 和客户端的 X-Request-Timeout，
+    # 重试次数不超过上游调用次数的 RETRY_BUDGET_RATIO
+    RETRY_ENABLED = os.environ.get('RETRY_ENABLED', 'true').lower() == 'true'
+    RETRY_MAX_ATTEMPTS = int(os.environ.get('RETRY_MAX_ATTEMPTS', 3))
+    RETRY_BASE_DELAY = float(os.environ.get('RETRY_BASE_DELAY', 0.2))
+    RETRY_MAX_DELAY = float(os.environ.get('RETRY_MAX_DELAY', 5))
+    RETRY_DEADLINE = float(os.environ.get('RETRY_DEADLINE', 120))
+    RETRY_STATUS_CODES = os.environ.get('RETRY_STATUS_CODES', '408,429,500,502,503,504')
+    RETRY_BUDGET_RATIO = float(os.environ.get('RETRY_BUDGET_RATIO', 0.2))
+    RETRY_BUDGET_BURST = int(os.environ.get('RETRY_BUDGET_BURST', 10))
+    
+    # 对冲请求: HEDGE_DELAY 为 0 时按主Key的 p90 延迟触发，额外请求占比不超过 HEDGE_BUDGET_RATIO
+    HEDGE_ENABLED = os.environ.get('HEDGE_ENABLED', 'false').lower() == 'true'
+    HEDGE_DELAY = float(os.environ.get('HEDGE_DELAY', 0))
+    HEDGE_MIN_DELAY = float(os.environ.get('HEDGE_MIN_DELAY', 0.05))
+    HEDGE_DEFAULT_DELAY = float(os.environ.get('HEDGE_DEFAULT_DELAY', 1.0))
+    HEDGE_BUDGET_RATIO = float(os.environ.get('HEDGE_BUDGET_RATIO', 0.1))
+    HEDGE_BUDGET_BURST = int(os.environ.get('HEDGE_BUDGET_BURST', 5))
+    HEDGE_THREADS = int(os.environ.get('HEDGE_THREADS', 32))
+    
+    # 每日Token配额: 计数器保存在本机 SQLite 文件中，所有 worker 共享
+    QUOTA_ENABLED = os.environ.get('QUOTA_ENABLED', 'true').lower() == 'true'
+    QUOTA_STORE_PATH = os.environ.get('QUOTA_STORE_PATH')
+    QUOTA_DEFAULT_COMPLETION_TOKENS = int(os.environ.get('QUOTA_DEFAULT_COMPLETION_TOKENS', 256))
+    
+    # Token估算与上下文长度检查: TOKEN_ESTIMATOR 为 auto 时安装了 tiktoken 的 OpenAI 模型按真实词表计数，heuristic 只用估算；
+    # MODEL_CONTEXT_WINDOWS 覆盖或补充模型的上下文长度，格式为 "模型名前缀=tokens,..."
+    TOKEN_ESTIMATOR = os.environ.get('TOKEN_ESTIMATOR', 'auto')
+    TOKEN_ESTIMATE_TOLERANCE = float(os.environ.get('TOKEN_ESTIMATE_TOLERANCE', 0.1))
+    TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 4096))
+    MODEL_CONTEXT_WINDOWS = os.environ.get('MODEL_CONTEXT_WINDOWS', '')
+    
+    # 使用统计页面
+    USAGE_MAX_DAYS = int(os.environ.get('USAGE_MAX_DAYS', 90))
+    USAGE_PAGE_SIZE = int(os.environ.get('USAGE_PAGE_SIZE', 50))
+    
+    # 用量记录保留与归档: 超过保留天数的原始记录归档为 gzip CSV 后删除，汇总表保留
+    RETENTION_ENABLED = os.environ.get('RETENTION_ENABLED', 'false').lower() == 'true'
+    RETENTION_DAYS = int(os.environ.get('RETENTION_DAYS', 30))
+    RETENTION_INTERVAL = int(os.environ.get('RETENTION_INTERVAL', 3600))
+    RETENTION_BATCH_SIZE = int(os.environ.get('RETENTION_BATCH_SIZE', 5000))
+    RETENTION_ARCHIVE_DIR = os.environ.get('RETENTION_ARCHIVE_DIR')
+    
+    # 数据库连接: DATABASE_URL 指向 PostgreSQL 时使用连接池参数，SQLite 时使用下面的 PRAGMA 设置
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 20))
+    DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+    DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true'
+    SQLITE_TUNED = os.environ.get('SQLITE_TUNED', 'true').lower() == 'true'
+    SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000))
+    SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL').upper()
+    SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 268435456))
+    
+    # 批量请求与 embeddings 合并
+    BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 1000))
+    BATCH_THREADS = int(os.environ.get('BATCH_THREADS', 16))
+    BATCH_PER_KEY_CONCURRENCY = int(os.environ.get('BATCH_PER_KEY_CONCURRENCY', 4))
+    EMBEDDING_COALESCE_ENABLED = os.environ.get('EMBEDDING_COALESCE_ENABLED', 'true').lower() == 'true'
+    EMBEDDING_COALESCE_WINDOW = float(os.environ.get('EMBEDDING_COALESCE_WINDOW', 0.01))
+    EMBEDDING_COALESCE_MAX_INPUTS = int(os.environ.get('EMBEDDING_COALESCE_MAX_INPUTS', 256))
+    
+    # 异步任务队列: 任务保存在本机 SQLite 文件中，每个 worker 进程启动 JOB_WORKERS 个工作线程
+    JOB_QUEUE_ENABLED = os.environ.get('JOB_QUEUE_ENABLED', 'true').lower() == 'true'
+    JOB_STORE_PATH = os.environ.get('JOB_STORE_PATH')
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+    JOB_PER_KEY_CONCURRENCY = int(os.environ.get('JOB_PER_KEY_CONCURRENCY', 2))
+    JOB_RESULT_TTL = int(os.environ.get('JOB_RESULT_TTL', 3600))
+    JOB_MAX_WAIT = int(os.environ.get('JOB_MAX_WAIT', 30))
+    JOB_LEASE = int(os.environ.get('JOB_LEASE', 300))
+    JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+    JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 1.0))
+    
+    # 速率限制: 每分钟请求数/Token数的令牌桶保存在本机 SQLite 文件中，各 worker 共享；0 表示不限制
+    RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+    RATE_LIMIT_STORE_PATH = os.environ.get('RATE_LIMIT_STORE_PATH')
+    RATE_LIMIT_MAX_WAIT = float(os.environ.get('RATE_LIMIT_MAX_WAIT', 0))
+    RATE_LIMIT_DEFAULT_USER_RPM = int(os.environ.get('RATE_LIMIT_DEFAULT_USER_RPM', 0))
+    RATE_LIMIT_DEFAULT_USER_TPM = int(os.environ.get('RATE_LIMIT_DEFAULT_USER_TPM', 0))
+    
+    # 监控指标: 各 worker 的指标快照写入 METRICS_DIR，/metrics 合并输出；设置 METRICS_TOKEN 后抓取时需带 Bearer Token
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+    METRICS_DIR = os.environ.get('METRICS_DIR')
+    METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
@@ -14,6 +14,9 @@ class User(UserMixin, db.Model):
     api_key = db.Column(db.String(256), unique=True, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     is_active = db.Column(db.Boolean, default=True)
+    max_tokens_per_day = db.Column(db.Integer, nullable=True)
+    rpm_limit = db.Column(db.Integer, nullable=True)
+    tpm_limit = db.Column(db.Integer, nullable=True)
     
     api_keys = db.relationship('APIKey', backref='user', lazy=True, cascade='all, delete-orphan')
     usage_records = db.relationship('UsageRecord', backref='user', lazy=True, cascade='all, delete-orphan')
@@ -34,27 +37,79 @@ class APIKey(db.Model):
     priority = db.Column(db.Integer, default=0)
     max_tokens_per_day = db.Column(db.Integer, nullable=True)
     used_tokens_today = db.Column(db.Integer, default=0)
+    rpm_limit = db.Column(db.Integer, nullable=True)
+    tpm_limit = db.Column(db.Integer, nullable=True)
     last_used_at = db.Column(db.DateTime, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     usage_records = db.relationship('UsageRecord', backref='api_key', lazy=True, cascade='all, delete-orphan')
+    hourly_rollups = db.relationship('UsageRollupHourly', lazy=True, cascade='all, delete-orphan')
+    daily_rollups = db.relationship('UsageRollupDaily', lazy=True, cascade='all, delete-orphan')
 
 class UsageRecord(db.Model):
     __tablename__ = 'usage_records'
+    __table_args__ = (
+        db.Index('ix_usage_records_user_created', 'user_id', 'created_at', 'id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    api_key_id = db.Column(db.Integer, db.ForeignKey('api_keys.id'), nullable=False)
+    api_key_id = db.Column(db.Integer, db.ForeignKey('api_keys.id'), nullable=True)
     provider = db.Column(db.String(50), nullable=False)
     model = db.Column(db.String(100), nullable=True)
     prompt_tokens = db.Column(db.Integer, default=0)
     completion_tokens = db.Column(db.Integer, default=0)
     total_tokens = db.Column(db.Integer, default=0)
     request_time = db.Column(db.Float, default=0)
+    auth_time = db.Column(db.Float, default=0)
+    select_time = db.Column(db.Float, default=0)
+    connect_time = db.Column(db.Float, default=0)
+    ttfb = db.Column(db.Float, default=0)
+    upstream_time = db.Column(db.Float, default=0)
     status = db.Column(db.String(20), default='success')
+    upstream_status = db.Column(db.Integer, nullable=True)
     error_message = db.Column(db.Text, nullable=True)
+    cache_hit = db.Column(db.Boolean, default=False)
+    saved_tokens = db.Column(db.Integer, default=0)
+    is_hedge = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+class UsageRollupMixin:
+    # 按时间桶预聚合的用量，由 usage_writer 在写入原始记录的同一事务中累加
+    id = db.Column(db.Integer, primary_key=True)
+    bucket = db.Column(db.DateTime, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    api_key_id = db.Column(db.Integer, db.ForeignKey('api_keys.id'), nullable=False)
+    provider = db.Column(db.String(50), nullable=False)
+    model = db.Column(db.String(100), nullable=False, default='')
+    requests = db.Column(db.Integer, default=0)
+    success_requests = db.Column(db.Integer, default=0)
+    failed_requests = db.Column(db.Integer, default=0)
+    # 对冲落败和客户端中途断开的请求，不算成功也不算失败
+    cancelled_requests = db.Column(db.Integer, default=0)
+    prompt_tokens = db.Column(db.Integer, default=0)
+    completion_tokens = db.Column(db.Integer, default=0)
+    total_tokens = db.Column(db.Integer, default=0)
+    saved_tokens = db.Column(db.Integer, default=0)
+    latency_sum = db.Column(db.Float, default=0)
+    # 被采样掉、没有原始记录的失败次数和耗时 (已包含在上面的计数中)，重建汇总时保留
+    sampled_failures = db.Column(db.Integer, default=0)
+    sampled_latency = db.Column(db.Float, default=0)
+
+class UsageRollupHourly(UsageRollupMixin, db.Model):
+    __tablename__ = 'usage_rollups_hourly'
+    __table_args__ = (
+        db.UniqueConstraint('bucket', 'user_id', 'api_key_id', 'provider', 'model', name='uq_usage_rollups_hourly'),
+        db.Index('ix_usage_rollups_hourly_user_bucket', 'user_id', 'bucket'),
+    )
+
+class UsageRollupDaily(UsageRollupMixin, db.Model):
+    __tablename__ = 'usage_rollups_daily'
+    __table_args__ = (
+        db.UniqueConstraint('bucket', 'user_id', 'api_key_id', 'provider', 'model', name='uq_usage_rollups_daily'),
+        db.Index('ix_usage_rollups_daily_user_bucket', 'user_id', 'bucket'),
+    )
+
 class APIProvider:
     PROVIDERS = {
         'openai': {
@@ -0,0 +1,49 @@
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+
+def normalize_database_url(url):
+    # 部分托管平台提供的是 postgres:// 前缀，SQLAlchemy 只识别 postgresql://
+    if url.startswith('postgres://'):
+        return 'postgresql://' + url[len('postgres://'):]
+    return url
+
+
+def is_sqlite(uri):
+    return make_url(uri).get_backend_name() == 'sqlite'
+
+
+def engine_options(config):
+    # 服务端数据库按 worker 数配置连接池；SQLite 只需要设置等锁时间，连接池由 Flask-SQLAlchemy 选择
+    if is_sqlite(config['SQLALCHEMY_DATABASE_URI']):
+        return {'connect_args': {'timeout': config['SQLITE_BUSY_TIMEOUT'] / 1000}}
+    return {
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': config['DB_POOL_PRE_PING']
+    }
+
+
+def configure_database(app):
+    uri = normalize_database_url(app.config['SQLALCHEMY_DATABASE_URI'])
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    options = engine_options(app.config)
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+
+def tune_sqlite(engine, config):
+    # 每个新连接都设置一遍：WAL 让读写互不阻塞，NORMAL 在 WAL 下只在检查点时 fsync，mmap 减少读取时的系统调用
+    if engine.dialect.name != 'sqlite' or not config['SQLITE_TUNED'] or engine.url.database in (None, '', ':memory:'):
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute(f"PRAGMA busy_timeout={int(config['SQLITE_BUSY_TIMEOUT'])}")
+        cursor.execute(f"PRAGMA synchronous={config['SQLITE_SYNCHRONOUS']}")
+        cursor.execute(f"PRAGMA mmap_size={int(config['SQLITE_MMAP_SIZE'])}")
+        cursor.close()
@@ -0,0 +1,72 @@
+from sqlalchemy import create_engine, func, inspect, literal, select, text
+
+from app.models.engine import normalize_database_url
+
+
+def column_default_sql(column, dialect):
+    default = column.default
+    if default is None or not default.is_scalar:
+        return ''
+    value = literal(default.arg, type_=column.type).compile(
+        dialect=dialect, compile_kwargs={'literal_binds': True}
+    )
+    return f' DEFAULT {value}'
+
+
+def upgrade_schema(db):
+    # create_all 不会修改已存在的表，这里为旧数据库补齐新增的列和索引
+    engine = db.engine
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+
+    with engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_columns = {c['name']: c['nullable'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    # 改为可空的列在 PostgreSQL 上去掉 NOT NULL；SQLite 不支持修改已有列的约束
+                    if column.nullable and not existing_columns[column.name] and engine.dialect.name == 'postgresql':
+                        conn.execute(text(f'ALTER TABLE {table.name} ALTER COLUMN {column.name} DROP NOT NULL'))
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                default = column_default_sql(column, engine.dialect)
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}{default}'))
+
+            existing_indexes = {i['name'] for i in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(conn)
+
+
+def copy_database(db, target_url, batch_size=5000, log=None):
+    # 把当前数据库的全部表按外键依赖顺序复制到新的空数据库，保留原有ID
+    target = create_engine(normalize_database_url(target_url))
+    db.metadata.create_all(target)
+    with target.connect() as conn:
+        for table in db.metadata.sorted_tables:
+            if conn.execute(select(func.count()).select_from(table)).scalar():
+                raise ValueError(f'目标数据库的 {table.name} 表不为空')
+
+    copied = {}
+    with db.engine.connect() as source, target.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            copied[table.name] = 0
+            result = source.execution_options(yield_per=batch_size).execute(select(table).order_by(*table.primary_key.columns))
+            for rows in result.partitions():
+                conn.execute(table.insert(), [row._asdict() for row in rows])
+                copied[table.name] += len(rows)
+                if log:
+                    log(table.name, copied[table.name])
+
+        if target.dialect.name == 'postgresql':
+            # 显式写入ID后序列不会前进，按已有的最大ID重置
+            for table in db.metadata.sorted_tables:
+                if 'id' in table.c and table.c.id.autoincrement:
+                    conn.execute(text(
+                        f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                        f"COALESCE((SELECT MAX(id) FROM {table.name}), 0) + 1, false)"
+                    ))
+    target.dispose()
+    return copied
@@ -1,3 +1,18 @@
-from flask import Blueprint
+import hmac
+
+from flask import Blueprint, Response, current_app, request
+
+from app.services.metrics import metrics
 
 main_bp = Blueprint('main', __name__)
+
+
+@main_bp.route('/metrics')
+def prometheus_metrics():
+    # Prometheus 抓取接口，合并本机所有 worker 的指标
+    if not metrics.enabled:
+        return Response('metrics disabled\n', status=404, mimetype='text/plain')
+    token = current_app.config.get('METRICS_TOKEN')
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return Response('unauthorized\n', status=401, mimetype='text/plain')
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
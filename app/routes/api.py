@@ -1,9 +1,36 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify
+from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify, Response, stream_with_context, current_app, g
 from flask_login import login_required, current_user
-from app.models import db, User, APIKey, UsageRecord, APIProvider
+from app.models import db, APIKey, UsageRecord, APIProvider
+from app.services.auth_cache import auth_cache
+from app.services.batching import batch_runner, embedding_coalescer
+from app.services.chat import (
+    ChatRequest, bearer_token, select_api_keys, reserve_tokens, admit_key, finish_attempt, rate_limited_result,
+    no_key_result, fallback_key, failed_attempt, request_failed, record_failure, upstream_failed, upstream_error,
+    observe_upstream, record_usage, consume_rate_tokens, usage_event
+)
+from app.services.circuit_breaker import circuit_breakers
+from app.services.hedging import hedger
+from app.services.http_pool import upstream_pool
+from app.services.jobs import job_queue, JobFailed
+from app.services.metrics import metrics, Timer
+from app.services.passthrough import passthrough
+from app.services.quota import quota_store, SCOPE_USER, SCOPE_KEY
+from app.services.rate_limit import rate_limiter
+from app.services.response_cache import response_cache
+from app.services.retention import retention, EXPORT_COLUMNS
+from app.services.retry import retry_policy, transient
+from app.services.routing import router
+from app.services.semantic_cache import semantic_cache
+from app.services.streaming import open_stream
+from app.services.tokens import token_estimator
+from app.services.usage_stats import day_start, summarize, provider_breakdown, daily_usage, record_page
+from app.services.usage_writer import usage_writer
+from app.services.upstream import adapter_for
 from datetime import datetime, timedelta
-import requests
+import csv
+import io
 import json
+import math
 import time
 
 api_bp = Blueprint('api', __name__)
@@ -12,22 +39,9 @@ api_bp = Blueprint('api', __name__)
 @login_required
 def dashboard():
     api_keys = APIKey.query.filter_by(user_id=current_user.id).all()
-    usage_today = UsageRecord.query.filter(
-        UsageRecord.user_id == current_user.id,
-        UsageRecord.created_at >= datetime.utcnow().replace(hour=0, minute=0, second=0)
-    ).all()
-    
-    total_tokens_today = sum(r.total_tokens for r in usage_today)
-    total_requests_today = len(usage_today)
-    success_requests = len([r for r in usage_today if r.status == 'success'])
-    failed_requests = total_requests_today - success_requests
-    
-    provider_stats = {}
-    for record in usage_today:
-        if record.provider not in provider_stats:
-            provider_stats[record.provider] = {'tokens': 0, 'requests': 0}
-        provider_stats[record.provider]['tokens'] += record.total_tokens
-        provider_stats[record.provider]['requests'] += 1
+    today = day_start()
+    summary = summarize(current_user.id, today)
+    provider_stats = provider_breakdown(current_user.id, today)
     
     recent_records = UsageRecord.query.filter_by(user_id=current_user.id).order_by(
         UsageRecord.created_at.desc()
@@ -35,20 +49,25 @@ def dashboard():
     
     return render_template('dashboard.html', 
                          api_keys=api_keys,
-                         total_tokens_today=total_tokens_today,
-                         total_requests_today=total_requests_today,
-                         success_requests=success_requests,
-                         failed_requests=failed_requests,
+                         total_tokens_today=summary['tokens'],
+                         total_requests_today=summary['requests'],
+                         success_requests=summary['success'],
+                         failed_requests=summary['failed'],
                          provider_stats=provider_stats,
                          recent_records=recent_records,
                          providers=APIProvider.PROVIDERS,
+                         breaker_states={key.id: circuit_breakers.state_for(key) for key in api_keys},
+                         key_usage=quota_store.key_usage(api_keys),
+                         user_quota_used=quota_store.user_usage(current_user.id),
+                         semantic_stats=semantic_cache.user_stats(current_user.id) if semantic_cache.enabled else None,
                          user_api_key=current_user.api_key)
 
 @api_bp.route('/api-keys', methods=['GET'])
 @login_required
 def api_keys():
     api_keys = APIKey.query.filter_by(user_id=current_user.id).order_by(APIKey.priority.desc()).all()
-    return render_template('api_keys.html', api_keys=api_keys, providers=APIProvider.PROVIDERS)
+    return render_template('api_keys.html', api_keys=api_keys, providers=APIProvider.PROVIDERS,
+                           key_usage=quota_store.key_usage(api_keys))
 
 @api_bp.route('/api-keys/add', methods=['POST'])
 @login_required
@@ -62,6 +81,8 @@ def add_api_key():
     is_free = request.form.get('is_free') == 'on'
     max_tokens_per_day = request.form.get('max_tokens_per_day', type=int)
     priority = request.form.get('priority', type=int, default=0)
+    rpm_limit = request.form.get('rpm_limit', type=int)
+    tpm_limit = request.form.get('tpm_limit', type=int)
     
     if not name or not provider or not api_key:
         flash('请填写API名称、提供商和API Key', 'error')
@@ -84,11 +105,14 @@ def add_api_key():
         model=model if model else None,
         is_free=is_free,
         max_tokens_per_day=max_tokens_per_day,
-        priority=priority
+        priority=priority,
+        rpm_limit=rpm_limit or None,
+        tpm_limit=tpm_limit or None
     )
     
     db.session.add(new_api_key)
     db.session.commit()
+    auth_cache.invalidate_keys(current_user.id)
     
     flash('API Key添加成功', 'success')
     return redirect(url_for('api.api_keys'))
@@ -99,6 +123,7 @@ def toggle_api_key(key_id):
     api_key = APIKey.query.filter_by(id=key_id, user_id=current_user.id).first_or_404()
     api_key.is_active = not api_key.is_active
     db.session.commit()
+    auth_cache.invalidate_keys(current_user.id)
     
     status = '启用' if api_key.is_active else '停用'
     flash(f'API {status}', 'success')
@@ -110,6 +135,7 @@ def delete_api_key(key_id):
     api_key = APIKey.query.filter_by(id=key_id, user_id=current_user.id).first_or_404()
     db.session.delete(api_key)
     db.session.commit()
+    auth_cache.invalidate_keys(current_user.id)
     
     flash('API Key已删除', 'success')
     return redirect(url_for('api.api_keys'))
@@ -130,81 +156,15 @@ def test_api_key(key_id):
 
 def test_provider_connection(api_key):
     try:
-        if api_key.provider == 'openai':
-            headers = {
-                'Authorization': f'Bearer {api_key.api_key}',
-                'Content-Type': 'application/json'
-            }
-            model = api_key.model or 'gpt-3.5-turbo'
-            base_url = api_key.base_url or 'https://api.openai.com/v1'
-            response = requests.post(
-                f'{base_url}/chat/completions',
-                headers=headers,
-                json={'model': model, 'messages': [{'role': 'user', 'content': 'Hi'}], 'max_tokens': 5},
-                timeout=10
-            )
-            if response.status_code == 200:
-                return {'success': True, 'message': 'API连接正常'}
-            else:
-                return {'success': False, 'message': f'HTTP {response.status_code}: {response.text[:100]}'}
-        
-        elif api_key.provider == 'anthropic':
-            headers = {
-                'x-api-key': api_key.api_key,
-                'anthropic-version': '2023-06-01',
-                'Content-Type': 'application/json'
-            }
-            model = api_key.model or 'claude-3-haiku-20240307'
-            base_url = api_key.base_url or 'https://api.anthropic.com/v1'
-            response = requests.post(
-                f'{base_url}/messages',
-                headers=headers,
-                json={'model': model, 'max_tokens': 5, 'messages': [{'role': 'user', 'content': 'Hi'}]},
-                timeout=10
-            )
-            if response.status_code == 200:
-                return {'success': True, 'message': 'API连接正常'}
-            else:
-                return {'success': False, 'message': f'HTTP {response.status_code}: {response.text[:100]}'}
-        
-        elif api_key.provider in ['moonshot', 'zhipu', 'deepseek', 'qwen', 'minimax']:
-            headers = {
-                'Authorization': f'Bearer {api_key.api_key}',
-                'Content-Type': 'application/json'
-            }
-            model = api_key.model or ''
-            base_url = api_key.base_url or ''
-            response = requests.post(
-                f'{base_url}/chat/completions',
-                headers=headers,
-                json={'model': model, 'messages': [{'role': 'user', 'content': 'Hi'}], 'max_tokens': 5},
-                timeout=10
-            )
-            if response.status_code == 200:
-                return {'success': True, 'message': 'API连接正常'}
-            else:
-                return {'success': False, 'message': f'HTTP {response.status_code}: {response.text[:100]}'}
-        
-        elif api_key.provider == 'azure':
-            headers = {
-                'api-key': api_key.api_key,
-                'Content-Type': 'application/json'
-            }
-            base_url = api_key.base_url
-            deployment = api_key.model or 'gpt-35-turbo'
-            response = requests.post(
-                f'{base_url}/openai/deployments/{deployment}/chat/completions?api-version=2024-02-15-preview',
-                headers=headers,
-                json={'messages': [{'role': 'user', 'content': 'Hi'}], 'max_tokens': 5},
-                timeout=10
-            )
-            if response.status_code == 200:
-                return {'success': True, 'message': 'API连接正常'}
-            else:
-                return {'success': False, 'message': f'HTTP {response.status_code}: {response.text[:100]}'}
-        
+        adapter = adapter_for(api_key)
+        url, headers, payload = adapter.request(
+            [{'role': 'user', 'content': 'Hi'}], adapter.default_model, max_tokens=5
+        )
+        response = upstream_pool.post(url, headers=headers, json=payload, timeout=10)
+        if response.status_code == 200:
+            return {'success': True, 'message': 'API连接正常'}
         else:
-            return {'success': False, 'message': f'未支持的提供商: {api_key.provider}'}
+            return {'success': False, 'message': f'HTTP {response.status_code}: {response.text[:100]}'}
     
     except Exception as e:
         return {'success': False, 'message': str(e)}
@@ -213,377 +173,600 @@ def test_provider_connection(api_key):
 @login_required
 def usage():
     days = request.args.get('days', type=int, default=7)
-    start_date = datetime.utcnow() - timedelta(days=days)
-    
-    records = UsageRecord.query.filter(
-        UsageRecord.user_id == current_user.id,
-        UsageRecord.created_at >= start_date
-    ).order_by(UsageRecord.created_at.desc()).all()
-    
-    daily_usage = {}
-    for record in records:
-        date_key = record.created_at.strftime('%Y-%m-%d')
-        if date_key not in daily_usage:
-            daily_usage[date_key] = {'tokens': 0, 'requests': 0, 'providers': {}}
-        daily_usage[date_key]['tokens'] += record.total_tokens
-        daily_usage[date_key]['requests'] += 1
-        
-        if record.provider not in daily_usage[date_key]['providers']:
-            daily_usage[date_key]['providers'][record.provider] = {'tokens': 0, 'requests': 0}
-        daily_usage[date_key]['providers'][record.provider]['tokens'] += record.total_tokens
-        daily_usage[date_key]['providers'][record.provider]['requests'] += 1
+    days = max(1, min(days, current_app.config['USAGE_MAX_DAYS']))
+    cursor = request.args.get('before')
+    start_date = day_start() - timedelta(days=days - 1)
+    
+    # 汇总读取按天预聚合的表，明细按页读取
+    summary = summarize(current_user.id, start_date)
+    records, next_cursor = record_page(
+        current_user.id, start_date, cursor, current_app.config['USAGE_PAGE_SIZE']
+    )
     
-    return render_template('usage.html', records=records, daily_usage=daily_usage, days=days)
+    return render_template('usage.html',
+                         records=records,
+                         next_cursor=next_cursor,
+                         cursor=cursor,
+                         daily_usage=daily_usage(current_user.id, start_date),
+                         days=days,
+                         start_date=start_date,
+                         saved_tokens=summary['saved_tokens'],
+                         providers=APIProvider.PROVIDERS)
 
-@api_bp.route('/chat', methods=['POST'])
-def chat():
-    # 从请求头获取API key
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or not auth_header.startswith('Bearer '):
-        return jsonify({'error': 'Unauthorized: No API key provided'}), 401
-    
-    user_api_key = auth_header.split(' ')[1]
+@api_bp.route('/usage/export')
+@login_required
+def export_usage():
+    # 导出包含已归档的历史记录，按日期范围 [start, end) 流式输出CSV
+    try:
+        end = datetime.strptime(request.args['end'], '%Y-%m-%d') if request.args.get('end') else day_start() + timedelta(days=1)
+        start = datetime.strptime(request.args['start'], '%Y-%m-%d') if request.args.get('start') else end - timedelta(days=30)
+    except ValueError:
+        return jsonify({'error': '日期格式应为 YYYY-MM-DD'}), 400
+    user_id = current_user.id
+    
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_COLUMNS)
+        for row in retention.iter_export(user_id, start, end):
+            writer.writerow(['' if row.get(column) is None else row[column] for column in EXPORT_COLUMNS])
+            if buffer.tell() > 65536:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    
+    filename = f'usage-{start:%Y%m%d}-{end:%Y%m%d}.csv'
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
+
+def authenticate():
+    # 从请求头获取API key，返回 (user_id, 错误响应)
+    user_api_key = bearer_token(request.headers)
+    if user_api_key is None:
+        return None, (jsonify({'error': 'Unauthorized: No API key provided'}), 401)
     
     # 验证API key
-    user = User.query.filter_by(api_key=user_api_key).first()
-    if not user:
-        return jsonify({'error': 'Unauthorized: Invalid API key'}), 401
-    
-    data = request.get_json()
-    messages = data.get('messages', [])
-    model = data.get('model')
-    temperature = data.get('temperature', 0.7)
-    max_tokens = data.get('max_tokens')
-    
-    api_key = select_api_key(user.id, model)
-    
-    if not api_key:
-        return jsonify({'error': '没有可用的API Key'}), 400
-    
-    result = call_api(api_key, messages, model, temperature, max_tokens)
-    
+    user_id = auth_cache.get_user_id(user_api_key)
+    if not user_id:
+        return None, (jsonify({'error': 'Unauthorized: Invalid API key'}), 401)
+    return user_id, None
+
+def limit_user(user_id, tokens):
+    # 用户级速率限制，超限时按配置排队等待；未配置限制时返回 None
+    rpm, tpm = rate_limiter.user_limits(*auth_cache.get_user_rate_limits(user_id))
+    return rate_limiter.acquire(SCOPE_USER, user_id, rpm, tpm, tokens)
+
+def limit_key(api_key, tokens, wait=False):
+    # 上游Key级速率限制：超限的Key直接跳过，只有最后一个候选Key才排队等待
+    state = rate_limiter.acquire(SCOPE_KEY, api_key.id, api_key.rpm_limit, api_key.tpm_limit, tokens, None if wait else 0)
+    if state is not None and not state.allowed:
+        return rate_limited_result(state, api_key)
+    return None
+
+def rate_limited_response(result):
+    response = jsonify({'error': result['message']})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(max(math.ceil(result['rate_limited']), 1))
+    return response
+
+@api_bp.after_request
+def add_rate_limit_headers(response):
+    state = g.pop('rate_limit', None)
+    if state is not None:
+        response.headers.update(state.headers())
+    return response
+
+@api_bp.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    metrics.inc('gateway_http_requests_in_flight', endpoint=request.endpoint)
+
+@api_bp.after_request
+def record_request_metrics(response):
+    # 流式响应只计到响应头就绪，完整耗时见 gateway_request_duration_seconds
+    metrics.inc('gateway_http_requests_total', endpoint=request.endpoint, code=str(response.status_code))
+    metrics.observe('gateway_http_request_duration_seconds', time.perf_counter() - g.request_started,
+                    endpoint=request.endpoint)
+    return response
+
+@api_bp.teardown_request
+def finish_request_metrics(exc=None):
+    if 'request_started' in g:
+        metrics.inc('gateway_http_requests_in_flight', -1, endpoint=request.endpoint)
+
+@api_bp.route('/chat', methods=['POST'])
+def chat():
+    # 各步骤与 ASGI 网关共用 (app/services/chat.py)，这里只负责同步调用上游和生成响应
+    chat_request, reply = ChatRequest.parse(request.headers, request.get_data(cache=True))
+    if reply:
+        return json_reply(*reply)
+    reply = chat_request.authenticate()
+    if reply:
+        return json_reply(*reply)
+    reply = chat_request.admit(rate_limiter.acquire(*chat_request.rate_limit()))
+    if reply:
+        return json_reply(*reply)
+    reply = chat_request.cached()
+    if reply:
+        return json_reply(*reply)
+    
+    def upstream(api_key, stream=False, rate_wait=False):
+        return call_api(chat_request.user_id, api_key, chat_request.messages, chat_request.model, chat_request.temperature,
+                        chat_request.max_tokens, stream, rate_wait, chat_request.deadline, chat_request.body)
+    
+    # 主Key响应过慢时对冲到下一个Key，两个都失败后继续故障转移
+    api_keys = chat_request.api_keys
+    if hedger.applies(api_keys, chat_request.stream):
+        api_key, result, hedged = hedger.run(upstream, api_keys[0], api_keys[1], chat_request.hedge_lost)
+        if result['success']:
+            return chat_response(chat_request, api_key, result, is_hedge=hedged)
+        stop = chat_request.attempt_failed(api_key, result)
+        api_keys = [] if stop else api_keys[2:] if hedged else api_keys[1:]
+    
+    # 按路由策略排好的顺序依次尝试，失败后转移到下一个可用Key，超过截止时间后不再尝试
+    for api_key in api_keys:
+        result = upstream(api_key, chat_request.stream, api_key is api_keys[-1])
+        if result['success']:
+            return chat_response(chat_request, api_key, result)
+        if chat_request.attempt_failed(api_key, result):
+            break
+    
+    return json_reply(*chat_request.failed(api_key, result))
+
+def json_reply(status, payload, headers):
+    response = jsonify(payload)
+    response.status_code = status
+    response.headers.update(headers)
+    return response
+
+@api_bp.route('/chat/batch', methods=['POST'])
+def chat_batch():
+    # 一次提交多个非流式对话请求，并发转发后按顺序返回，或以 NDJSON 按完成顺序逐行返回
+    user_id, error = authenticate()
+    if error:
+        return error
+    
+    data = request.get_json(silent=True)
+    items = data.get('requests') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items or not all(isinstance(item, dict) for item in items):
+        return jsonify({'error': 'requests 必须是非空的请求数组'}), 400
+    if len(items) > batch_runner.max_items:
+        return jsonify({'error': f'单次最多提交 {batch_runner.max_items} 个请求'}), 400
+    ndjson = bool(data.get('stream')) or 'application/x-ndjson' in request.headers.get('Accept', '')
+    
+    app = current_app._get_current_object()
+    
+    def run_item(item):
+        with app.app_context():
+            return call_with_failover(user_id, item, batch_runner.key_slot)
+    
+    def generate():
+        # 所有请求完成后一次性写入用量记录；客户端中途断开时仍等待已发出的请求完成并记录
+        events, reservations = [], []
+        results = batch_runner.run(run_item, items)
+        try:
+            for index, (api_key, result) in results:
+                if result['success']:
+                    events.append(usage_event(user_id, api_key, result))
+                    reservations.append((api_key, result.get('reservation')))
+                else:
+                    batch_runner.counters['failed_items'] += 1
+                yield index, batch_item_response(index, items[index], result)
+        finally:
+            for index, (api_key, result) in results:
+                if result['success']:
+                    events.append(usage_event(user_id, api_key, result))
+                    reservations.append((api_key, result.get('reservation')))
+            if events:
+                usage_writer.write_batch(events)
+            for (api_key, reservation), event in zip(reservations, events):
+                quota_store.settle(reservation, event['total_tokens'])
+                consume_rate_tokens(user_id, api_key, event['total_tokens'])
+                metrics.record(event)
+    
+    if ndjson:
+        return Response(
+            stream_with_context(json.dumps(line, ensure_ascii=False) + '\n' for _, line in generate()),
+            mimetype='application/x-ndjson'
+        )
+    responses = [None] * len(items)
+    for index, line in generate():
+        responses[index] = line
+    return jsonify({'object': 'list', 'data': responses})
+
+def call_with_failover(user_id, item, key_slot):
+    # 批量请求和异步任务使用：与 /chat 相同的故障转移顺序，key_slot 限制每个上游Key的并发数
+    messages = item.get('messages', [])
+    model = item.get('model')
+    max_tokens = item.get('max_tokens')
+    timer = Timer()
+    deadline = retry_policy.deadline_for()
+    state = limit_user(user_id, token_estimator.estimate(messages, max_tokens, model=model))
+    if state is not None and not state.allowed:
+        return None, record_failure(user_id, None, rate_limited_result(state), timer)
+    with timer.phase('select'):
+        api_keys = select_api_keys(user_id, model, messages, max_tokens)
+    api_key, result = None, None
+    if not api_keys:
+        api_key, result = fallback_key(auth_cache.get_keys(user_id)), no_key_result(user_id, model, messages, max_tokens)
+    for api_key in api_keys:
+        with key_slot(api_key.id):
+            result = call_api(user_id, api_key, messages, model, item.get('temperature', 0.7), max_tokens,
+                              rate_wait=api_key is api_keys[-1], deadline=deadline)
+        if result['success']:
+            return api_key, timer.attach(result)
+        failed_attempt(user_id, api_key, result, timer)
+        if result.get('quota_exceeded') == SCOPE_USER or retry_policy.expired(deadline):
+            break
+    request_failed(user_id, api_key, result, timer)
+    return None, result
+
+def failure_status(result):
+    if result.get('quota_exceeded') == SCOPE_USER or 'rate_limited' in result:
+        return 429
+    return 400 if result.get('status_code') == 400 else 500
+
+def batch_item_response(index, item, result):
+    line = {'index': index}
+    if 'custom_id' in item:
+        line['custom_id'] = item['custom_id']
     if result['success']:
-        record_usage(user.id, api_key, result)
-        return jsonify(result['response'])
+        line.update({'status': 200, 'response': result['response']})
     else:
-        if api_key.is_free:
-            next_key = get_next_free_api_key(user.id, api_key.id)
-            if next_key:
-                result = call_api(next_key, messages, model, temperature, max_tokens)
-                if result['success']:
-                    record_usage(user.id, next_key, result)
-                    return jsonify(result['response'])
-        
+        line.update({'status': failure_status(result), 'error': result['message']})
+    return line
+
+@api_bp.route('/jobs', methods=['POST'])
+def submit_job():
+    # 异步任务：立即返回任务ID，由后台工作线程转发上游，客户端轮询或长轮询获取结果
+    user_id, error = authenticate()
+    if error:
+        return error
+    if not job_queue.enabled:
+        return jsonify({'error': '异步任务未启用'}), 404
+    
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('messages'), list):
+        return jsonify({'error': 'messages 必须是消息数组'}), 400
+    if data.get('stream'):
+        return jsonify({'error': '异步任务不支持流式输出'}), 400
+    
+    job = job_queue.submit(user_id, data)
+    response = jsonify(job_view(job))
+    response.status_code = 202
+    response.headers['Location'] = url_for('api.get_job', job_id=job['id'])
+    return response
+
+@api_bp.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    user_id, error = authenticate()
+    if error:
+        return error
+    
+    wait = request.args.get('wait', type=float, default=0)
+    job = job_queue.wait(job_id, user_id, wait) if wait > 0 else job_queue.get(job_id, user_id)
+    if job is None:
+        return jsonify({'error': '任务不存在或已过期'}), 404
+    return jsonify(job_view(job))
+
+@api_bp.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    user_id, error = authenticate()
+    if error:
+        return error
+    
+    job = job_queue.cancel(job_id, user_id)
+    if job is None:
+        return jsonify({'error': '任务不存在或已过期'}), 404
+    return jsonify(job_view(job))
+
+def job_view(job):
+    view = {
+        'id': job['id'],
+        'object': 'chat.job',
+        'status': job['status'],
+        'created_at': int(job['created_at']),
+        'started_at': int(job['started_at']) if job['started_at'] else None,
+        'finished_at': int(job['finished_at']) if job['finished_at'] else None
+    }
+    if job['result'] is not None:
+        view['response'] = json.loads(job['result'])
+    if job['error'] is not None:
+        view['error'] = {'message': job['error'], 'status': job['status_code']}
+    return view
+
+def execute_job(user_id, data):
+    api_key, result = call_with_failover(user_id, data, job_queue.key_slot)
+    if not result['success']:
+        raise JobFailed(result['message'], failure_status(result))
+    record_usage(user_id, api_key, result)
+    return result['response']
+
+@api_bp.route('/embeddings', methods=['POST'])
+def embeddings():
+    # OpenAI 兼容的 embeddings 接口，并发的小请求会合并为一次上游调用
+    timer = Timer()
+    with timer.phase('auth'):
+        user_id, error = authenticate()
+    if error:
+        return error
+    
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Bad Request: JSON body must be an object'}), 400
+    inputs = data.get('input')
+    single = isinstance(inputs, str)
+    if single:
+        inputs = [inputs]
+    if not isinstance(inputs, list) or not inputs or not all(isinstance(text, str) for text in inputs):
+        return jsonify({'error': 'input 必须是字符串或字符串数组'}), 400
+    model = data.get('model')
+    estimate = token_estimator.estimate_texts(inputs, model=model)
+    deadline = retry_policy.deadline_for(request.headers)
+    
+    state = g.rate_limit = limit_user(user_id, estimate)
+    if state is not None and not state.allowed:
+        return rate_limited_response(record_failure(user_id, None, rate_limited_result(state), timer))
+    
+    with timer.phase('select'):
+        api_keys = [key for key in select_api_keys(user_id, model) if adapter_for(key).supports_embeddings]
+    if not api_keys:
+        candidates = [key for key in auth_cache.get_keys(user_id) if adapter_for(key).supports_embeddings]
+        record_failure(user_id, fallback_key(candidates), no_key_result(), timer)
+        return jsonify({'error': '没有支持 embeddings 的API Key'}), 400
+    
+    for api_key in api_keys:
+        result = call_embeddings(user_id, api_key, inputs, model or api_key.model, estimate, deadline)
+        if result['success']:
+            break
+        failed_attempt(user_id, api_key, result, timer)
+        if result.get('quota_exceeded') == SCOPE_USER or retry_policy.expired(deadline):
+            break
+    
+    if not result['success']:
+        request_failed(user_id, api_key, result, timer)
+    if result.get('quota_exceeded') == SCOPE_USER:
+        return jsonify({'error': result['message']}), 429
+    if 'rate_limited' in result:
+        return rate_limited_response(result)
+    if not result['success']:
         return jsonify({'error': result['message']}), 500
+    record_usage(user_id, api_key, timer.attach(result))
+    return jsonify({
+        'object': 'list',
+        'data': [{'object': 'embedding', 'index': index, 'embedding': vector} for index, vector in enumerate(result['data'])],
+        'model': model or api_key.model,
+        'usage': {'prompt_tokens': result['usage'].get('prompt_tokens', 0), 'total_tokens': result['usage'].get('total_tokens', 0)}
+    })
+
+def call_embeddings(user_id, api_key, inputs, model, estimate, deadline):
+    rejected = limit_key(api_key, estimate)
+    if rejected:
+        return upstream_failed(api_key, rejected)
+    reservation, rejected = reserve_tokens(user_id, api_key, estimate)
+    if rejected:
+        return upstream_failed(api_key, rejected)
+    # 合并后的整批按发起合并的请求的截止时间重试
+    result = embedding_coalescer.submit((api_key.id, model), inputs, lambda batch: retry_policy.run(
+        lambda timeout: call_embeddings_upstream(api_key, batch, model, timeout),
+        deadline, provider=api_key.provider, key_id=str(api_key.id)
+    ))
+    if result['success']:
+        result['reservation'] = reservation
+    else:
+        quota_store.release(reservation)
+    return result
+
+def call_embeddings_upstream(api_key, inputs, model, timeout):
+    # 合并后的整批只计一次熔断和路由统计
+    if not circuit_breakers.acquire(api_key):
+        return upstream_failed(api_key, {'success': False, 'message': f'{api_key.name} 已熔断，暂时跳过', 'circuit_open': True})
+    started = router.begin(api_key.id)
+    sent = time.perf_counter()
+    metrics.inc('gateway_upstream_in_flight', provider=api_key.provider, key_id=str(api_key.id))
+    result, ttfb = None, 0
+    try:
+        adapter = adapter_for(api_key)
+        url, headers, payload = adapter.embeddings_request(inputs, model)
+        response = upstream_pool.post(url, headers=headers, data=passthrough.dumps(payload), timeout=timeout)
+        ttfb = response.elapsed.total_seconds()
+        if response.status_code != 200:
+            result = upstream_error(response)
+        else:
+            result = adapter.parse_embeddings(passthrough.loads(response.content))
+    except Exception as e:
+        result = {'success': False, 'message': str(e), 'retryable': transient(e)}
+    finally:
+        result = result or {'success': False, 'message': 'API Error'}
+        metrics.inc('gateway_upstream_in_flight', -1, provider=api_key.provider, key_id=str(api_key.id))
+        observe_upstream(api_key, result, upstream_pool.connect_time(), ttfb, time.perf_counter() - sent)
+        router.end(api_key.id, started, router.outcome(result))
+        circuit_breakers.record(api_key, result)
+    return result
+
+def chat_response(chat_request, api_key, result, is_hedge=False):
+    if 'stream' not in result:
+        headers = chat_request.completed(api_key, result, is_hedge)
+        if 'body' in result:
+            # 透传的响应体原样返回
+            response = Response(result['body'], mimetype='application/json')
+        else:
+            response = jsonify(result['response'])
+        response.headers.update(headers)
+        return response
+    
+    streamed = chat_request.stream_started(result)
+    
+    def generate():
+        # 客户端断开时生成器被关闭 (GeneratorExit)，状态保持 cancelled
+        status = 'cancelled'
+        try:
+            yield from result['stream']
+            status = 'success'
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            chat_request.stream_finished(api_key, result, streamed, status)
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers=dict(chat_request.rate_headers, **{'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    )
 
 def select_api_key(user_id, model=None):
-    api_keys = APIKey.query.filter_by(user_id=user_id, is_active=True).order_by(APIKey.priority.desc()).all()
-    
-    now = datetime.utcnow()
-    today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-    
-    for key in api_keys:
-        if key.is_free:
-            return key
-        
-        if key.max_tokens_per_day:
-            if key.used_tokens_today < key.max_tokens_per_day:
-                return key
-            else:
-                continue
-        
-        return key
-    
-    return None
+    api_keys = select_api_keys(user_id, model)
+    return api_keys[0] if api_keys else None
 
-def get_next_free_api_key(user_id, current_key_id):
-    return APIKey.query.filter(
-        APIKey.user_id == user_id,
-        APIKey.is_active == True,
-        APIKey.is_free == True,
-        APIKey.id != current_key_id
-    ).first()
+def call_api(user_id, api_key, messages, model=None, temperature=0.7, max_tokens=None, stream=False, rate_wait=False,
+             deadline=None, body=None):
+    # 瞬时故障先在同一个Key上按退避策略重试，每次重试都重新检查速率限制、配额和熔断；
+    # body 为客户端的原始请求体 (ClientBody)，OpenAI 兼容的提供商直接透传
+    if deadline is None:
+        deadline = retry_policy.deadline_for()
+    return retry_policy.run(
+        lambda timeout: attempt_api(
+            user_id, api_key, messages, model, temperature, max_tokens, stream, rate_wait, timeout, body
+        ),
+        deadline, provider=api_key.provider, key_id=str(api_key.id)
+    )
 
-def call_api(api_key, messages, model=None, temperature=0.7, max_tokens=None):
-    start_time = time.time()
+def attempt_api(user_id, api_key, messages, model, temperature, max_tokens, stream, rate_wait, timeout, body=None):
     model = model or api_key.model
+    # 被速率限制的Key不计入熔断和路由统计，直接转移到下一个Key
+    estimate = token_estimator.estimate(messages, max_tokens, api_key.provider, model)
+    refused = limit_key(api_key, estimate, rate_wait)
+    if refused:
+        return upstream_failed(api_key, refused)
+    reservation, refused = admit_key(user_id, api_key, estimate)
+    if refused:
+        return refused
+    started = router.begin(api_key.id)
+    sent = time.perf_counter()
+    metrics.inc('gateway_upstream_in_flight', provider=api_key.provider, key_id=str(api_key.id))
+    result, ttfb = None, 0
     
     try:
-        if api_key.provider == 'openai':
-            headers = {
-                'Authorization': f'Bearer {api_key.api_key}',
-                'Content-Type': 'application/json'
-            }
-            base_url = api_key.base_url or 'https://api.openai.com/v1'
-            payload = {
-                'model': model,
-                'messages': messages,
-                'temperature': temperature
-            }
-            if max_tokens:
-                payload['max_tokens'] = max_tokens
-            
-            response = requests.post(
-                f'{base_url}/chat/completions',
-                headers=headers,
-                json=payload,
-                timeout=120
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                return {
-                    'success': True,
-                    'response': result,
-                    'usage': result.get('usage', {})
-                }
-            else:
-                return {'success': False, 'message': f'API Error: {response.text}'}
-        
-        elif api_key.provider == 'anthropic':
-            headers = {
-                'x-api-key': api_key.api_key,
-                'anthropic-version': '2023-06-01',
-                'Content-Type': 'application/json'
-            }
-            base_url = api_key.base_url or 'https://api.anthropic.com/v1'
-            
-            anthropic_messages = []
-            for msg in messages:
-                anthropic_messages.append({
-                    'role': msg['role'],
-                    'content': msg['content']
-                })
-            
-            payload = {
-                'model': model,
-                'messages': anthropic_messages,
-                'max_tokens': max_tokens or 1024,
-                'temperature': temperature
-            }
-            
-            response = requests.post(
-                f'{base_url}/messages',
-                headers=headers,
-                json=payload,
-                timeout=120
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                return {
-                    'success': True,
-                    'response': {
-                        'choices': [{
-                            'message': {
-                                'role': 'assistant',
-                                'content': result['content'][0]['text']
-                            }
-                        }],
-                        'usage': {
-                            'prompt_tokens': result['usage']['input_tokens'],
-                            'completion_tokens': result['usage']['output_tokens'],
-                            'total_tokens': result['usage']['input_tokens'] + result['usage']['output_tokens']
-                        }
-                    },
-                    'usage': {
-                        'prompt_tokens': result['usage']['input_tokens'],
-                        'completion_tokens': result['usage']['output_tokens'],
-                        'total_tokens': result['usage']['input_tokens'] + result['usage']['output_tokens']
-                    }
-                }
-            else:
-                return {'success': False, 'message': f'API Error: {response.text}'}
-        
-        elif api_key.provider in ['moonshot', 'deepseek']:
-            headers = {
-                'Authorization': f'Bearer {api_key.api_key}',
-                'Content-Type': 'application/json'
-            }
-            base_url = api_key.base_url
-            payload = {
-                'model': model,
-                'messages': messages,
-                'temperature': temperature
-            }
-            if max_tokens:
-                payload['max_tokens'] = max_tokens
-            
-            response = requests.post(
-                f'{base_url}/chat/completions',
-                headers=headers,
-                json=payload,
-                timeout=120
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                return {
-                    'success': True,
-                    'response': result,
-                    'usage': result.get('usage', {})
-                }
-            else:
-                return {'success': False, 'message': f'API Error: {response.text}'}
-        
-        elif api_key.provider == 'zhipu':
-            headers = {
-                'Authorization': f'Bearer {api_key.api_key}',
-                'Content-Type': 'application/json'
-            }
-            base_url = api_key.base_url
-            payload = {
-                'model': model,
-                'messages': messages,
-                'temperature': temperature
-            }
-            if max_tokens:
-                payload['max_tokens'] = max_tokens
-            
-            response = requests.post(
-                f'{base_url}/chat/completions',
-                headers=headers,
-                json=payload,
-                timeout=120
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                return {
-                    'success': True,
-                    'response': result,
-                    'usage': result.get('usage', {})
-                }
-            else:
-                return {'success': False, 'message': f'API Error: {response.text}'}
-        
-        elif api_key.provider == 'qwen':
-            headers = {
-                'Authorization': f'Bearer {api_key.api_key}',
-                'Content-Type': 'application/json'
-            }
-            base_url = api_key.base_url
-            payload = {
-                'model': model,
-                'input': {'messages': messages},
-                'parameters': {'temperature': temperature}
-            }
-            if max_tokens:
-                payload['parameters']['max_tokens'] = max_tokens
-            
-            response = requests.post(
-                f'{base_url}/services/aigc/text-generation/generation',
-                headers=headers,
-                json=payload,
-                timeout=120
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                return {
-                    'success': True,
-                    'response': {
-                        'choices': [{
-                            'message': {
-                                'role': 'assistant',
-                                'content': result['output']['text']
-                            }
-                        }],
-                        'usage': result.get('usage', {})
-                    },
-                    'usage': result.get('usage', {})
-                }
-            else:
-                return {'success': False, 'message': f'API Error: {response.text}'}
-        
-        elif api_key.provider == 'minimax':
-            headers = {
-                'Authorization': f'Bearer {api_key.api_key}',
-                'Content-Type': 'application/json'
-            }
-            base_url = api_key.base_url
-            payload = {
-                'model': model,
-                'messages': messages,
-                'temperature': temperature
-            }
-            if max_tokens:
-                payload['tokens_to_generate'] = max_tokens
-            
-            response = requests.post(
-                f'{base_url}/text/chatcompletion_v2',
-                headers=headers,
-                json=payload,
-                timeout=120
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                return {
-                    'success': True,
-                    'response': result,
-                    'usage': result.get('usage', {})
-                }
-            else:
-                return {'success': False, 'message': f'API Error: {response.text}'}
-        
-        elif api_key.provider == 'azure':
-            headers = {
-                'api-key': api_key.api_key,
-                'Content-Type': 'application/json'
-            }
-            base_url = api_key.base_url
-            deployment = model or 'gpt-35-turbo'
-            payload = {
-                'messages': messages,
-                'temperature': temperature
-            }
-            if max_tokens:
-                payload['max_tokens'] = max_tokens
-            
-            response = requests.post(
-                f'{base_url}/openai/deployments/{deployment}/chat/completions?api-version=2024-02-15-preview',
-                headers=headers,
-                json=payload,
-                timeout=120
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                return {
-                    'success': True,
-                    'response': result,
-                    'usage': result.get('usage', {})
-                }
-            else:
-                return {'success': False, 'message': f'API Error: {response.text}'}
+        adapter = adapter_for(api_key)
+        url, headers, data, raw = passthrough.request(adapter, body, messages, model, temperature, max_tokens, stream)
+        response = upstream_pool.post(url, headers=headers, data=data, timeout=timeout, stream=stream)
+        # requests 的 elapsed 为发出请求到解析完响应头的时间
+        ttfb = response.elapsed.total_seconds()
         
+        if response.status_code != 200:
+            result = upstream_error(response)
+        elif stream:
+            result = passthrough.open_stream(response, model) if raw else open_stream(response, adapter.relay(model))
+        elif raw:
+            result = passthrough.parse_response(adapter, response.content)
         else:
-            return {'success': False, 'message': f'未支持的提供商: {api_key.provider}'}
+            result = adapter.parse_response(passthrough.loads(response.content))
     
     except Exception as e:
-        return {'success': False, 'message': str(e)}
-
-def record_usage(user_id, api_key, result):
-    request_time = time.time()
-    usage = result.get('usage', {})
-    
-    record = UsageRecord(
-        user_id=user_id,
-        api_key_id=api_key.id,
-        provider=api_key.provider,
-        model=api_key.model,
-        prompt_tokens=usage.get('prompt_tokens', 0),
-        completion_tokens=usage.get('completion_tokens', 0),
-        total_tokens=usage.get('total_tokens', 0),
-        status='success'
-    )
+        result = {'success': False, 'message': str(e), 'retryable': transient(e)}
     
-    api_key.used_tokens_today += record.total_tokens
-    api_key.last_used_at = datetime.utcnow()
+    finally:
+        result = result or {'success': False, 'message': 'API Error'}
+        metrics.inc('gateway_upstream_in_flight', -1, provider=api_key.provider, key_id=str(api_key.id))
+        finish_attempt(api_key, result, reservation, started, upstream_pool.connect_time(), ttfb, time.perf_counter() - sent)
     
-    db.session.add(record)
+    return result
+
+@api_bp.route('/pool-stats')
+@login_required
+def pool_stats():
+    return jsonify(upstream_pool.stats())
+
+@api_bp.route('/auth-cache-stats')
+@login_required
+def auth_cache_stats():
+    return jsonify(auth_cache.stats())
+
+@api_bp.route('/usage-writer-stats')
+@login_required
+def usage_writer_stats():
+    return jsonify(usage_writer.stats())
+
+@api_bp.route('/response-cache-stats')
+@login_required
+def response_cache_stats():
+    return jsonify(response_cache.stats())
+
+@api_bp.route('/semantic-cache-stats')
+@login_required
+def semantic_cache_stats():
+    return jsonify(semantic_cache.stats())
+
+@api_bp.route('/routing-stats')
+@login_required
+def routing_stats():
+    return jsonify(router.stats())
+
+@api_bp.route('/circuit-breaker-stats')
+@login_required
+def circuit_breaker_stats():
+    return jsonify(circuit_breakers.stats())
+
+@api_bp.route('/hedge-stats')
+@login_required
+def hedge_stats():
+    return jsonify(hedger.stats())
+
+@api_bp.route('/batch-stats')
+@login_required
+def batch_stats():
+    return jsonify({'batch': batch_runner.stats(), 'embeddings': embedding_coalescer.stats()})
+
+@api_bp.route('/job-stats')
+@login_required
+def job_stats():
+    return jsonify(job_queue.stats())
+
+@api_bp.route('/quota-stats')
+@login_required
+def quota_stats():
+    return jsonify(quota_store.stats())
+
+@api_bp.route('/rate-limit-stats')
+@login_required
+def rate_limit_stats():
+    return jsonify(rate_limiter.stats())
+
+@api_bp.route('/retry-stats')
+@login_required
+def retry_stats():
+    return jsonify(retry_policy.stats())
+
+@api_bp.route('/passthrough-stats')
+@login_required
+def passthrough_stats():
+    return jsonify(passthrough.stats())
+
+@api_bp.route('/token-stats')
+@login_required
+def token_stats():
+    return jsonify(token_estimator.stats())
+
+@api_bp.route('/user-quota', methods=['POST'])
+@login_required
+def set_user_quota():
+    current_user.max_tokens_per_day = request.form.get('max_tokens_per_day', type=int) or None
+    current_user.rpm_limit = request.form.get('rpm_limit', type=int) or None
+    current_user.tpm_limit = request.form.get('tpm_limit', type=int) or None
     db.session.commit()
+    auth_cache.invalidate_user(current_user.id)
+    flash('Token上限和速率限制已更新', 'success')
+    return redirect(url_for('api.dashboard'))
+
+@api_bp.route('/retention-stats')
+@login_required
+def retention_stats():
+    return jsonify(retention.stats())
 
 @api_bp.route('/reset-usage/<int:key_id>', methods=['POST'])
 @login_required
@@ -591,5 +774,7 @@ def reset_usage(key_id):
     api_key = APIKey.query.filter_by(id=key_id, user_id=current_user.id).first_or_404()
     api_key.used_tokens_today = 0
     db.session.commit()
+    quota_store.reset_key(api_key.id)
+    auth_cache.invalidate_keys(current_user.id)
     flash(f'{api_key.name} 今日用量已重置', 'success')
     return redirect(url_for('api.api_keys'))
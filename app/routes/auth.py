@@ -2,6 +2,7 @@ from flask import Blueprint, render_template, redirect, url_for, flash, request
 from flask_login import login_user, logout_user, login_required, current_user
 from flask_bcrypt import Bcrypt
 from app.models import db, User
+from app.services.auth_cache import auth_cache
 from datetime import datetime
 import secrets
 import string
@@ -98,5 +99,6 @@ def reset_api_key():
     new_api_key = generate_api_key()
     current_user.api_key = new_api_key
     db.session.commit()
+    auth_cache.invalidate_user(current_user.id)
     flash(f'API Key已重置为: {new_api_key}', 'success')
     return redirect(url_for('api.dashboard'))
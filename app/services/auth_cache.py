@@ -0,0 +1,166 @@
+import os
+import threading
+import time
+
+from app.models import User, APIKey
+
+
+class KeySnapshot:
+    # 与数据库会话无关的 APIKey 只读快照，可在请求和线程之间安全复用
+    __slots__ = (
+        'id', 'user_id', 'name', 'provider', 'api_key', 'api_secret', 'base_url', 'model',
+        'is_active', 'is_free', 'priority', 'max_tokens_per_day', 'used_tokens_today', 'last_used_at',
+        'rpm_limit', 'tpm_limit'
+    )
+
+    def __init__(self, key):
+        for name in self.__slots__:
+            setattr(self, name, getattr(key, name))
+
+
+class AuthCache:
+    # 网关Key -> 用户ID，用户ID -> 按优先级排序的可用上游Key
+    def __init__(self, app=None):
+        self.ttl = 60
+        self.max_entries = 10000
+        self.stamp_file = None
+        self._stamp = None
+        self._users = {}
+        self._tokens_by_user = {}
+        self._limits = {}
+        self._rate_limits = {}
+        self._keys = {}
+        self._lock = threading.Lock()
+        self.counters = {'user_hits': 0, 'user_misses': 0, 'key_hits': 0, 'key_misses': 0, 'invalidations': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config.get('AUTH_CACHE_TTL', self.ttl)
+        self.max_entries = app.config.get('AUTH_CACHE_MAX_ENTRIES', self.max_entries)
+        if app.config.get('AUTH_CACHE_SHARED', True):
+            # 多个 gunicorn worker 通过同一个文件的 mtime 广播失效
+            os.makedirs(app.instance_path, exist_ok=True)
+            self.stamp_file = os.path.join(app.instance_path, 'auth_cache.stamp')
+            if not os.path.exists(self.stamp_file):
+                open(self.stamp_file, 'a').close()
+            self._stamp = os.stat(self.stamp_file).st_mtime_ns
+        app.extensions['auth_cache'] = self
+
+    def _check_stamp(self):
+        if self.stamp_file is None:
+            return
+        try:
+            stamp = os.stat(self.stamp_file).st_mtime_ns
+        except OSError:
+            return
+        if stamp != self._stamp:
+            self._stamp = stamp
+            self.clear()
+
+    def _touch_stamp(self):
+        if self.stamp_file is None:
+            return
+        try:
+            os.utime(self.stamp_file, ns=(time.time_ns(), time.time_ns()))
+            self._stamp = os.stat(self.stamp_file).st_mtime_ns
+        except OSError:
+            pass
+
+    def _evict_if_full(self, cache):
+        if len(cache) >= self.max_entries:
+            now = time.monotonic()
+            for key, (expires, _) in list(cache.items()):
+                if expires <= now:
+                    cache.pop(key, None)
+            if len(cache) >= self.max_entries:
+                cache.pop(next(iter(cache)), None)
+
+    def get_user_id(self, token):
+        self._check_stamp()
+        entry = self._users.get(token)
+        if entry is not None and entry[0] > time.monotonic():
+            self.counters['user_hits'] += 1
+            return entry[1]
+
+        self.counters['user_misses'] += 1
+        user = User.query.filter_by(api_key=token).first()
+        if not user:
+            return None
+        with self._lock:
+            self._evict_if_full(self._users)
+            self._users[token] = (time.monotonic() + self.ttl, user.id)
+            self._tokens_by_user[user.id] = token
+            self._limits[user.id] = user.max_tokens_per_day or 0
+            self._rate_limits[user.id] = (user.rpm_limit or 0, user.tpm_limit or 0)
+        return user.id
+
+    def get_user_limit(self, user_id):
+        # 随 get_user_id 一起缓存，正常情况下不会访问数据库
+        limit = self._limits.get(user_id)
+        if limit is None:
+            user = User.query.get(user_id)
+            limit = self._limits[user_id] = (user.max_tokens_per_day or 0) if user else 0
+        return limit
+
+    def get_user_rate_limits(self, user_id):
+        # (每分钟请求数, 每分钟Token数)，0 表示不限制
+        limits = self._rate_limits.get(user_id)
+        if limits is None:
+            user = User.query.get(user_id)
+            limits = self._rate_limits[user_id] = (user.rpm_limit or 0, user.tpm_limit or 0) if user else (0, 0)
+        return limits
+
+    def get_keys(self, user_id):
+        self._check_stamp()
+        entry = self._keys.get(user_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self.counters['key_hits'] += 1
+            return entry[1]
+
+        self.counters['key_misses'] += 1
+        keys = [KeySnapshot(key) for key in APIKey.query.filter_by(
+            user_id=user_id, is_active=True
+        ).order_by(APIKey.priority.desc()).all()]
+        with self._lock:
+            self._evict_if_full(self._keys)
+            self._keys[user_id] = (time.monotonic() + self.ttl, keys)
+        return keys
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            token = self._tokens_by_user.pop(user_id, None)
+            if token is not None:
+                self._users.pop(token, None)
+            self._limits.pop(user_id, None)
+            self._rate_limits.pop(user_id, None)
+            self._keys.pop(user_id, None)
+            self.counters['invalidations'] += 1
+        self._touch_stamp()
+
+    def invalidate_keys(self, user_id):
+        with self._lock:
+            self._keys.pop(user_id, None)
+            self.counters['invalidations'] += 1
+        self._touch_stamp()
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+            self._tokens_by_user.clear()
+            self._limits.clear()
+            self._rate_limits.clear()
+            self._keys.clear()
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats.update({
+            'pid': os.getpid(),
+            'ttl': self.ttl,
+            'cached_users': len(self._users),
+            'cached_key_lists': len(self._keys)
+        })
+        return stats
+
+
+auth_cache = AuthCache()
@@ -0,0 +1,157 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+class BatchRunner:
+    # 批量请求中的各项在共享线程池中并发执行，同一个上游Key同时进行的请求数受限
+    def __init__(self, app=None):
+        self.max_items = 1000
+        self.max_workers = 16
+        self.per_key_concurrency = 4
+        self._executor = None
+        self._pid = None
+        self._slots = {}
+        self._lock = threading.Lock()
+        self.counters = {'batches': 0, 'items': 0, 'failed_items': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_items = app.config.get('BATCH_MAX_ITEMS', self.max_items)
+        self.max_workers = app.config.get('BATCH_THREADS', self.max_workers)
+        self.per_key_concurrency = app.config.get('BATCH_PER_KEY_CONCURRENCY', self.per_key_concurrency)
+        app.extensions['batch_runner'] = self
+
+    def _get_executor(self):
+        # fork 之后线程池不可用，按进程号懒创建
+        if self._executor is None or self._pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='batch')
+                    self._slots = {}
+        return self._executor
+
+    def key_slot(self, key_id):
+        slot = self._slots.get(key_id)
+        if slot is None:
+            with self._lock:
+                slot = self._slots.setdefault(key_id, threading.BoundedSemaphore(self.per_key_concurrency))
+        return slot
+
+    def run(self, func, items):
+        # 按完成顺序产出 (序号, 结果)
+        executor = self._get_executor()
+        self.counters['batches'] += 1
+        self.counters['items'] += len(items)
+        futures = {executor.submit(func, item): index for index, item in enumerate(items)}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats.update({
+            'pid': os.getpid(),
+            'max_items': self.max_items,
+            'threads': self.max_workers,
+            'per_key_concurrency': self.per_key_concurrency
+        })
+        return stats
+
+
+class _PendingEmbeddings:
+    __slots__ = ('inputs', 'chars', 'closed', 'full', 'done', 'result')
+
+    def __init__(self):
+        self.inputs = []
+        self.chars = []
+        self.closed = False
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.result = None
+
+
+class EmbeddingCoalescer:
+    # 同一Key、同一模型的并发小请求在很短的窗口内合并为一次上游调用，结果按各自的输入拆分返回
+    def __init__(self, app=None):
+        self.enabled = True
+        self.window = 0.01
+        self.max_inputs = 256
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.counters = {'requests': 0, 'inputs': 0, 'upstream_calls': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('EMBEDDING_COALESCE_ENABLED', self.enabled)
+        self.window = app.config.get('EMBEDDING_COALESCE_WINDOW', self.window)
+        self.max_inputs = app.config.get('EMBEDDING_COALESCE_MAX_INPUTS', self.max_inputs)
+        app.extensions['embedding_coalescer'] = self
+
+    def submit(self, group, inputs, call):
+        # 第一个到达的请求负责等待窗口结束并发出合并后的请求，其余请求等待它的结果
+        self.counters['requests'] += 1
+        self.counters['inputs'] += len(inputs)
+        if not self.enabled:
+            self.counters['upstream_calls'] += 1
+            return call(inputs)
+
+        with self._lock:
+            pending = self._pending.get(group)
+            leader = pending is None or pending.closed or len(pending.inputs) + len(inputs) > self.max_inputs
+            if leader:
+                pending = self._pending[group] = _PendingEmbeddings()
+            offset = len(pending.inputs)
+            pending.inputs.extend(inputs)
+            pending.chars.extend(len(text) for text in inputs)
+            if len(pending.inputs) >= self.max_inputs:
+                pending.full.set()
+
+        if leader:
+            pending.full.wait(self.window)
+            with self._lock:
+                pending.closed = True
+                if self._pending.get(group) is pending:
+                    del self._pending[group]
+            self.counters['upstream_calls'] += 1
+            try:
+                pending.result = call(pending.inputs)
+            except Exception as e:
+                pending.result = {'success': False, 'message': str(e)}
+            finally:
+                pending.done.set()
+        else:
+            pending.done.wait()
+        return self.split(pending, offset, len(inputs))
+
+    @staticmethod
+    def split(pending, offset, count):
+        result = pending.result
+        if not result['success'] or (offset == 0 and count == len(pending.inputs)):
+            return result
+        # 上游只返回整批的Token数，按字符数比例分摊到各个请求
+        total_chars = sum(pending.chars) or 1
+        share = sum(pending.chars[offset:offset + count]) / total_chars
+        prompt_tokens = round(result['usage'].get('prompt_tokens', 0) * share)
+        return {
+            'success': True,
+            'data': result['data'][offset:offset + count],
+            'usage': {'prompt_tokens': prompt_tokens, 'total_tokens': prompt_tokens}
+        }
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats.update({
+            'pid': os.getpid(),
+            'enabled': self.enabled,
+            'window': self.window,
+            'max_inputs': self.max_inputs,
+            'pending_groups': len(self._pending)
+        })
+        return stats
+
+
+batch_runner = BatchRunner()
+embedding_coalescer = EmbeddingCoalescer()
@@ -0,0 +1,388 @@
+import math
+import time
+from datetime import datetime
+
+from app.services.auth_cache import auth_cache
+from app.services.circuit_breaker import circuit_breakers
+from app.services.metrics import metrics, Timer
+from app.services.passthrough import passthrough, ClientBody
+from app.services.quota import quota_store, QuotaExceeded, SCOPE_USER, SCOPE_KEY
+from app.services.rate_limit import rate_limiter
+from app.services.response_cache import response_cache, cache_key, request_fields
+from app.services.retry import retry_policy, parse_retry_after
+from app.services.routing import router
+from app.services.semantic_cache import semantic_cache
+from app.services.tokens import token_estimator
+from app.services.usage_writer import usage_writer
+
+
+def bearer_token(headers):
+    auth_header = headers.get('Authorization')
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return None
+    return auth_header.split(' ')[1]
+
+
+class ChatRequest:
+    # 一次 /v1/chat 请求的参数和处理状态。Flask 路由和 ASGI 网关共用这里的各个步骤，只各自负责上游调用和收发；
+    # 步骤都是同步函数，ASGI 网关把它们放到数据库线程池中执行。返回的响应为 (状态码, JSON 内容, 响应头)
+    def __init__(self, token, data, raw, headers):
+        self.timer = Timer()
+        self.token = token
+        self.data = data
+        self.messages = data.get('messages', [])
+        self.model = data.get('model')
+        self.temperature = data.get('temperature', 0.7)
+        self.max_tokens = data.get('max_tokens')
+        self.stream = bool(data.get('stream'))
+        self.headers = headers
+        self.deadline = retry_policy.deadline_for(headers)
+        # 透传时直接转发原始请求体
+        self.body = ClientBody(raw, data)
+        self.user_id = None
+        self.user_limits = (0, 0)
+        self.api_keys = []
+        self.rate_headers = {}
+        self.key_hash = None
+        self.probe = None
+
+    @classmethod
+    def parse(cls, headers, raw):
+        # 返回 (ChatRequest, 错误响应)
+        token = bearer_token(headers)
+        if token is None:
+            return None, (401, {'error': 'Unauthorized: No API key provided'}, {})
+        try:
+            data = passthrough.loads(raw)
+        except ValueError:
+            return None, (400, {'error': 'Bad Request: invalid JSON body'}, {})
+        if not isinstance(data, dict):
+            return None, (400, {'error': 'Bad Request: JSON body must be an object'}, {})
+        return cls(token, data, raw, headers), None
+
+    def authenticate(self):
+        with self.timer.phase('auth'):
+            self.user_id = auth_cache.get_user_id(self.token)
+        if not self.user_id:
+            return 401, {'error': 'Unauthorized: Invalid API key'}, {}
+        self.user_limits = rate_limiter.user_limits(*auth_cache.get_user_rate_limits(self.user_id))
+        return None
+
+    def rate_limit(self):
+        # 用户级令牌桶的参数，由调用方同步或异步排队
+        estimate = token_estimator.estimate(self.messages, self.max_tokens, model=self.model)
+        return (SCOPE_USER, self.user_id) + tuple(self.user_limits) + (estimate,)
+
+    def admit(self, state):
+        # 用户级速率限制放行后选出候选Key；被拒绝时返回响应
+        self.rate_headers = state.headers() if state is not None else {}
+        if state is not None and not state.allowed:
+            result = record_failure(self.user_id, None, rate_limited_result(state), self.timer)
+            return 429, {'error': result['message']}, self.rate_headers
+        with self.timer.phase('select'):
+            self.api_keys = select_api_keys(self.user_id, self.model, self.messages, self.max_tokens)
+        if not self.api_keys:
+            result = no_key_result(self.user_id, self.model, self.messages, self.max_tokens)
+            record_failure(self.user_id, fallback_key(auth_cache.get_keys(self.user_id)), result, self.timer)
+            return 400, {'error': result['message']}, self.rate_headers
+        return None
+
+    def cached(self):
+        # temperature 为 0 的非流式请求先查响应缓存，未命中后查找语义相近的历史请求；命中时返回响应
+        api_key = self.api_keys[0]
+        model = self.model or api_key.model
+        cache_control = self.headers.get('Cache-Control')
+        cache_mode = response_cache.cache_mode(self.temperature, self.stream, cache_control)
+        if cache_mode:
+            self.key_hash = cache_key(api_key.provider, model, self.data)
+            if cache_mode == 'use':
+                cached = response_cache.get(self.key_hash)
+                if cached:
+                    record_usage(self.user_id, api_key, self.timer.attach(cached), cache_hit=True)
+                    return 200, cached['response'], dict(self.rate_headers, **{'X-Cache': 'HIT'})
+
+        semantic_mode = semantic_cache.cache_mode(self.stream, cache_control, self.headers.get('X-Semantic-Cache'))
+        if semantic_mode:
+            # temperature 不同的请求不共用缓存，未指定时按默认值计入分区
+            params = dict(request_fields(self.data), temperature=self.temperature)
+            self.probe = semantic_cache.probe(self.user_id, model, self.messages, params)
+            if self.probe is not None and semantic_mode == 'use':
+                cached = semantic_cache.lookup(self.probe)
+                if cached:
+                    record_usage(self.user_id, api_key, self.timer.attach(cached), cache_hit=True)
+                    return 200, cached['response'], dict(self.rate_headers, **{
+                        'X-Cache': 'SEMANTIC-HIT', 'X-Semantic-Similarity': f"{cached['similarity']:.4f}"
+                    })
+        return None
+
+    def attempt_failed(self, api_key, result):
+        # 故障转移中的一次失败，返回是否不再尝试后面的Key
+        failed_attempt(self.user_id, api_key, result, self.timer)
+        return result.get('quota_exceeded') == SCOPE_USER or retry_policy.expired(self.deadline)
+
+    def hedge_lost(self, api_key, result):
+        record_hedge_loser(self.user_id, api_key, result)
+
+    def failed(self, api_key, result):
+        request_failed(self.user_id, api_key, result, self.timer)
+        if result.get('quota_exceeded') == SCOPE_USER:
+            return 429, {'error': result['message']}, self.rate_headers
+        if 'rate_limited' in result:
+            retry_after = str(max(math.ceil(result['rate_limited']), 1))
+            return 429, {'error': result['message']}, dict(self.rate_headers, **{'Retry-After': retry_after})
+        return 500, {'error': result['message']}, self.rate_headers
+
+    def completed(self, api_key, result, is_hedge=False):
+        # 非流式请求成功: 先记录用量、写入缓存，再返回响应，返回值为响应头
+        record_usage(self.user_id, api_key, self.timer.attach(result), is_hedge=is_hedge)
+        headers = dict(self.rate_headers)
+        if self.key_hash:
+            response_cache.set(self.key_hash, result)
+            headers['X-Cache'] = 'MISS'
+        if self.probe is not None:
+            semantic_cache.store(self.probe, result)
+        return headers
+
+    def stream_started(self, result):
+        # 流式响应的上游耗时计到流结束，用量在流结束后由 stream_finished 记录
+        self.timer.attach(result)
+        return time.perf_counter()
+
+    def stream_finished(self, api_key, result, started, status='success'):
+        # 流正常结束后 result['usage'] 已由最后的事件填充；客户端断开 (cancelled) 或上游中断 (error) 时
+        # 上游的Token已经消耗，按已知的部分用量记录
+        result['timings']['upstream'] += time.perf_counter() - started
+        if status != 'success':
+            self.partial_usage(api_key, result)
+        record_usage(self.user_id, api_key, result, status=status)
+
+    def partial_usage(self, api_key, result):
+        # 上游还没发送 usage 时，输入Token按请求估算，输出Token按已转发的内容事件数估算
+        usage, relay = result['usage'], result.get('relay')
+        prompt_tokens = usage.get('prompt_tokens') or token_estimator.prompt_tokens(
+            self.messages, api_key.provider, self.model or api_key.model
+        )
+        completion_tokens = max(usage.get('completion_tokens') or 0, relay.events if relay else 0)
+        usage.update({
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens
+        })
+
+
+def select_api_keys(user_id, model=None, messages=None, max_tokens=None):
+    eligible = []
+    for key in auth_cache.get_keys(user_id):
+        amount = 1
+        if messages is not None:
+            # 模型上下文长度不够的Key直接跳过，请求转到上下文更长的模型，不必等上游返回错误
+            amount = token_estimator.admit(messages, max_tokens, key.provider, model or key.model)
+            if amount is None:
+                token_estimator.counters['keys_skipped'] += 1
+                continue
+        # 预留失败的Key由 quota_store 记住当天剩余的额度，短时间内不够本次请求的直接跳过
+        if quota_store.exhausted(key, amount):
+            continue
+        # 熔断打开的Key直接跳过，半开状态只放行少量探测请求
+        if not circuit_breakers.available(key):
+            continue
+        eligible.append(key)
+
+    return router.order(user_id, eligible)
+
+
+def reserve_tokens(user_id, api_key, amount):
+    # 请求前按估算预留Token，返回 (reservation, 失败结果)
+    try:
+        return quota_store.reserve(user_id, auth_cache.get_user_limit(user_id), api_key, amount), None
+    except QuotaExceeded as e:
+        if e.scope == SCOPE_USER:
+            message = '今日Token额度已用完'
+        else:
+            message = f'{api_key.name} 今日Token额度已用完'
+        return None, {'success': False, 'message': message, 'quota_exceeded': e.scope}
+
+
+def admit_key(user_id, api_key, estimate):
+    # Key级速率限制放行后预留Token并通过熔断器，返回 (reservation, 拒绝结果)
+    reservation, refused = reserve_tokens(user_id, api_key, estimate)
+    if refused:
+        return None, upstream_failed(api_key, refused)
+    if not circuit_breakers.acquire(api_key):
+        quota_store.release(reservation)
+        return None, upstream_failed(
+            api_key, {'success': False, 'message': f'{api_key.name} 已熔断，暂时跳过', 'circuit_open': True}
+        )
+    return reservation, None
+
+
+def finish_attempt(api_key, result, reservation, started, connect, ttfb, elapsed):
+    # 上游调用结束后更新延迟统计和熔断状态；成功的请求在记录用量时按实际Token结算，失败的立即归还预留
+    observe_upstream(api_key, result, connect, ttfb, elapsed)
+    router.end(api_key.id, started, router.outcome(result))
+    circuit_breakers.record(api_key, result)
+    if result['success']:
+        result['reservation'] = reservation
+    else:
+        quota_store.release(reservation)
+    return result
+
+
+def rate_limited_result(state, api_key=None):
+    message = f'{api_key.name} 已达到速率限制' if api_key else '请求过于频繁，请稍后重试'
+    return {'success': False, 'message': message, 'rate_limited': state.retry_after}
+
+
+def no_key_result(user_id=None, model=None, messages=None, max_tokens=None):
+    # 所有Key都因为上下文长度不够被跳过时，告诉客户端请求太长，而不是没有可用的Key
+    if messages is not None:
+        candidates = auth_cache.get_keys(user_id)
+        if candidates and not any(
+            token_estimator.fits(messages, max_tokens, key.provider, model or key.model) for key in candidates
+        ):
+            key = candidates[0]
+            token_estimator.counters['context_rejected'] += 1
+            prompt_tokens = token_estimator.prompt_tokens(messages, key.provider, model or key.model)
+            window = token_estimator.context_window(model or key.model)
+            message = f'请求超过模型的上下文长度: 输入约 {prompt_tokens} tokens'
+            if max_tokens:
+                message += f'，max_tokens 为 {max_tokens}'
+            return {'success': False, 'message': f'{message}，上限 {window} tokens', 'status_code': 400, 'no_key': True,
+                    'context_length_exceeded': True}
+    return {'success': False, 'message': '没有可用的API Key', 'status_code': 400, 'no_key': True}
+
+
+def fallback_key(candidates):
+    # 所有Key都被熔断或额度用完时，失败记到优先级最高的Key上，故障期间汇总表的失败数才准确；用户没有任何Key时不关联Key
+    return candidates[0] if candidates else None
+
+
+def rejected(result):
+    # 网关自己拒绝的请求：没有发到上游
+    return bool('rate_limited' in result or result.get('quota_exceeded') or result.get('circuit_open') or result.get('no_key'))
+
+
+def failed_attempt(user_id, api_key, result, timer=None):
+    # 故障转移中每个上游返回错误的Key各记一条失败记录；被网关拒绝的Key只在请求最终失败时记录一次
+    if not rejected(result):
+        record_failure(user_id, api_key, result, timer)
+
+
+def request_failed(user_id, api_key, result, timer=None):
+    if rejected(result):
+        record_failure(user_id, api_key, result, timer)
+
+
+def record_failure(user_id, api_key, result, timer=None, is_hedge=False):
+    # 失败记录走 usage_writer 的非阻塞采样路径，api_key 为 None 表示没有选到上游Key
+    if timer is not None:
+        timer.attach(result)
+    event = usage_event(user_id, api_key, result, is_hedge=is_hedge, status='rejected' if rejected(result) else 'error')
+    event['upstream_status'] = result.get('status_code') if not result.get('no_key') else None
+    event['error_message'] = result.get('message')
+    usage_writer.submit_failure(event)
+    metrics.record(event)
+    return result
+
+
+def failure_reason(result):
+    # 上游失败或被拒绝的原因，作为 gateway_upstream_errors_total 的标签
+    if 'rate_limited' in result:
+        return 'rate_limited'
+    if result.get('quota_exceeded'):
+        return 'quota_exceeded'
+    if result.get('circuit_open'):
+        return 'circuit_open'
+    if result.get('status_code'):
+        return f'http_{result["status_code"]}'
+    return 'exception'
+
+
+def upstream_failed(api_key, result):
+    metrics.inc('gateway_upstream_errors_total', provider=api_key.provider, key_id=str(api_key.id),
+                reason=failure_reason(result))
+    return result
+
+
+def upstream_error(response):
+    # 上游返回的 Retry-After 决定重试前至少等待多久；requests 和 httpx 的响应都可以
+    return {
+        'success': False,
+        'message': f'API Error: {response.text}',
+        'status_code': response.status_code,
+        'retry_after': parse_retry_after(response.headers)
+    }
+
+
+def observe_upstream(api_key, result, connect, ttfb, elapsed):
+    # 各阶段耗时随结果传到 usage_event 写入用量记录；新建连接的耗时和失败次数直接计入指标
+    result['timings'] = {'connect': connect, 'ttfb': ttfb, 'upstream': elapsed}
+    if connect:
+        metrics.observe('gateway_upstream_connect_seconds', connect, provider=api_key.provider, key_id=str(api_key.id))
+    if not result['success']:
+        upstream_failed(api_key, result)
+
+
+def record_usage(user_id, api_key, result, cache_hit=False, is_hedge=False, status='success'):
+    event = usage_event(user_id, api_key, result, cache_hit, is_hedge, status)
+    usage_writer.submit(event)
+    metrics.record(event)
+
+    # 配额以 quota_store 为准，数据库中的计数由 usage_writer 批量累加
+    quota_store.settle(result.get('reservation'), event['total_tokens'])
+    consume_rate_tokens(user_id, api_key, event['total_tokens'])
+
+
+def consume_rate_tokens(user_id, api_key, tokens):
+    # 放行时只检查Token桶余量，请求完成后按实际用量扣除用户和上游Key的Token桶
+    _, user_tpm = rate_limiter.user_limits(*auth_cache.get_user_rate_limits(user_id))
+    rate_limiter.consume(SCOPE_USER, user_id, user_tpm, tokens)
+    rate_limiter.consume(SCOPE_KEY, api_key.id, api_key.tpm_limit, tokens)
+
+
+def usage_event(user_id, api_key, result, cache_hit=False, is_hedge=False, status='success'):
+    usage = result.get('usage', {})
+    timings = result.get('timings', {})
+    started = result.get('started')
+    now = datetime.utcnow()
+
+    # 缓存命中不消耗上游Token，原本需要的Token记为节省量
+    if cache_hit:
+        prompt_tokens = completion_tokens = total_tokens = 0
+        saved_tokens = usage.get('total_tokens', 0)
+    else:
+        prompt_tokens = usage.get('prompt_tokens', 0)
+        completion_tokens = usage.get('completion_tokens', 0)
+        total_tokens = usage.get('total_tokens', 0)
+        saved_tokens = 0
+
+    return {
+        'user_id': user_id,
+        'api_key_id': api_key.id if api_key else None,
+        'provider': api_key.provider if api_key else '',
+        'model': api_key.model if api_key else None,
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'total_tokens': total_tokens,
+        'status': status,
+        'cache_hit': cache_hit,
+        'saved_tokens': saved_tokens,
+        'is_hedge': is_hedge,
+        'request_time': time.perf_counter() - started if started else timings.get('upstream', 0),
+        'auth_time': timings.get('auth', 0),
+        'select_time': timings.get('select', 0),
+        'connect_time': timings.get('connect', 0),
+        'ttfb': timings.get('ttfb', 0),
+        'upstream_time': timings.get('upstream', 0),
+        'upstream_status': None,
+        'error_message': None,
+        'created_at': now
+    }
+
+
+def record_hedge_loser(user_id, api_key, result):
+    # 对冲中落败的请求：已完成的按实际消耗记为 cancelled，失败的记为 error，被取消的不计Token
+    if result is not None and not result['success']:
+        record_failure(user_id, api_key, result, is_hedge=True)
+    else:
+        record_usage(user_id, api_key, result or {}, is_hedge=True, status='cancelled')
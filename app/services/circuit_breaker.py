@@ -0,0 +1,148 @@
+import os
+import threading
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold, recovery_timeout, half_open_max_calls):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probes = 0
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.recovery_timeout:
+            self.state = HALF_OPEN
+            self.probes = 0
+
+    def available(self):
+        # 只检查是否可用，不占用半开状态的探测名额
+        with self._lock:
+            self._refresh()
+            if self.state == OPEN:
+                return False
+            return self.state == CLOSED or self.probes < self.half_open_max_calls
+
+    def acquire(self):
+        with self._lock:
+            self._refresh()
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and self.probes < self.half_open_max_calls:
+                self.probes += 1
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.probes = 0
+
+    def record_failure(self):
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._open()
+                return
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self._open()
+
+    def release(self):
+        # 请求被取消时归还半开状态占用的探测名额
+        with self._lock:
+            if self.state == HALF_OPEN and self.probes > 0:
+                self.probes -= 1
+
+    def _open(self):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self.probes = 0
+
+    def snapshot(self):
+        with self._lock:
+            self._refresh()
+            retry_in = 0
+            if self.state == OPEN:
+                retry_in = max(0, round(self.recovery_timeout - (time.monotonic() - self.opened_at)))
+            return {'state': self.state, 'failures': self.failures, 'retry_in': retry_in}
+
+
+class CircuitBreakers:
+    # 每个上游Key (或每个 base_url) 一个熔断器，状态保存在当前进程内
+    def __init__(self, app=None):
+        self.enabled = True
+        self.scope = 'key'
+        self.failure_threshold = 5
+        self.recovery_timeout = 30
+        self.half_open_max_calls = 1
+        self._breakers = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('CIRCUIT_BREAKER_ENABLED', self.enabled)
+        self.scope = app.config.get('CIRCUIT_BREAKER_SCOPE', self.scope)
+        self.failure_threshold = app.config.get('CIRCUIT_BREAKER_FAILURE_THRESHOLD', self.failure_threshold)
+        self.recovery_timeout = app.config.get('CIRCUIT_BREAKER_RECOVERY_TIMEOUT', self.recovery_timeout)
+        self.half_open_max_calls = app.config.get('CIRCUIT_BREAKER_HALF_OPEN_CALLS', self.half_open_max_calls)
+        app.extensions['circuit_breakers'] = self
+
+    def breaker_key(self, api_key):
+        if self.scope == 'base_url':
+            return api_key.base_url or api_key.provider
+        return api_key.id
+
+    def get(self, api_key):
+        key = self.breaker_key(api_key)
+        breaker = self._breakers.get(key)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(key, CircuitBreaker(
+                    self.failure_threshold, self.recovery_timeout, self.half_open_max_calls
+                ))
+        return breaker
+
+    def available(self, api_key):
+        return not self.enabled or self.get(api_key).available()
+
+    def acquire(self, api_key):
+        return not self.enabled or self.get(api_key).acquire()
+
+    def record(self, api_key, result):
+        if not self.enabled:
+            return
+        # 只有连接错误、超时、5xx 和 429 计为上游故障，其他4xx视为请求本身的问题
+        status_code = result.get('status_code')
+        if result['success'] or (status_code is not None and 400 <= status_code < 500 and status_code != 429):
+            self.get(api_key).record_success()
+        else:
+            self.get(api_key).record_failure()
+
+    def release(self, api_key):
+        if self.enabled:
+            self.get(api_key).release()
+
+    def state_for(self, api_key):
+        breaker = self._breakers.get(self.breaker_key(api_key))
+        return breaker.snapshot() if breaker else {'state': CLOSED, 'failures': 0, 'retry_in': 0}
+
+    def stats(self):
+        return {
+            'pid': os.getpid(),
+            'enabled': self.enabled,
+            'scope': self.scope,
+            'breakers': {str(key): breaker.snapshot() for key, breaker in list(self._breakers.items())}
+        }
+
+
+circuit_breakers = CircuitBreakers()
@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from flask import current_app
+
+from app.services.routing import router
+
+logger = logging.getLogger(__name__)
+
+
+class Hedger:
+    # 主Key在延迟阈值内未返回时向下一个Key发出同样的请求，取先成功的结果
+    def __init__(self, app=None):
+        self.enabled = False
+        self.delay = 0
+        self.min_delay = 0.05
+        self.default_delay = 1.0
+        self.budget_ratio = 0.1
+        self.budget_burst = 5
+        self.max_workers = 32
+        self._tokens = 0.0
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.counters = {'requests': 0, 'hedged': 0, 'hedge_wins': 0, 'budget_exhausted': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('HEDGE_ENABLED', self.enabled)
+        self.delay = app.config.get('HEDGE_DELAY', self.delay)
+        self.min_delay = app.config.get('HEDGE_MIN_DELAY', self.min_delay)
+        self.default_delay = app.config.get('HEDGE_DEFAULT_DELAY', self.default_delay)
+        self.budget_ratio = app.config.get('HEDGE_BUDGET_RATIO', self.budget_ratio)
+        self.budget_burst = app.config.get('HEDGE_BUDGET_BURST', self.budget_burst)
+        self.max_workers = app.config.get('HEDGE_THREADS', self.max_workers)
+        self._tokens = float(self.budget_burst)
+        app.extensions['hedger'] = self
+
+    def applies(self, api_keys, stream):
+        # 流式响应开始输出后无法切换，只对冲非流式请求
+        return self.enabled and not stream and len(api_keys) > 1
+
+    def delay_for(self, key_id):
+        # HEDGE_DELAY 为 0 时按主Key近期的 p90 延迟决定何时发出对冲请求
+        if self.delay:
+            return self.delay
+        p90 = router.stats_for(key_id).percentile(0.9)
+        if p90 is None:
+            return self.default_delay
+        return max(p90, self.min_delay)
+
+    def _deposit(self):
+        # 每个请求为预算存入 budget_ratio 个令牌，对冲一次消耗一个，额外请求不超过该比例
+        with self._lock:
+            self.counters['requests'] += 1
+            self._tokens = min(float(self.budget_burst), self._tokens + self.budget_ratio)
+
+    def _spend(self):
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                self.counters['hedged'] += 1
+                return True
+            self.counters['budget_exhausted'] += 1
+            return False
+
+    def _get_executor(self):
+        # fork 之后线程池不可用，按进程号懒创建
+        if self._executor is None or self._pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='hedge')
+        return self._executor
+
+    def _pick(self, outcomes, backup):
+        winner = next((o for o in outcomes if o[1]['success']), None)
+        if winner is None:
+            return None
+        if winner[0] is backup:
+            self.counters['hedge_wins'] += 1
+        return winner
+
+    def run(self, call, primary, backup, on_loser):
+        # 返回 (api_key, result, hedged)；被放弃的一方完成后交给 on_loser(api_key, result) 记录
+        app = current_app._get_current_object()
+        self._deposit()
+        executor = self._get_executor()
+        first = executor.submit(call, primary)
+        done, _ = wait([first], timeout=self.delay_for(primary.id))
+        if done or not self._spend():
+            return primary, first.result(), False
+
+        futures = {first: primary, executor.submit(call, backup): backup}
+        pending = set(futures)
+        finished = []
+        winner = None
+        while winner is None and pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            outcomes = [(futures[f], f.result()) for f in done]
+            winner = self._pick(outcomes, backup)
+            finished.extend(o for o in outcomes if o is not winner)
+
+        if winner is None:
+            winner = finished.pop()
+        for api_key, result in finished:
+            on_loser(api_key, result)
+        # 同步模式无法中断阻塞中的上游调用，结果直接丢弃，完成后仍按实际消耗记录。
+        # 回调在请求返回之后的线程池线程中执行，需要自己的应用上下文
+        def record_loser(future, api_key):
+            with app.app_context():
+                try:
+                    on_loser(api_key, future.result())
+                except Exception:
+                    logger.exception('记录对冲落败请求的用量失败')
+
+        for future in pending:
+            future.add_done_callback(lambda f, api_key=futures[future]: record_loser(f, api_key))
+        return winner[0], winner[1], True
+
+    async def run_async(self, call, primary, backup):
+        # 返回 (api_key, result, hedged, losers)，losers 中被取消的请求结果为 None
+        self._deposit()
+        first = asyncio.ensure_future(call(primary))
+        done, _ = await asyncio.wait({first}, timeout=self.delay_for(primary.id))
+        if done or not self._spend():
+            return primary, await first, False, []
+
+        tasks = {first: primary, asyncio.ensure_future(call(backup)): backup}
+        pending = set(tasks)
+        finished = []
+        winner = None
+        while winner is None and pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            outcomes = [(tasks[t], t.result()) for t in done]
+            winner = self._pick(outcomes, backup)
+            finished.extend(o for o in outcomes if o is not winner)
+
+        if winner is None:
+            winner = finished.pop()
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        losers = finished + [(tasks[t], None) for t in pending]
+        return winner[0], winner[1], True, losers
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats.update({
+            'pid': os.getpid(),
+            'enabled': self.enabled,
+            'delay': self.delay or 'p90',
+            'budget_ratio': self.budget_ratio,
+            'budget_tokens': round(self._tokens, 2)
+        })
+        return stats
+
+
+hedger = Hedger()
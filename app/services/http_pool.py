@@ -0,0 +1,169 @@
+import os
+import socket
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+_timing = threading.local()
+
+
+class TimedHTTPConnection(HTTPConnection):
+    # 记录当前线程本次请求中建立新连接 (含 TLS 握手) 的耗时，复用的连接不计
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            _timing.connect = getattr(_timing, 'connect', 0.0) + time.perf_counter() - started
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            _timing.connect = getattr(_timing, 'connect', 0.0) + time.perf_counter() - started
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    def __init__(self, socket_options=None, **kwargs):
+        self.socket_options = socket_options
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.socket_options is not None:
+            kwargs['socket_options'] = self.socket_options
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool
+        }
+
+
+class UpstreamPool:
+    # 按上游主机 (scheme://host:port) 复用长连接 Session
+    def __init__(self, app=None):
+        self._sessions = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+        self.pool_connections = 4
+        self.pool_maxsize = 32
+        self.pool_block = True
+        self.keepalive = True
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.pool_connections = app.config.get('UPSTREAM_POOL_CONNECTIONS', self.pool_connections)
+        self.pool_maxsize = app.config.get('UPSTREAM_POOL_MAXSIZE', self.pool_maxsize)
+        self.pool_block = app.config.get('UPSTREAM_POOL_BLOCK', self.pool_block)
+        self.keepalive = app.config.get('UPSTREAM_KEEPALIVE', self.keepalive)
+        app.extensions['upstream_pool'] = self
+
+    @staticmethod
+    def pool_key(url):
+        parts = urlsplit(url)
+        return f'{parts.scheme}://{parts.netloc}'
+
+    def _socket_options(self):
+        if not self.keepalive:
+            return None
+        options = list(HTTPConnection.default_socket_options)
+        options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+        for name, value in (('TCP_KEEPIDLE', 60), ('TCP_KEEPINTVL', 15), ('TCP_KEEPCNT', 4)):
+            if hasattr(socket, name):
+                options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+        return options
+
+    def _create_session(self):
+        session = requests.Session()
+        adapter = KeepAliveAdapter(
+            socket_options=self._socket_options(),
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            pool_block=self.pool_block,
+            max_retries=0
+        )
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if not self.keepalive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    def session_for(self, url):
+        key = self.pool_key(url)
+        session = self._sessions.get(key)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(key)
+                if session is None:
+                    session = self._create_session()
+                    self._sessions[key] = session
+                    self._stats[key] = {'requests': 0, 'errors': 0}
+        return key, session
+
+    def request(self, method, url, **kwargs):
+        key, session = self.session_for(url)
+        stats = self._stats[key]
+        # 对冲、批量和任务线程会同时计数
+        with self._lock:
+            stats['requests'] += 1
+        _timing.connect = 0.0
+        try:
+            return session.request(method, url, **kwargs)
+        except requests.RequestException:
+            with self._lock:
+                stats['errors'] += 1
+            raise
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    @staticmethod
+    def connect_time():
+        # 当前线程上一次请求建立连接的耗时，复用已有连接时为 0
+        return getattr(_timing, 'connect', 0.0)
+
+    def stats(self):
+        hosts = {}
+        for key, session in list(self._sessions.items()):
+            adapter = session.get_adapter(key)
+            pools = list(adapter.poolmanager.pools._container.values())
+            hosts[key] = {
+                'requests': self._stats[key]['requests'],
+                'errors': self._stats[key]['errors'],
+                'connections_opened': sum(p.num_connections for p in pools),
+                'pooled_requests': sum(p.num_requests for p in pools),
+                'idle_connections': sum(1 for p in pools if p.pool is not None for c in list(p.pool.queue) if c is not None),
+            }
+        return {
+            'pid': os.getpid(),
+            'pool_maxsize': self.pool_maxsize,
+            'pool_block': self.pool_block,
+            'keepalive': self.keepalive,
+            'hosts': hosts
+        }
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+            self._stats.clear()
+
+
+upstream_pool = UpstreamPool()
@@ -0,0 +1,235 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED = (SUCCEEDED, FAILED, CANCELLED)
+
+
+class JobFailed(Exception):
+    def __init__(self, message, status_code=500):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class JobQueue:
+    # 异步任务保存在本机 SQLite 文件中，所有 worker 进程共享；每个进程的工作线程抢占排队中的任务执行
+    def __init__(self, app=None):
+        self.app = None
+        self.handler = None
+        self.enabled = True
+        self.path = None
+        self.workers = 4
+        self.per_key_concurrency = 2
+        self.result_ttl = 3600
+        self.max_wait = 30
+        self.lease = 300
+        self.max_attempts = 3
+        self.poll_interval = 1.0
+        self._local = threading.local()
+        self._threads = []
+        self._pid = None
+        self._slots = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._finished = threading.Condition()
+        self._last_purge = 0
+        self.counters = {'submitted': 0, 'succeeded': 0, 'failed': 0, 'cancelled': 0, 'requeued': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app, handler=None):
+        self.app = app
+        self.handler = handler or self.handler
+        self.enabled = app.config.get('JOB_QUEUE_ENABLED', self.enabled)
+        self.workers = app.config.get('JOB_WORKERS', self.workers)
+        self.per_key_concurrency = app.config.get('JOB_PER_KEY_CONCURRENCY', self.per_key_concurrency)
+        self.result_ttl = app.config.get('JOB_RESULT_TTL', self.result_ttl)
+        self.max_wait = app.config.get('JOB_MAX_WAIT', self.max_wait)
+        self.lease = app.config.get('JOB_LEASE', self.lease)
+        self.max_attempts = app.config.get('JOB_MAX_ATTEMPTS', self.max_attempts)
+        self.poll_interval = app.config.get('JOB_POLL_INTERVAL', self.poll_interval)
+        self.path = app.config.get('JOB_STORE_PATH') or os.path.join(app.instance_path, 'jobs.db')
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'id TEXT PRIMARY KEY, user_id INTEGER NOT NULL, status TEXT NOT NULL, request TEXT NOT NULL, '
+            'result TEXT, error TEXT, status_code INTEGER, attempts INTEGER NOT NULL DEFAULT 0, '
+            'created_at REAL NOT NULL, started_at REAL, finished_at REAL, lease_until REAL, expires_at REAL)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_jobs_status_created ON jobs (status, created_at)')
+        app.extensions['job_queue'] = self
+        if self.enabled:
+            # 服务重启后由第一个请求启动工作线程，继续执行未完成的任务
+            app.before_request(self._ensure_workers)
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _ensure_workers(self):
+        # gunicorn fork 之后线程不会被继承，按进程号懒启动
+        if self._pid == os.getpid() and all(thread.is_alive() for thread in self._threads):
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._slots = {}
+                self._threads = []
+            self._pid = os.getpid()
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, name=f'job-worker-{len(self._threads)}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def key_slot(self, key_id):
+        slot = self._slots.get(key_id)
+        if slot is None:
+            with self._lock:
+                slot = self._slots.setdefault(key_id, threading.BoundedSemaphore(self.per_key_concurrency))
+        return slot
+
+    def submit(self, user_id, request):
+        job_id = f'job-{uuid.uuid4().hex}'
+        now = time.time()
+        self._connect().execute(
+            'INSERT INTO jobs (id, user_id, status, request, created_at) VALUES (?, ?, ?, ?, ?)',
+            (job_id, user_id, QUEUED, json.dumps(request, ensure_ascii=False), now)
+        )
+        self.counters['submitted'] += 1
+        self._ensure_workers()
+        with self._wakeup:
+            self._wakeup.notify()
+        return self.get(job_id)
+
+    def get(self, job_id, user_id=None):
+        row = self._connect().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None or (user_id is not None and row['user_id'] != user_id):
+            return None
+        return dict(row)
+
+    def wait(self, job_id, user_id, timeout):
+        # 长轮询：本进程完成的任务立即唤醒，其他进程完成的任务按轮询间隔发现
+        deadline = time.monotonic() + min(timeout, self.max_wait)
+        while True:
+            job = self.get(job_id, user_id)
+            remaining = deadline - time.monotonic()
+            if job is None or job['status'] in FINISHED or remaining <= 0:
+                return job
+            with self._finished:
+                self._finished.wait(min(remaining, self.poll_interval))
+
+    def cancel(self, job_id, user_id):
+        # 只能取消还在排队的任务，已开始执行的上游请求无法中断
+        updated = self._connect().execute(
+            'UPDATE jobs SET status = ?, finished_at = ?, expires_at = ? WHERE id = ? AND user_id = ? AND status = ?',
+            (CANCELLED, time.time(), time.time() + self.result_ttl, job_id, user_id, QUEUED)
+        ).rowcount
+        if updated:
+            self.counters['cancelled'] += 1
+        return self.get(job_id, user_id)
+
+    def _claim(self):
+        conn = self._connect()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # 租约过期的任务说明执行它的进程已退出，重新排队或标记失败
+            requeued = conn.execute(
+                'UPDATE jobs SET status = ?, lease_until = NULL WHERE status = ? AND lease_until < ? AND attempts < ?',
+                (QUEUED, RUNNING, now, self.max_attempts)
+            ).rowcount
+            conn.execute(
+                'UPDATE jobs SET status = ?, error = ?, status_code = 500, finished_at = ?, expires_at = ? '
+                'WHERE status = ? AND lease_until < ?',
+                (FAILED, '任务执行中断次数过多', now, now + self.result_ttl, RUNNING, now)
+            )
+            row = conn.execute(
+                'SELECT id, user_id, request FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1', (QUEUED,)
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    'UPDATE jobs SET status = ?, attempts = attempts + 1, started_at = ?, lease_until = ? WHERE id = ?',
+                    (RUNNING, now, now + self.lease, row['id'])
+                )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        self.counters['requeued'] += requeued
+        return row
+
+    def _finish(self, job_id, status, result=None, error=None, status_code=None):
+        now = time.time()
+        self._connect().execute(
+            'UPDATE jobs SET status = ?, result = ?, error = ?, status_code = ?, finished_at = ?, '
+            'lease_until = NULL, expires_at = ? WHERE id = ? AND status = ?',
+            (status, json.dumps(result, ensure_ascii=False) if result is not None else None, error, status_code,
+             now, now + self.result_ttl, job_id, RUNNING)
+        )
+        self.counters[status] += 1
+        with self._finished:
+            self._finished.notify_all()
+
+    def _purge(self):
+        now = time.time()
+        if now - self._last_purge < 60:
+            return
+        self._last_purge = now
+        self._connect().execute('DELETE FROM jobs WHERE expires_at < ?', (now,))
+
+    def _run(self):
+        while True:
+            try:
+                self._purge()
+                job = self._claim()
+            except Exception:
+                logger.exception('读取任务队列失败')
+                job = None
+            if job is None:
+                with self._wakeup:
+                    self._wakeup.wait(self.poll_interval)
+                continue
+            try:
+                with self.app.app_context():
+                    result = self.handler(job['user_id'], json.loads(job['request']))
+                self._finish(job['id'], SUCCEEDED, result=result, status_code=200)
+            except JobFailed as e:
+                self._finish(job['id'], FAILED, error=str(e), status_code=e.status_code)
+            except Exception as e:
+                logger.exception('任务 %s 执行失败', job['id'])
+                self._finish(job['id'], FAILED, error=str(e), status_code=500)
+
+    def stats(self):
+        rows = self._connect().execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+        stats = dict(self.counters)
+        stats.update({
+            'pid': os.getpid(),
+            'enabled': self.enabled,
+            'path': self.path,
+            'workers': sum(1 for thread in self._threads if thread.is_alive()) if self._pid == os.getpid() else 0,
+            'jobs': {status: count for status, count in rows}
+        })
+        return stats
+
+
+job_queue = JobQueue()
@@ -0,0 +1,265 @@
+import atexit
+import bisect
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+METRICS = {
+    'gateway_http_requests_total': (COUNTER, 'HTTP responses by endpoint and status code'),
+    'gateway_http_request_duration_seconds': (HISTOGRAM, 'Time spent handling HTTP requests'),
+    'gateway_http_requests_in_flight': (GAUGE, 'HTTP requests currently being handled'),
+    'gateway_requests_total': (COUNTER, 'Recorded gateway requests by upstream key and status'),
+    'gateway_request_duration_seconds': (HISTOGRAM, 'End-to-end gateway time per recorded request'),
+    'gateway_phase_duration_seconds': (HISTOGRAM, 'Gateway time spent in each request phase'),
+    'gateway_upstream_connect_seconds': (HISTOGRAM, 'Time to open new upstream connections, including TLS'),
+    'gateway_upstream_ttfb_seconds': (HISTOGRAM, 'Time from sending the upstream request to its response headers'),
+    'gateway_upstream_duration_seconds': (HISTOGRAM, 'Total upstream time per request'),
+    'gateway_upstream_in_flight': (GAUGE, 'Upstream requests currently in progress'),
+    'gateway_upstream_errors_total': (COUNTER, 'Failed or rejected upstream attempts by reason'),
+    'gateway_upstream_retries_total': (COUNTER, 'Upstream retries on the same key by reason'),
+    'gateway_db_write_seconds': (HISTOGRAM, 'Time to write one batch of usage records'),
+    'gateway_db_written_records_total': (COUNTER, 'Usage records written to the database'),
+    'gateway_semantic_cache_lookups_total': (COUNTER, 'Semantic cache lookups by result'),
+    'gateway_semantic_cache_lookup_seconds': (HISTOGRAM, 'Time to embed the prompt and search the semantic cache'),
+}
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Timer:
+    # 记录一次网关请求各阶段的耗时 (秒)
+    __slots__ = ('started', 'phases')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - started
+
+    def attach(self, result):
+        # 把网关侧的阶段耗时合并到上游调用结果中，记录用量时统一读取
+        result.setdefault('timings', {}).update(self.phases)
+        result['started'] = self.started
+        return result
+
+
+class Metrics:
+    # 进程内累计的 Prometheus 指标；每个 worker 定期把快照写到 instance/metrics/<pid>.json，
+    # /metrics 合并本机所有进程的快照输出。已退出进程的计数和直方图保留，在途数只取存活的进程
+    def __init__(self, app=None):
+        self.enabled = True
+        self.directory = None
+        self.flush_interval = 5
+        self.stale_after = 86400
+        self.buckets = DEFAULT_BUCKETS
+        self._values = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pid = None
+        self._last_flush = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('METRICS_ENABLED', self.enabled)
+        self.flush_interval = app.config.get('METRICS_FLUSH_INTERVAL', self.flush_interval)
+        self.directory = app.config.get('METRICS_DIR') or os.path.join(app.instance_path, 'metrics')
+        os.makedirs(self.directory, exist_ok=True)
+        app.extensions['metrics'] = self
+        atexit.register(self.flush)
+
+    def _state(self):
+        # fork 之后子进程从空的计数开始，避免把父进程的数据重复计入
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._values = {}
+                    self._flush_lock = threading.Lock()
+                    self._pid = os.getpid()
+                    self._last_flush = 0
+        return self._values
+
+    def inc(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+        values = self._state()
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            values[key] = values.get(key, 0) + amount
+        self._maybe_flush()
+
+    @contextmanager
+    def in_flight(self, name, **labels):
+        self.inc(name, 1, **labels)
+        try:
+            yield
+        finally:
+            self.inc(name, -1, **labels)
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        values = self._state()
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = values.get(key)
+            if entry is None:
+                entry = values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            entry[index] += 1
+            entry[-1] += value
+        self._maybe_flush()
+
+    def record(self, event):
+        # 每条用量记录对应一次完整的网关请求
+        labels = {
+            'provider': event['provider'],
+            'model': event['model'] or '',
+            'key_id': str(event['api_key_id'] or '')
+        }
+        self.inc('gateway_requests_total', status=event['status'], **labels)
+        self.observe('gateway_request_duration_seconds', event['request_time'], **labels)
+        if event.get('ttfb'):
+            self.observe('gateway_upstream_ttfb_seconds', event['ttfb'], **labels)
+        if event.get('upstream_time'):
+            self.observe('gateway_upstream_duration_seconds', event['upstream_time'], **labels)
+        for phase in ('auth', 'select'):
+            if event.get(f'{phase}_time'):
+                self.observe('gateway_phase_duration_seconds', event[f'{phase}_time'], phase=phase)
+
+    def snapshot(self):
+        values = self._state()
+        with self._lock:
+            return [
+                [name, list(labels), list(value) if isinstance(value, list) else value]
+                for (name, labels), value in values.items()
+            ]
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f'{pid}.json')
+
+    def _maybe_flush(self):
+        if self.directory is None or time.monotonic() - self._last_flush < self.flush_interval:
+            return
+        # 其他线程正在写快照时直接跳过，请求线程不等待
+        if not self._flush_lock.acquire(blocking=False):
+            return
+        try:
+            if time.monotonic() - self._last_flush >= self.flush_interval:
+                self._write_snapshot()
+        finally:
+            self._flush_lock.release()
+
+    def flush(self):
+        if self.directory is None:
+            return
+        with self._flush_lock:
+            self._write_snapshot()
+
+    def _write_snapshot(self):
+        # 同一进程内由 _flush_lock 串行化，临时文件不会被另一个线程改名；写入失败不影响请求
+        self._last_flush = time.monotonic()
+        path = self._path(os.getpid())
+        tmp_path = f'{path}.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, path)
+        except OSError:
+            logger.exception('写入指标快照失败')
+
+    def collect(self):
+        # 合并所有进程的指标: {(name, labels): value}
+        merged = {}
+        own = os.getpid()
+        now = time.time()
+        snapshots = [self.snapshot()]
+        for path in glob.glob(os.path.join(self.directory or '', '*.json')):
+            try:
+                pid = int(os.path.basename(path)[:-5])
+            except ValueError:
+                continue
+            if pid == own:
+                continue
+            alive = pid_alive(pid)
+            try:
+                if not alive and now - os.path.getmtime(path) > self.stale_after:
+                    os.remove(path)
+                    continue
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if not alive:
+                snapshot = [item for item in snapshot if METRICS.get(item[0], (None,))[0] != GAUGE]
+            snapshots.append(snapshot)
+
+        for snapshot in snapshots:
+            for name, labels, value in snapshot:
+                key = (name, tuple(tuple(label) for label in labels))
+                if isinstance(value, list):
+                    current = merged.get(key)
+                    merged[key] = value if current is None else [a + b for a, b in zip(current, value)]
+                else:
+                    merged[key] = merged.get(key, 0) + value
+        return merged
+
+    def render(self):
+        # Prometheus 文本格式
+        merged = self.collect()
+        lines = []
+        for name, (kind, help_text) in METRICS.items():
+            series = sorted((labels, value) for (metric, labels), value in merged.items() if metric == name)
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in series:
+                if kind == HISTOGRAM:
+                    cumulative = 0
+                    for bound, count in zip(self.buckets + ('+Inf',), value[:-1]):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{format_labels(labels, le=bound)} {cumulative}')
+                    lines.append(f'{name}_sum{format_labels(labels)} {value[-1]}')
+                    lines.append(f'{name}_count{format_labels(labels)} {cumulative}')
+                else:
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{escape_label(value)}"' for key, value in pairs) + '}'
+
+
+metrics = Metrics()
@@ -0,0 +1,180 @@
+import json
+import os
+
+from flask.json.provider import DefaultJSONProvider
+
+from app.services.streaming import PassthroughRelay, open_passthrough_stream
+
+
+def orjson_available():
+    try:
+        import orjson  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def stdlib_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def scan_usage(body):
+    # 从响应末尾向前找 "usage" 对象，只解析这一小段；找不到或格式不对时返回 None，由调用方完整解析
+    end = len(body)
+    while True:
+        index = body.rfind(b'"usage"', 0, end)
+        if index < 0:
+            return None
+        # 字符串内容里的引号都带反斜杠转义，不会被误认为字段名
+        if index == 0 or body[index - 1] != 0x5c:
+            break
+        end = index
+    start = body.find(b'{', index + 7)
+    if start < 0 or body[index + 7:start].strip() != b':':
+        return None
+    stop = body.find(b'}', start)
+    # usage 中可能嵌套 prompt_tokens_details 等对象
+    while stop >= 0 and body.count(b'{', start, stop + 1) > body.count(b'}', start, stop + 1):
+        stop = body.find(b'}', stop + 1)
+    if stop < 0:
+        return None
+    try:
+        usage = json.loads(body[start:stop + 1])
+    except ValueError:
+        return None
+    return usage if isinstance(usage, dict) else None
+
+
+class ClientBody:
+    # 客户端的原始请求体和解析后的字典，透传时直接转发原始字节
+    __slots__ = ('raw', 'data')
+
+    def __init__(self, raw, data):
+        self.raw = raw
+        self.data = data
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    # jsonify 和 request.get_json 使用 orjson；日期、dataclass 等类型仍按 Flask 默认的方式序列化
+    def _orjson_dumps(self, obj):
+        import orjson
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            return orjson.dumps(obj, default=self.default, option=option)
+        except TypeError:
+            return None
+
+    def dumps(self, obj, **kwargs):
+        # orjson 的输出本身就是紧凑格式，jsonify 传入的紧凑分隔符不影响结果
+        if kwargs.get('separators') == (',', ':'):
+            kwargs.pop('separators')
+        if not kwargs:
+            data = self._orjson_dumps(obj)
+            if data is not None:
+                return data.decode('utf-8')
+        return super().dumps(obj, **kwargs)
+
+    def response(self, *args, **kwargs):
+        # jsonify 直接使用 orjson 生成的字节；调试模式下按 Flask 默认缩进输出
+        if self.compact is False or (self.compact is None and self._app.debug):
+            return super().response(*args, **kwargs)
+        data = self._orjson_dumps(self._prepare_response_obj(args, kwargs))
+        if data is None:
+            return super().response(*args, **kwargs)
+        return self._app.response_class(data + b'\n', mimetype=self.mimetype)
+
+    def loads(self, s, **kwargs):
+        import orjson
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+
+class Passthrough:
+    # OpenAI 兼容的提供商直接转发客户端的原始请求体，只在需要时补上 model 等字段；
+    # 响应体原样返回给客户端，只截取 usage 一段解析。其余提供商和需要改写请求的情况照常拼装
+    def __init__(self, app=None):
+        self.enabled = True
+        self.providers = frozenset(('openai', 'moonshot', 'deepseek', 'zhipu', 'azure'))
+        self.json_backend = 'json'
+        self._loads = json.loads
+        self._dumps = stdlib_dumps
+        self.counters = {'requests': 0, 'fallbacks': 0, 'usage_scanned': 0, 'usage_parsed': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('PASSTHROUGH_ENABLED', self.enabled)
+        providers = app.config.get('PASSTHROUGH_PROVIDERS')
+        if providers is not None:
+            self.providers = frozenset(name.strip() for name in str(providers).split(',') if name.strip())
+        backend = app.config.get('JSON_BACKEND', 'auto')
+        if backend == 'orjson' or (backend == 'auto' and orjson_available()):
+            import orjson
+            self.json_backend = 'orjson'
+            self._loads = orjson.loads
+            self._dumps = orjson.dumps
+            app.json = OrjsonProvider(app)
+        else:
+            self.json_backend = 'json'
+            self._loads = json.loads
+            self._dumps = stdlib_dumps
+        app.extensions['passthrough'] = self
+
+    def loads(self, data):
+        return self._loads(data)
+
+    def dumps(self, obj):
+        return self._dumps(obj)
+
+    def patch(self, raw, fields):
+        # 把缺少的字段插到原始 JSON 对象的开头，其余字节不动
+        if not fields:
+            return raw
+        start = raw.find(b'{') + 1
+        prefix = self._dumps(fields)[:-1]
+        rest = raw[start:]
+        return prefix + (b',' if rest.lstrip()[:1] != b'}' else b'') + rest
+
+    def request(self, adapter, client_body, messages, model, temperature, max_tokens, stream):
+        # 返回 (url, headers, 请求体字节, 是否透传)
+        if client_body is not None and self.enabled and adapter.provider in self.providers:
+            fields = adapter.passthrough_fields(client_body.data, model, temperature, max_tokens, stream)
+            if fields is not None:
+                self.counters['requests'] += 1
+                headers = adapter.stream_headers if stream else adapter.headers
+                return adapter.endpoint(model), headers, self.patch(client_body.raw, fields), True
+            self.counters['fallbacks'] += 1
+        url, headers, payload = adapter.request(messages, model, temperature, max_tokens, stream)
+        return url, headers, self._dumps(payload), False
+
+    def parse_response(self, adapter, body):
+        usage = scan_usage(body)
+        if usage is None:
+            self.counters['usage_parsed'] += 1
+            usage = self._loads(body).get('usage')
+        else:
+            self.counters['usage_scanned'] += 1
+        return {'success': True, 'body': body, 'usage': adapter.normalize_usage(usage)}
+
+    @staticmethod
+    def relay(model):
+        return PassthroughRelay(model)
+
+    def open_stream(self, response, model):
+        return open_passthrough_stream(response, self.relay(model))
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats.update({
+            'pid': os.getpid(),
+            'enabled': self.enabled,
+            'providers': sorted(self.providers),
+            'json_backend': self.json_backend
+        })
+        return stats
+
+
+passthrough = Passthrough()
@@ -0,0 +1,191 @@
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+SCOPE_USER = 'user'
+SCOPE_KEY = 'key'
+
+
+class QuotaExceeded(Exception):
+    def __init__(self, scope):
+        super().__init__(scope)
+        self.scope = scope
+
+
+class Reservation:
+    __slots__ = ('user_id', 'key_id', 'day', 'amount')
+
+    def __init__(self, user_id, key_id, day, amount):
+        self.user_id = user_id
+        self.key_id = key_id
+        self.day = day
+        self.amount = amount
+
+
+def today():
+    return datetime.utcnow().strftime('%Y-%m-%d')
+
+
+def used_today_from_db(api_key):
+    # 计数器还没有今天的行时，以数据库里当天的用量作为初始值
+    last_used_at = api_key.last_used_at
+    if last_used_at and last_used_at.strftime('%Y-%m-%d') == today():
+        return api_key.used_tokens_today or 0
+    return 0
+
+
+class QuotaStore:
+    # 每日Token计数保存在本机 SQLite 文件中，所有 worker 共享，预留和结算都是原子的条件更新
+    def __init__(self, app=None):
+        self.enabled = True
+        self.path = None
+        self.exhausted_ttl = 10
+        self.retention_days = 2
+        self._local = threading.local()
+        self._exhausted = {}
+        self._last_day = None
+        self.counters = {'reserved': 0, 'settled': 0, 'released': 0, 'rejected_user': 0, 'rejected_key': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('QUOTA_ENABLED', self.enabled)
+        self.path = app.config.get('QUOTA_STORE_PATH') or os.path.join(app.instance_path, 'quota.db')
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS quota_counters ('
+            'scope TEXT NOT NULL, owner_id INTEGER NOT NULL, day TEXT NOT NULL, used INTEGER NOT NULL, '
+            'PRIMARY KEY (scope, owner_id, day))'
+        )
+        self._purge(conn, today())
+        app.extensions['quota_store'] = self
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _purge(self, conn, day):
+        # 跨天后旧的计数自然失效，只保留最近几天的行
+        cutoff = (datetime.strptime(day, '%Y-%m-%d') - timedelta(days=self.retention_days)).strftime('%Y-%m-%d')
+        conn.execute('DELETE FROM quota_counters WHERE day < ?', (cutoff,))
+        self._last_day = day
+
+    def exhausted(self, api_key, amount=1):
+        # 进程内记住预留失败时Key当天剩余的额度，剩余额度不够 amount 的请求在选Key时直接跳过，无需访问计数器
+        entry = self._exhausted.get(api_key.id)
+        return entry is not None and entry[0] == today() and entry[1] > time.monotonic() and entry[2] < amount
+
+    def reserve(self, user_id, user_limit, api_key, amount):
+        if not self.enabled:
+            return None
+        day = today()
+        key_limit = 0 if api_key.is_free else (api_key.max_tokens_per_day or 0)
+        conn = self._connect()
+        if self._last_day != day:
+            self._purge(conn, day)
+
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(
+                'INSERT OR IGNORE INTO quota_counters (scope, owner_id, day, used) VALUES (?, ?, ?, 0)',
+                (SCOPE_USER, user_id, day)
+            )
+            conn.execute(
+                'INSERT OR IGNORE INTO quota_counters (scope, owner_id, day, used) VALUES (?, ?, ?, ?)',
+                (SCOPE_KEY, api_key.id, day, used_today_from_db(api_key))
+            )
+            for scope, owner_id, limit in ((SCOPE_USER, user_id, user_limit or 0), (SCOPE_KEY, api_key.id, key_limit)):
+                updated = conn.execute(
+                    'UPDATE quota_counters SET used = used + ? '
+                    'WHERE scope = ? AND owner_id = ? AND day = ? AND (? = 0 OR used + ? <= ?)',
+                    (amount, scope, owner_id, day, limit, amount, limit)
+                ).rowcount
+                if not updated:
+                    raise QuotaExceeded(scope)
+            conn.execute('COMMIT')
+        except QuotaExceeded as e:
+            conn.execute('ROLLBACK')
+            self.counters[f'rejected_{e.scope}'] += 1
+            if e.scope == SCOPE_KEY:
+                used = self.used_today(SCOPE_KEY, [api_key.id]).get(api_key.id, 0)
+                self._exhausted[api_key.id] = (day, time.monotonic() + self.exhausted_ttl, max(key_limit - used, 0))
+            raise
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+        self.counters['reserved'] += 1
+        return Reservation(user_id, api_key.id, day, amount)
+
+    def settle(self, reservation, actual):
+        # 用实际消耗替换预留量，多退少补；计入预留当天
+        if reservation is None:
+            return
+        delta = actual - reservation.amount
+        if delta:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute(
+                    'UPDATE quota_counters SET used = MAX(used + ?, 0) WHERE day = ? AND '
+                    '((scope = ? AND owner_id = ?) OR (scope = ? AND owner_id = ?))',
+                    (delta, reservation.day, SCOPE_USER, reservation.user_id, SCOPE_KEY, reservation.key_id)
+                )
+                conn.execute('COMMIT')
+            except Exception:
+                # 不回滚的话这个线程的连接会一直停在事务里，之后的 BEGIN IMMEDIATE 全部失败
+                conn.execute('ROLLBACK')
+                raise
+        reservation.amount = actual
+        self.counters['released' if actual == 0 else 'settled'] += 1
+
+    def release(self, reservation):
+        self.settle(reservation, 0)
+
+    def used_today(self, scope, owner_ids):
+        if not owner_ids:
+            return {}
+        placeholders = ','.join('?' * len(owner_ids))
+        rows = self._connect().execute(
+            f'SELECT owner_id, used FROM quota_counters WHERE scope = ? AND day = ? AND owner_id IN ({placeholders})',
+            (scope, today(), *owner_ids)
+        ).fetchall()
+        return dict(rows)
+
+    def key_usage(self, api_keys):
+        used = self.used_today(SCOPE_KEY, [key.id for key in api_keys])
+        return {key.id: used.get(key.id, used_today_from_db(key)) for key in api_keys}
+
+    def user_usage(self, user_id):
+        return self.used_today(SCOPE_USER, [user_id]).get(user_id, 0)
+
+    def reset_key(self, key_id):
+        self._connect().execute(
+            'UPDATE quota_counters SET used = 0 WHERE scope = ? AND owner_id = ? AND day = ?',
+            (SCOPE_KEY, key_id, today())
+        )
+        self._exhausted.pop(key_id, None)
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats.update({
+            'pid': os.getpid(),
+            'enabled': self.enabled,
+            'path': self.path,
+            'day': today(),
+            'exhausted_keys': [key_id for key_id, entry in list(self._exhausted.items()) if entry[0] == today()]
+        })
+        return stats
+
+
+quota_store = QuotaStore()
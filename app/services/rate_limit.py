@@ -0,0 +1,180 @@
+import asyncio
+import math
+import os
+import sqlite3
+import threading
+import time
+
+
+class RateState:
+    # 一次检查后的令牌桶状态，用于生成 X-RateLimit-* 响应头
+    __slots__ = ('allowed', 'rpm', 'tpm', 'requests_left', 'tokens_left', 'retry_after')
+
+    def __init__(self, allowed, rpm, tpm, requests_left, tokens_left, retry_after=0):
+        self.allowed = allowed
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests_left = requests_left
+        self.tokens_left = tokens_left
+        self.retry_after = retry_after
+
+    def headers(self):
+        headers = {}
+        if self.rpm:
+            headers['X-RateLimit-Limit-Requests'] = str(self.rpm)
+            headers['X-RateLimit-Remaining-Requests'] = str(max(int(self.requests_left), 0))
+            headers['X-RateLimit-Reset-Requests'] = f'{max(self.rpm - self.requests_left, 0) * 60 / self.rpm:.1f}s'
+        if self.tpm:
+            headers['X-RateLimit-Limit-Tokens'] = str(self.tpm)
+            headers['X-RateLimit-Remaining-Tokens'] = str(max(int(self.tokens_left), 0))
+            headers['X-RateLimit-Reset-Tokens'] = f'{max(self.tpm - self.tokens_left, 0) * 60 / self.tpm:.1f}s'
+        if not self.allowed:
+            headers['Retry-After'] = str(max(math.ceil(self.retry_after), 1))
+        return headers
+
+
+class RateLimiter:
+    # 每分钟请求数/Token数的令牌桶保存在本机 SQLite 文件中，所有 worker 共享；桶容量为一分钟的额度，按秒匀速补充
+    def __init__(self, app=None):
+        self.enabled = True
+        self.path = None
+        self.max_wait = 0
+        self.default_user_rpm = 0
+        self.default_user_tpm = 0
+        self._local = threading.local()
+        self.counters = {'allowed': 0, 'limited_user': 0, 'limited_key': 0, 'waited': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('RATE_LIMIT_ENABLED', self.enabled)
+        self.max_wait = app.config.get('RATE_LIMIT_MAX_WAIT', self.max_wait)
+        self.default_user_rpm = app.config.get('RATE_LIMIT_DEFAULT_USER_RPM', self.default_user_rpm)
+        self.default_user_tpm = app.config.get('RATE_LIMIT_DEFAULT_USER_TPM', self.default_user_tpm)
+        self.path = app.config.get('RATE_LIMIT_STORE_PATH') or os.path.join(app.instance_path, 'ratelimit.db')
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._local = threading.local()
+        self._connect().execute(
+            'CREATE TABLE IF NOT EXISTS rate_buckets ('
+            'scope TEXT NOT NULL, owner_id INTEGER NOT NULL, kind TEXT NOT NULL, '
+            'level REAL NOT NULL, updated REAL NOT NULL, PRIMARY KEY (scope, owner_id, kind))'
+        )
+        app.extensions['rate_limiter'] = self
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def user_limits(self, rpm, tpm):
+        return rpm or self.default_user_rpm, tpm or self.default_user_tpm
+
+    @staticmethod
+    def _refill(conn, scope, owner_id, kind, limit, now):
+        row = conn.execute(
+            'SELECT level, updated FROM rate_buckets WHERE scope = ? AND owner_id = ? AND kind = ?',
+            (scope, owner_id, kind)
+        ).fetchone()
+        if row is None:
+            return float(limit)
+        level, updated = row
+        return min(float(limit), level + max(now - updated, 0) * limit / 60)
+
+    @staticmethod
+    def _store(conn, scope, owner_id, kind, level, now):
+        conn.execute(
+            'INSERT OR REPLACE INTO rate_buckets (scope, owner_id, kind, level, updated) VALUES (?, ?, ?, ?, ?)',
+            (scope, owner_id, kind, level, now)
+        )
+
+    def check(self, scope, owner_id, rpm, tpm, tokens):
+        # 请求桶至少剩1个、Token桶足够本次估算 (超过一分钟额度的大请求要求桶满) 时放行并扣除1个请求；
+        # Token 在请求完成后按实际用量扣除
+        if not self.enabled or not (rpm or tpm):
+            return None
+        conn = self._connect()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            requests_left = self._refill(conn, scope, owner_id, 'rpm', rpm, now) if rpm else 0
+            tokens_left = self._refill(conn, scope, owner_id, 'tpm', tpm, now) if tpm else 0
+            waits = []
+            if rpm and requests_left < 1:
+                waits.append((1 - requests_left) * 60 / rpm)
+            if tpm and tokens_left < min(tokens, tpm):
+                waits.append((min(tokens, tpm) - tokens_left) * 60 / tpm)
+            allowed = not waits
+            if allowed and rpm:
+                requests_left -= 1
+            if rpm:
+                self._store(conn, scope, owner_id, 'rpm', requests_left, now)
+            if tpm:
+                self._store(conn, scope, owner_id, 'tpm', tokens_left, now)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if allowed:
+            self.counters['allowed'] += 1
+        else:
+            self.counters[f'limited_{scope}'] += 1
+        return RateState(allowed, rpm, tpm, requests_left, tokens_left, max(waits, default=0))
+
+    def acquire(self, scope, owner_id, rpm, tpm, tokens, max_wait=None):
+        # 超限时在 max_wait 秒内排队等待，仍无法放行才拒绝
+        max_wait = self.max_wait if max_wait is None else max_wait
+        deadline = time.monotonic() + max_wait
+        state = self.check(scope, owner_id, rpm, tpm, tokens)
+        while state is not None and not state.allowed and time.monotonic() + state.retry_after <= deadline:
+            self.counters['waited'] += 1
+            time.sleep(state.retry_after)
+            state = self.check(scope, owner_id, rpm, tpm, tokens)
+        return state
+
+    async def acquire_async(self, scope, owner_id, rpm, tpm, tokens, max_wait=None, executor=None):
+        # ASGI 网关使用：check 是 BEGIN IMMEDIATE 事务，遇到写锁会等待，放到线程池中执行；排队时让出事件循环
+        if not self.enabled or not (rpm or tpm):
+            return None
+        loop = asyncio.get_running_loop()
+        max_wait = self.max_wait if max_wait is None else max_wait
+        deadline = time.monotonic() + max_wait
+        state = await loop.run_in_executor(executor, self.check, scope, owner_id, rpm, tpm, tokens)
+        while not state.allowed and time.monotonic() + state.retry_after <= deadline:
+            self.counters['waited'] += 1
+            await asyncio.sleep(state.retry_after)
+            state = await loop.run_in_executor(executor, self.check, scope, owner_id, rpm, tpm, tokens)
+        return state
+
+    def consume(self, scope, owner_id, tpm, tokens):
+        # 按实际用量扣除Token桶，允许透支，透支部分随时间补回后才会放行新请求
+        if not self.enabled or not tpm or not tokens:
+            return
+        conn = self._connect()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            level = self._refill(conn, scope, owner_id, 'tpm', tpm, now)
+            self._store(conn, scope, owner_id, 'tpm', level - tokens, now)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats.update({
+            'pid': os.getpid(),
+            'enabled': self.enabled,
+            'path': self.path,
+            'max_wait': self.max_wait,
+            'buckets': self._connect().execute('SELECT COUNT(*) FROM rate_buckets').fetchone()[0]
+        })
+        return stats
+
+
+rate_limiter = RateLimiter()
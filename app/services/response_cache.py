@@ -0,0 +1,203 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def request_fields(data):
+    # 除流式选项外的全部请求字段都可能影响输出 (tools、response_format、n、top_p、stop、seed 等)，都要计入缓存键
+    return {name: value for name, value in data.items() if name not in ('stream', 'stream_options')}
+
+
+def cache_key(provider, model, data):
+    canonical = json.dumps(
+        [provider, model, request_fields(data)],
+        sort_keys=True, ensure_ascii=False, separators=(',', ':')
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def encode_result(result):
+    usage = result.get('usage', {})
+    if 'body' in result:
+        # 透传的响应体直接拼进缓存值，不再解析
+        return b'{"response":' + result['body'] + b',"usage":' + json.dumps(usage).encode('utf-8') + b'}'
+    return json.dumps(
+        {'response': result['response'], 'usage': usage}, ensure_ascii=False, separators=(',', ':')
+    ).encode('utf-8')
+
+
+class MemoryCacheBackend:
+    # 进程内 LRU，同时受条目数、总字节数和 TTL 限制
+    def __init__(self, max_bytes, max_entries=10000):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at <= time.time():
+                self._remove(key)
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+            self._items[key] = (time.time() + ttl, value)
+            self.size += len(value)
+            while self.size > self.max_bytes or len(self._items) > self.max_entries:
+                self._remove(next(iter(self._items)))
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+
+    def _remove(self, key):
+        _, value = self._items.pop(key)
+        self.size -= len(value)
+
+    def stats(self):
+        return {'backend': 'memory', 'entries': len(self._items), 'bytes': self.size, 'max_bytes': self.max_bytes}
+
+
+class DiskCacheBackend:
+    # SQLite 文件存储，重启后缓存仍然有效，多个 worker 共享同一个文件
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS response_cache ('
+                'key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, '
+                'expires_at REAL NOT NULL, accessed_at REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_response_cache_accessed ON response_cache (accessed_at)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        conn = self._connect()
+        now = time.time()
+        row = conn.execute(
+            'SELECT value FROM response_cache WHERE key = ? AND expires_at > ?', (key, now)
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute('UPDATE response_cache SET accessed_at = ? WHERE key = ?', (now, key))
+        return row[0]
+
+    def set(self, key, value, ttl):
+        if len(value) > self.max_bytes:
+            return
+        conn = self._connect()
+        now = time.time()
+        conn.execute(
+            'INSERT OR REPLACE INTO response_cache (key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)',
+            (key, value, len(value), now + ttl, now)
+        )
+        self._evict(conn, now)
+
+    def _evict(self, conn, now):
+        conn.execute('DELETE FROM response_cache WHERE expires_at <= ?', (now,))
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM response_cache').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # 按最近访问时间淘汰，直到总大小回到上限以内
+        overflow = total - self.max_bytes
+        freed = 0
+        victims = []
+        for key, size in conn.execute('SELECT key, size FROM response_cache ORDER BY accessed_at'):
+            victims.append((key,))
+            freed += size
+            if freed >= overflow:
+                break
+        conn.executemany('DELETE FROM response_cache WHERE key = ?', victims)
+
+    def delete(self, key):
+        self._connect().execute('DELETE FROM response_cache WHERE key = ?', (key,))
+
+    def stats(self):
+        entries, size = self._connect().execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM response_cache'
+        ).fetchone()
+        return {'backend': 'disk', 'path': self.path, 'entries': entries, 'bytes': size, 'max_bytes': self.max_bytes}
+
+
+class ResponseCache:
+    def __init__(self, app=None):
+        self.enabled = False
+        self.ttl = 3600
+        self.backend = None
+        self.counters = {'hits': 0, 'misses': 0, 'stores': 0, 'bypassed': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('RESPONSE_CACHE_ENABLED', False)
+        self.ttl = app.config.get('RESPONSE_CACHE_TTL', self.ttl)
+        max_bytes = app.config.get('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+        if app.config.get('RESPONSE_CACHE_BACKEND', 'memory') == 'disk':
+            path = app.config.get('RESPONSE_CACHE_PATH') or os.path.join(app.instance_path, 'response_cache.db')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.backend = DiskCacheBackend(path, max_bytes)
+        else:
+            self.backend = MemoryCacheBackend(max_bytes, app.config.get('RESPONSE_CACHE_MAX_ENTRIES', 10000))
+        app.extensions['response_cache'] = self
+
+    def cache_mode(self, temperature, stream, cache_control):
+        # 返回 None 表示不使用缓存；'refresh' 表示跳过读取但写入新结果
+        if not self.enabled or stream or temperature != 0:
+            return None
+        directives = {d.strip().lower() for d in (cache_control or '').split(',')}
+        if 'no-store' in directives:
+            self.counters['bypassed'] += 1
+            return None
+        if 'no-cache' in directives:
+            self.counters['bypassed'] += 1
+            return 'refresh'
+        return 'use'
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self.counters['misses'] += 1
+            return None
+        self.counters['hits'] += 1
+        return json.loads(value)
+
+    def set(self, key, result):
+        self.backend.set(key, encode_result(result), self.ttl)
+        self.counters['stores'] += 1
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats.update(self.backend.stats() if self.backend else {})
+        stats.update({'enabled': self.enabled, 'ttl': self.ttl, 'pid': os.getpid()})
+        return stats
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,262 @@
+import csv
+import glob
+import gzip
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, select, text, tuple_
+
+from app.models import db, UsageRecord, UsageRollupDaily
+from app.services.rollups import day_bucket, rebuild
+
+try:
+    import fcntl
+except ImportError:  # Windows 开发环境只运行单进程
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_COLUMNS = [column.name for column in UsageRecord.__table__.columns]
+EXPORT_COLUMNS = [
+    'created_at', 'provider', 'model', 'prompt_tokens', 'completion_tokens', 'total_tokens',
+    'status', 'cache_hit', 'saved_tokens', 'is_hedge', 'request_time', 'upstream_status', 'error_message'
+]
+
+
+def parse_datetime(value):
+    return value if isinstance(value, datetime) else datetime.fromisoformat(value)
+
+
+class RetentionManager:
+    # 超过保留天数的原始记录先确认已汇总到按天的汇总表，再按天归档为 gzip CSV 文件后删除
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        self.days = 30
+        self.interval = 3600
+        self.batch_size = 5000
+        self.vacuum_pages = 1000
+        self.archive_dir = None
+        self.lock_file = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.counters = {'runs': 0, 'archived_days': 0, 'archived_rows': 0, 'deleted_rows': 0, 'reclaimed_pages': 0}
+        self.last_run = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('RETENTION_ENABLED', self.enabled)
+        self.days = max(1, app.config.get('RETENTION_DAYS', self.days))
+        self.interval = app.config.get('RETENTION_INTERVAL', self.interval)
+        self.batch_size = app.config.get('RETENTION_BATCH_SIZE', self.batch_size)
+        self.archive_dir = app.config.get('RETENTION_ARCHIVE_DIR') or os.path.join(
+            app.instance_path, 'archive', 'usage_records'
+        )
+        self.lock_file = os.path.join(app.instance_path, 'retention.lock')
+        app.extensions['retention'] = self
+        if self.enabled:
+            # 只在处理请求的进程中启动后台线程，flask 命令行和压测脚本不会启动
+            app.before_request(self._ensure_thread)
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='usage-retention', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    self.run_once()
+            except Exception:
+                logger.exception('用量记录归档失败')
+            time.sleep(self.interval)
+
+    def _acquire(self):
+        # 多个 worker 进程中只有拿到文件锁的那个执行归档
+        if fcntl is None:
+            return True, None
+        os.makedirs(os.path.dirname(self.lock_file), exist_ok=True)
+        handle = open(self.lock_file, 'w')
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            handle.close()
+            return False, None
+        return True, handle
+
+    def run_once(self, now=None, vacuum=False):
+        acquired, handle = self._acquire()
+        if not acquired:
+            return None
+        try:
+            cutoff = day_bucket(now or datetime.utcnow()) - timedelta(days=self.days)
+            archived = []
+            while True:
+                earliest = db.session.query(func.min(UsageRecord.created_at)).filter(
+                    UsageRecord.created_at < cutoff
+                ).scalar()
+                if earliest is None:
+                    break
+                day = day_bucket(earliest)
+                archived.append((day.strftime('%Y-%m-%d'), self.archive_day(day)))
+            self.reclaim_space(vacuum)
+            self.counters['runs'] += 1
+            self.last_run = datetime.utcnow()
+            return archived
+        finally:
+            if handle is not None:
+                handle.close()
+
+    def archive_day(self, day):
+        end = day + timedelta(days=1)
+        in_day = (UsageRecord.created_at >= day, UsageRecord.created_at < end)
+        raw_count, max_id = db.session.query(func.count(UsageRecord.id), func.max(UsageRecord.id)).filter(*in_day).one()
+        if not raw_count:
+            return 0
+
+        # 压缩：按天汇总行少于原始记录时 (例如升级前的历史数据) 先由原始记录重建当天的汇总；
+        # 被采样掉的失败没有原始记录，不参与比较
+        rolled_up = db.session.query(
+            func.coalesce(func.sum(UsageRollupDaily.requests - UsageRollupDaily.sampled_failures), 0)
+        ).filter(UsageRollupDaily.bucket == day).scalar()
+        if rolled_up < raw_count:
+            rebuild(day, end, self.batch_size)
+
+        written = self._write_archive(day, in_day, max_id)
+
+        deleted = 0
+        while True:
+            batch = select(UsageRecord.id).where(*in_day, UsageRecord.id <= max_id).limit(self.batch_size)
+            result = db.session.execute(delete(UsageRecord).where(UsageRecord.id.in_(batch.scalar_subquery())))
+            db.session.commit()
+            deleted += result.rowcount
+            if result.rowcount < self.batch_size:
+                break
+            time.sleep(0.01)
+
+        self.counters['archived_days'] += 1
+        self.counters['archived_rows'] += written
+        self.counters['deleted_rows'] += deleted
+        return deleted
+
+    def _day_files(self, day):
+        return sorted(glob.glob(os.path.join(self.archive_dir, day.strftime('%Y-%m'), day.strftime('%Y-%m-%d') + '_*.csv.gz')))
+
+    def _write_archive(self, day, in_day, max_id):
+        # 每天一个或多个文件，按月分目录；已归档过的ID会跳过，中断后重新执行不会产生重复行
+        archived_ids = set()
+        for path in self._day_files(day):
+            with gzip.open(path, 'rt', newline='', encoding='utf-8') as f:
+                archived_ids.update(int(row['id']) for row in csv.DictReader(f))
+
+        month_dir = os.path.join(self.archive_dir, day.strftime('%Y-%m'))
+        os.makedirs(month_dir, exist_ok=True)
+        tmp_path = os.path.join(month_dir, f'.{day:%Y-%m-%d}.{os.getpid()}.tmp')
+        columns = [UsageRecord.__table__.c[name] for name in ARCHIVE_COLUMNS]
+        written, first_id, last_id = 0, None, 0
+        with gzip.open(tmp_path, 'wt', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(ARCHIVE_COLUMNS)
+            while True:
+                rows = db.session.execute(
+                    select(*columns).where(*in_day, UsageRecord.id > last_id, UsageRecord.id <= max_id)
+                    .order_by(UsageRecord.id).limit(self.batch_size)
+                ).all()
+                if not rows:
+                    break
+                last_id = rows[-1].id
+                for row in rows:
+                    if row.id in archived_ids:
+                        continue
+                    first_id = first_id or row.id
+                    writer.writerow(['' if value is None else value for value in row])
+                    written += 1
+
+        if not written:
+            os.remove(tmp_path)
+            return 0
+        os.replace(tmp_path, os.path.join(month_dir, f'{day:%Y-%m-%d}_{first_id}-{last_id}.csv.gz'))
+        return written
+
+    def reclaim_space(self, vacuum=False):
+        engine = db.engine
+        if engine.dialect.name == 'postgresql':
+            with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+                conn.execute(text('VACUUM ANALYZE usage_records'))
+            return
+        if engine.dialect.name != 'sqlite':
+            return
+
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            if vacuum:
+                # 一次性转换为增量模式，整库 VACUUM 会锁库，只通过命令行执行
+                conn.execute(text('PRAGMA auto_vacuum = INCREMENTAL'))
+                conn.execute(text('VACUUM'))
+                return
+            if conn.execute(text('PRAGMA auto_vacuum')).scalar() != 2:
+                return
+            # 增量模式下分小步归还空闲页，每步只短暂持有写锁
+            while True:
+                free_pages = conn.execute(text('PRAGMA freelist_count')).scalar()
+                if not free_pages:
+                    break
+                conn.execute(text(f'PRAGMA incremental_vacuum({self.vacuum_pages})'))
+                self.counters['reclaimed_pages'] += min(free_pages, self.vacuum_pages)
+                time.sleep(0.05)
+
+    def iter_export(self, user_id, start, end):
+        # 先读取归档文件，再读取仍在数据库中的记录；归档后未及删除的记录按ID去重
+        exported_ids = set()
+        day = day_bucket(start)
+        while day < end:
+            for path in self._day_files(day):
+                with gzip.open(path, 'rt', newline='', encoding='utf-8') as f:
+                    for row in csv.DictReader(f):
+                        if int(row['user_id']) != user_id:
+                            continue
+                        if start <= parse_datetime(row['created_at']) < end:
+                            exported_ids.add(int(row['id']))
+                            yield row
+            day += timedelta(days=1)
+
+        columns = [UsageRecord.__table__.c[name] for name in EXPORT_COLUMNS]
+        last = (start, 0)
+        while True:
+            rows = db.session.execute(
+                select(UsageRecord.id, *columns).where(
+                    UsageRecord.user_id == user_id,
+                    UsageRecord.created_at < end,
+                    tuple_(UsageRecord.created_at, UsageRecord.id) > last
+                ).order_by(UsageRecord.created_at, UsageRecord.id).limit(self.batch_size)
+            ).all()
+            if not rows:
+                return
+            for row in rows:
+                if row.id not in exported_ids:
+                    yield row._asdict()
+            last = (rows[-1].created_at, rows[-1].id)
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats.update({
+            'pid': os.getpid(),
+            'enabled': self.enabled,
+            'days': self.days,
+            'archive_dir': self.archive_dir,
+            'last_run': self.last_run.isoformat() if self.last_run else None
+        })
+        return stats
+
+
+retention = RetentionManager()
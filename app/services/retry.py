@@ -0,0 +1,206 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import httpx
+import requests
+from urllib3.exceptions import NewConnectionError
+
+from app.services.metrics import metrics
+from app.services.upstream import UPSTREAM_TIMEOUT
+
+
+def transient(error):
+    # 只有请求还没发到上游时才能安全重试：建立连接失败或超时、等待连接池超时。
+    # 读超时、连接中途断开和响应体读取中断时上游可能已经开始生成并计费，重试会重复计费
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, (requests.Timeout, requests.exceptions.ChunkedEncodingError)):
+        return False
+    if isinstance(error, requests.ConnectionError):
+        # requests 把 urllib3 的异常放在 args[0]，连接失败时为 MaxRetryError(reason=NewConnectionError)
+        cause = error.args[0] if error.args else None
+        return isinstance(getattr(cause, 'reason', cause), NewConnectionError)
+    return isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+
+def parse_retry_after(headers):
+    # 上游要求的等待秒数: retry-after-ms 优先，Retry-After 可以是秒数或 HTTP 日期
+    value = headers.get('retry-after-ms')
+    if value:
+        try:
+            return max(float(value) / 1000, 0)
+        except ValueError:
+            pass
+    value = headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    # 同一个上游Key上的瞬时故障按指数退避加随机抖动重试；所有重试都在请求截止时间之内完成，
+    # 并受全局重试预算限制，上游大面积故障时不会因为重试成倍放大请求量
+    def __init__(self, app=None):
+        self.enabled = True
+        self.max_attempts = 3
+        self.base_delay = 0.2
+        self.max_delay = 5.0
+        self.deadline = UPSTREAM_TIMEOUT
+        self.status_codes = frozenset((408, 429, 500, 502, 503, 504))
+        self.budget_ratio = 0.2
+        self.budget_burst = 10
+        self._tokens = 0.0
+        self._lock = threading.Lock()
+        self.counters = {
+            'calls': 0, 'retries': 0, 'recovered': 0, 'budget_exhausted': 0,
+            'deadline_exceeded': 0, 'retry_after_too_long': 0
+        }
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('RETRY_ENABLED', self.enabled)
+        self.max_attempts = app.config.get('RETRY_MAX_ATTEMPTS', self.max_attempts)
+        self.base_delay = app.config.get('RETRY_BASE_DELAY', self.base_delay)
+        self.max_delay = app.config.get('RETRY_MAX_DELAY', self.max_delay)
+        self.deadline = app.config.get('RETRY_DEADLINE', self.deadline)
+        codes = app.config.get('RETRY_STATUS_CODES')
+        if codes is not None:
+            self.status_codes = frozenset(int(code) for code in str(codes).split(',') if code.strip())
+        self.budget_ratio = app.config.get('RETRY_BUDGET_RATIO', self.budget_ratio)
+        self.budget_burst = app.config.get('RETRY_BUDGET_BURST', self.budget_burst)
+        self._tokens = float(self.budget_burst)
+        app.extensions['retry_policy'] = self
+
+    def deadline_for(self, headers=None):
+        # 客户端通过 X-Request-Timeout (OpenAI SDK 为 X-Stainless-Timeout) 告知自己的超时秒数，
+        # 截止时间取它和 RETRY_DEADLINE 中较小的一个
+        timeout = self.deadline
+        if headers is not None:
+            value = headers.get('x-request-timeout') or headers.get('x-stainless-timeout')
+            try:
+                if value and float(value) > 0:
+                    timeout = min(timeout, float(value))
+            except ValueError:
+                pass
+        return time.monotonic() + timeout
+
+    @staticmethod
+    def remaining(deadline):
+        return max(deadline - time.monotonic(), 0)
+
+    def expired(self, deadline):
+        return deadline is not None and self.remaining(deadline) <= 0
+
+    def timeout(self, deadline):
+        # 单次上游调用的超时不超过剩余时间
+        return max(min(UPSTREAM_TIMEOUT, self.remaining(deadline)), 0.001)
+
+    def retryable(self, result):
+        # 网关自己拒绝的请求 (速率限制、配额、熔断) 和普通 4xx 不重试，交给故障转移处理
+        if result['success'] or 'rate_limited' in result or result.get('quota_exceeded') or result.get('circuit_open'):
+            return False
+        status_code = result.get('status_code')
+        if status_code is None:
+            return bool(result.get('retryable'))
+        return status_code in self.status_codes
+
+    def backoff(self, attempt):
+        # full jitter: 在 [0, base * 2^(attempt-1)] 内随机，避免多个请求同时重试
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def _deposit(self):
+        # 每次调用为预算存入 budget_ratio 个令牌，重试一次消耗一个
+        with self._lock:
+            self.counters['calls'] += 1
+            self._tokens = min(float(self.budget_burst), self._tokens + self.budget_ratio)
+
+    def _spend(self):
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                self.counters['retries'] += 1
+                return True
+            self.counters['budget_exhausted'] += 1
+            return False
+
+    def next_delay(self, result, attempt, deadline):
+        # 返回下一次重试前的等待秒数，不应重试时返回 None
+        if not self.enabled or attempt >= self.max_attempts or not self.retryable(result):
+            return None
+        retry_after = result.get('retry_after')
+        if retry_after is not None and retry_after > self.max_delay:
+            # 上游要求等待太久，直接转移到下一个Key
+            self.counters['retry_after_too_long'] += 1
+            return None
+        delay = max(retry_after or 0, self.backoff(attempt))
+        if delay >= self.remaining(deadline):
+            self.counters['deadline_exceeded'] += 1
+            return None
+        if not self._spend():
+            return None
+        return delay
+
+    def _retried(self, result, labels):
+        status_code = result.get('status_code')
+        metrics.inc('gateway_upstream_retries_total', reason=f'http_{status_code}' if status_code else 'exception',
+                    **labels)
+
+    def run(self, call, deadline, **labels):
+        # call(timeout) 执行一次上游调用并返回结果；labels 用于重试次数指标
+        self._deposit()
+        attempt = 1
+        result = call(self.timeout(deadline))
+        while True:
+            delay = self.next_delay(result, attempt, deadline)
+            if delay is None:
+                if attempt > 1 and result['success']:
+                    self.counters['recovered'] += 1
+                return result
+            self._retried(result, labels)
+            time.sleep(delay)
+            attempt += 1
+            result = call(self.timeout(deadline))
+
+    async def run_async(self, call, deadline, **labels):
+        # ASGI 网关使用：退避等待时让出事件循环
+        self._deposit()
+        attempt = 1
+        result = await call(self.timeout(deadline))
+        while True:
+            delay = self.next_delay(result, attempt, deadline)
+            if delay is None:
+                if attempt > 1 and result['success']:
+                    self.counters['recovered'] += 1
+                return result
+            self._retried(result, labels)
+            await asyncio.sleep(delay)
+            attempt += 1
+            result = await call(self.timeout(deadline))
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats.update({
+            'pid': os.getpid(),
+            'enabled': self.enabled,
+            'max_attempts': self.max_attempts,
+            'status_codes': sorted(self.status_codes),
+            'deadline': self.deadline,
+            'budget_ratio': self.budget_ratio,
+            'budget_tokens': round(self._tokens, 2)
+        })
+        return stats
+
+
+retry_policy = RetryPolicy()
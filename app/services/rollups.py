@@ -0,0 +1,136 @@
+from collections import defaultdict
+
+from sqlalchemy import and_, func, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from app.models import db, UsageRecord, UsageRollupHourly, UsageRollupDaily
+
+ROLLUP_MODELS = (UsageRollupHourly, UsageRollupDaily)
+KEY_FIELDS = ('bucket', 'user_id', 'api_key_id', 'provider', 'model')
+SUM_FIELDS = (
+    'requests', 'success_requests', 'failed_requests', 'cancelled_requests', 'prompt_tokens',
+    'completion_tokens', 'total_tokens', 'saved_tokens', 'latency_sum', 'sampled_failures', 'sampled_latency'
+)
+SAMPLED_FIELDS = ('sampled_failures', 'sampled_latency')
+
+
+def hour_bucket(created_at):
+    return created_at.replace(minute=0, second=0, microsecond=0)
+
+
+def day_bucket(created_at):
+    return created_at.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+BUCKETS = {UsageRollupHourly: hour_bucket, UsageRollupDaily: day_bucket}
+
+
+def aggregate(events):
+    # 把一批原始记录按 (时间桶, 用户, Key, 提供商, 模型) 合并，返回每张汇总表要累加的行
+    totals = {model: defaultdict(lambda: dict.fromkeys(SUM_FIELDS, 0)) for model in ROLLUP_MODELS}
+    for event in events:
+        # 未选到上游Key的失败记录不计入汇总表；count 为被采样掉的失败合并后的次数
+        if event['api_key_id'] is None:
+            continue
+        status = event.get('status', 'success')
+        count = event.get('count', 1)
+        sampled = event.get('sampled', False)
+        for model, bucket_of in BUCKETS.items():
+            key = (
+                bucket_of(event['created_at']), event['user_id'], event['api_key_id'],
+                event['provider'], event.get('model') or ''
+            )
+            row = totals[model][key]
+            row['requests'] += count
+            row['success_requests'] += count if status == 'success' else 0
+            row['cancelled_requests'] += count if status == 'cancelled' else 0
+            row['failed_requests'] += 0 if status in ('success', 'cancelled') else count
+            row['prompt_tokens'] += event.get('prompt_tokens') or 0
+            row['completion_tokens'] += event.get('completion_tokens') or 0
+            row['total_tokens'] += event.get('total_tokens') or 0
+            row['saved_tokens'] += event.get('saved_tokens') or 0
+            row['latency_sum'] += event.get('request_time') or 0
+            if sampled:
+                row['sampled_failures'] += count
+                row['sampled_latency'] += event.get('request_time') or 0
+    return {
+        model: [dict(zip(KEY_FIELDS, key), **sums) for key, sums in rows.items()]
+        for model, rows in totals.items()
+    }
+
+
+def _upsert(session, model, rows):
+    table = model.__table__
+    dialect = session.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        insert = (sqlite if dialect == 'sqlite' else postgresql).insert(table)
+        stmt = insert.on_conflict_do_update(
+            index_elements=list(KEY_FIELDS),
+            set_={field: table.c[field] + insert.excluded[field] for field in SUM_FIELDS}
+        )
+        session.execute(stmt, rows)
+        return
+
+    # 其他数据库先更新，未命中的行再插入
+    for row in rows:
+        updated = session.execute(
+            update(table).where(and_(*(table.c[f] == row[f] for f in KEY_FIELDS))).values(
+                {field: table.c[field] + row[field] for field in SUM_FIELDS}
+            )
+        ).rowcount
+        if not updated:
+            session.execute(table.insert(), [row])
+
+
+def apply_rollups(session, events):
+    for model, rows in aggregate(events).items():
+        if rows:
+            _upsert(session, model, rows)
+
+
+def rebuild(start=None, end=None, batch_size=5000, log=None):
+    # 清空 [start, end) 内的汇总行后由原始记录重建；start 为空时从最早的原始记录所在的那一天开始，
+    # 已归档删除的日期的汇总行保持不变。被采样掉的失败没有原始记录，只保留这部分计数。
+    # 清空和读取截止ID在同一事务中，之后写入的记录由 usage_writer 负责累加
+    if start is None:
+        earliest = db.session.query(func.min(UsageRecord.created_at)).scalar()
+        if earliest is None:
+            return 0
+        start = day_bucket(earliest)
+    for model in ROLLUP_MODELS:
+        query = db.session.query(model).filter(model.bucket >= start)
+        if end is not None:
+            query = query.filter(model.bucket < end)
+        query.filter(model.sampled_failures == 0).delete(synchronize_session=False)
+        reset = {field: 0 for field in SUM_FIELDS if field not in SAMPLED_FIELDS}
+        reset.update(
+            requests=model.sampled_failures, failed_requests=model.sampled_failures, latency_sum=model.sampled_latency
+        )
+        query.update(reset, synchronize_session=False)
+    max_id = db.session.query(func.max(UsageRecord.id)).scalar() or 0
+    db.session.commit()
+
+    columns = [UsageRecord.__table__.c[name] for name in (
+        'user_id', 'api_key_id', 'provider', 'model', 'prompt_tokens', 'completion_tokens',
+        'total_tokens', 'saved_tokens', 'request_time', 'status', 'created_at'
+    )]
+    conditions = [UsageRecord.id <= max_id, UsageRecord.created_at >= start]
+    if end is not None:
+        conditions.append(UsageRecord.created_at < end)
+    last_id, processed = 0, 0
+    while last_id < max_id:
+        rows = db.session.execute(
+            db.select(UsageRecord.id, *columns)
+            .where(UsageRecord.id > last_id, *conditions)
+            .order_by(UsageRecord.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        apply_rollups(db.session, [row._asdict() for row in rows])
+        db.session.commit()
+        last_id = rows[-1].id
+        processed += len(rows)
+        if log:
+            log(processed, max_id)
+    return processed
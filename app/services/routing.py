@@ -0,0 +1,157 @@
+import os
+import threading
+import time
+from collections import deque
+
+OUTCOME_SUCCESS = 'success'
+OUTCOME_ERROR = 'error'
+OUTCOME_RATE_LIMITED = 'rate_limited'
+
+
+class KeyStats:
+    # 单个上游Key的滚动窗口统计：延迟、错误和限流次数以及当前在途请求数
+    def __init__(self, window_size, window_seconds):
+        self.window_seconds = window_seconds
+        self.samples = deque(maxlen=window_size)
+        self.in_flight = 0
+
+    def _recent(self):
+        cutoff = time.monotonic() - self.window_seconds
+        while self.samples and self.samples[0][0] < cutoff:
+            self.samples.popleft()
+        return list(self.samples)
+
+    def add(self, latency, outcome):
+        self.samples.append((time.monotonic(), latency, outcome))
+
+    def percentile(self, q):
+        latencies = sorted(s[1] for s in self._recent() if s[2] == OUTCOME_SUCCESS)
+        if not latencies:
+            return None
+        index = min(len(latencies) - 1, int(q * len(latencies)))
+        return latencies[index]
+
+    def rates(self):
+        samples = self._recent()
+        if not samples:
+            return 0, 0.0, 0.0
+        errors = sum(1 for s in samples if s[2] == OUTCOME_ERROR)
+        limited = sum(1 for s in samples if s[2] == OUTCOME_RATE_LIMITED)
+        return len(samples), errors / len(samples), limited / len(samples)
+
+    def snapshot(self):
+        count, error_rate, rate_limited_rate = self.rates()
+        return {
+            'samples': count,
+            'in_flight': self.in_flight,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'error_rate': round(error_rate, 4),
+            'rate_limited_rate': round(rate_limited_rate, 4)
+        }
+
+
+class Router:
+    POLICIES = ('priority', 'latency', 'weighted_rr', 'least_inflight')
+
+    def __init__(self, app=None):
+        self.policy = 'priority'
+        self.window_size = 200
+        self.window_seconds = 300
+        self.unhealthy_error_rate = 0.5
+        self.min_samples = 5
+        self._stats = {}
+        self._rr_weights = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        policy = app.config.get('ROUTING_POLICY', self.policy)
+        if policy not in self.POLICIES:
+            raise ValueError(f'未知的路由策略: {policy}')
+        self.policy = policy
+        self.window_size = app.config.get('ROUTING_WINDOW_SIZE', self.window_size)
+        self.window_seconds = app.config.get('ROUTING_WINDOW_SECONDS', self.window_seconds)
+        self.unhealthy_error_rate = app.config.get('ROUTING_UNHEALTHY_ERROR_RATE', self.unhealthy_error_rate)
+        app.extensions['router'] = self
+
+    @staticmethod
+    def outcome(result):
+        if result['success']:
+            return OUTCOME_SUCCESS
+        if result.get('status_code') == 429:
+            return OUTCOME_RATE_LIMITED
+        return OUTCOME_ERROR
+
+    def stats_for(self, key_id):
+        stats = self._stats.get(key_id)
+        if stats is None:
+            with self._lock:
+                stats = self._stats.setdefault(key_id, KeyStats(self.window_size, self.window_seconds))
+        return stats
+
+    def begin(self, key_id):
+        stats = self.stats_for(key_id)
+        with self._lock:
+            stats.in_flight += 1
+        return time.monotonic()
+
+    def end(self, key_id, started, outcome):
+        stats = self.stats_for(key_id)
+        with self._lock:
+            stats.in_flight -= 1
+        stats.add(time.monotonic() - started, outcome)
+
+    def discard(self, key_id):
+        # 被取消的请求只减少在途计数，不计入延迟和错误统计
+        stats = self.stats_for(key_id)
+        with self._lock:
+            stats.in_flight -= 1
+
+    def is_unhealthy(self, key_id):
+        count, error_rate, rate_limited_rate = self.stats_for(key_id).rates()
+        return count >= self.min_samples and error_rate + rate_limited_rate >= self.unhealthy_error_rate
+
+    def order(self, user_id, keys):
+        # keys 已按 priority 降序排列；返回完整的故障转移顺序，不健康的Key排在最后
+        if self.policy == 'latency':
+            ordered = sorted(keys, key=lambda k: self.stats_for(k.id).percentile(0.5) or 0.0)
+        elif self.policy == 'least_inflight':
+            ordered = sorted(keys, key=lambda k: (
+                self.stats_for(k.id).in_flight, self.stats_for(k.id).percentile(0.5) or 0.0
+            ))
+        elif self.policy == 'weighted_rr':
+            ordered = self._weighted_round_robin(user_id, keys)
+        else:
+            ordered = list(keys)
+        healthy, unhealthy = [], []
+        for key in ordered:
+            (unhealthy if self.is_unhealthy(key.id) else healthy).append(key)
+        return healthy + unhealthy
+
+    def _weighted_round_robin(self, user_id, keys):
+        # 平滑加权轮询 (同 nginx)，权重取 priority，最小为1
+        if not keys:
+            return []
+        with self._lock:
+            current = self._rr_weights.setdefault(user_id, {})
+            total = 0
+            for key in keys:
+                weight = max(key.priority or 0, 1)
+                current[key.id] = current.get(key.id, 0) + weight
+                total += weight
+            chosen = max(keys, key=lambda k: current[k.id])
+            current[chosen.id] -= total
+        return [chosen] + [k for k in keys if k.id != chosen.id]
+
+    def stats(self):
+        return {
+            'pid': os.getpid(),
+            'policy': self.policy,
+            'keys': {key_id: stats.snapshot() for key_id, stats in list(self._stats.items())}
+        }
+
+
+router = Router()
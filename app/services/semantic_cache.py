@@ -0,0 +1,529 @@
+import atexit
+import hashlib
+import json
+import logging
+import math
+import mmap
+import operator
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from array import array
+from datetime import datetime, timedelta
+
+from app.services.http_pool import upstream_pool
+from app.services.metrics import metrics
+from app.services.quota import today
+from app.services.response_cache import encode_result
+
+logger = logging.getLogger(__name__)
+
+# 英文和数字按词切分，中日韩文字按字切分
+WORD_RE = re.compile(r'[a-z0-9]+|[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]')
+
+# LSH 参数: 每张表 8 个超平面、共 12 张表，相似度 0.9 的两条向量至少在一张表中落进同一个桶的概率约 98%
+LSH_TABLES = 12
+LSH_BITS = 8
+# 分区内条目不多时直接逐个比较，比计算签名更快
+BRUTE_FORCE_LIMIT = 64
+# 写入中途退出的进程留下的预留条目，超过这个时间 (秒) 后可以被回收
+RESERVATION_TIMEOUT = 60
+
+
+def last_user_text(messages):
+    # 返回 (最后一条用户消息的文本, 它在 messages 中的位置)
+    for index in range(len(messages) - 1, -1, -1):
+        message = messages[index]
+        if not isinstance(message, dict) or message.get('role') != 'user':
+            continue
+        content = message.get('content')
+        if isinstance(content, list):
+            content = ' '.join(
+                part['text'] for part in content if isinstance(part, dict) and isinstance(part.get('text'), str)
+            )
+        return (content if isinstance(content, str) else ''), index
+    return '', -1
+
+
+def normalize(vector):
+    norm = math.sqrt(sum(x * x for x in vector))
+    return [x / norm for x in vector] if norm else None
+
+
+def dot(a, b):
+    return sum(map(operator.mul, a, b))
+
+
+class HashingEmbedder:
+    # 本地向量: 单个词和相邻词对按特征哈希累加到固定维度，不需要模型文件和网络，
+    # 适合识别措辞、标点、大小写略有不同的重复提问。只看词面，改一个数字或加一个否定词相似度仍有 0.93 左右，
+    # 阈值低于 min_threshold 时不启用
+    min_threshold = 0.98
+
+    def __init__(self, dim):
+        self.dim = dim
+        self.name = f'hashing-{dim}'
+
+    def embed(self, text):
+        tokens = WORD_RE.findall(text.lower())
+        vector = [0.0] * self.dim
+        for feature in tokens + [f'{a} {b}' for a, b in zip(tokens, tokens[1:])]:
+            # crc32 在各进程间稳定，内置 hash() 每个进程不同
+            h = zlib.crc32(feature.encode('utf-8'))
+            vector[h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        return normalize(vector)
+
+
+class RemoteEmbedder:
+    # 配置的 OpenAI 兼容 embeddings 接口
+    min_threshold = 0
+
+    def __init__(self, url, model, api_key=None, timeout=2):
+        url = url.rstrip('/')
+        self.url = url if url.endswith('/embeddings') else f'{url}/embeddings'
+        self.model = model
+        self.timeout = timeout
+        self.name = f'remote-{model}'
+        self.headers = {'Content-Type': 'application/json'}
+        if api_key:
+            self.headers['Authorization'] = f'Bearer {api_key}'
+
+    def embed(self, text):
+        response = upstream_pool.post(
+            self.url, headers=self.headers, json={'model': self.model, 'input': text}, timeout=self.timeout
+        )
+        response.raise_for_status()
+        return normalize(response.json()['data'][0]['embedding'])
+
+
+class VectorIndex:
+    # 进程内的随机超平面 LSH 索引，按分区 (用户、模型、上下文) 分桶，分区之间互不可见
+    def __init__(self, dim, seed=0):
+        rng = random.Random(seed)
+        self.planes = [[[rng.gauss(0, 1) for _ in range(dim)] for _ in range(LSH_BITS)] for _ in range(LSH_TABLES)]
+        self.partitions = {}
+        self.buckets = {}
+        self.slots = {}
+
+    def signatures(self, vector):
+        # 本地特征哈希向量大多是稀疏的，只累加非零分量
+        nonzero = [(i, x) for i, x in enumerate(vector) if x]
+        if len(nonzero) * 4 < len(vector):
+            indices, values = zip(*nonzero)
+            vector = values
+            project = [[[plane[i] for i in indices] for plane in planes] for planes in self.planes]
+        else:
+            project = self.planes
+        return tuple(
+            sum(1 << bit for bit, plane in enumerate(planes) if dot(plane, vector) >= 0) for planes in project
+        )
+
+    def add(self, slot, version, partition, signatures):
+        self.remove(slot)
+        self.slots[slot] = (version, partition, signatures)
+        self.partitions.setdefault(partition, set()).add(slot)
+        for table, signature in enumerate(signatures):
+            self.buckets.setdefault((partition, table, signature), set()).add(slot)
+
+    def remove(self, slot):
+        entry = self.slots.pop(slot, None)
+        if entry is None:
+            return
+        _, partition, signatures = entry
+        slots = self.partitions[partition]
+        slots.discard(slot)
+        if not slots:
+            del self.partitions[partition]
+        for table, signature in enumerate(signatures):
+            key = (partition, table, signature)
+            bucket = self.buckets[key]
+            bucket.discard(slot)
+            if not bucket:
+                del self.buckets[key]
+
+    def candidates(self, partition, vector):
+        # 返回 [(slot, version)]
+        slots = self.partitions.get(partition)
+        if not slots:
+            return []
+        if len(slots) > BRUTE_FORCE_LIMIT:
+            found = set()
+            for table, signature in enumerate(self.signatures(vector)):
+                found.update(self.buckets.get((partition, table, signature), ()))
+            slots = found
+        return [(slot, self.slots[slot][0]) for slot in slots]
+
+    def __len__(self):
+        return len(self.slots)
+
+
+class Probe:
+    # 一次请求的语义缓存查询条件，查询未命中时用它写入上游的结果
+    __slots__ = ('user_id', 'partition', 'vector', 'started')
+
+    def __init__(self, user_id, partition, vector, started):
+        self.user_id = user_id
+        self.partition = partition
+        self.vector = vector
+        self.started = started
+
+
+class SemanticCache:
+    # 近似问题的响应缓存: 最后一条用户消息转成向量，在同一用户、同一模型、相同上下文的历史请求中找最相似的一条，
+    # 相似度达到阈值时直接返回它的响应。条目和响应保存在本机 SQLite 文件，向量保存在 mmap 映射的定长文件中，
+    # 所有 worker 共享；每个进程维护自己的 LSH 索引，按条目的版本号增量同步
+    def __init__(self, app=None):
+        self.enabled = False
+        self.threshold = 0.9
+        self.ttl = 86400
+        self.max_entries = 100000
+        self.max_entries_per_user = 1000
+        self.sync_interval = 1.0
+        self.stats_flush_interval = 5
+        self.stats_retention_days = 30
+        self.path = None
+        self.vector_path = None
+        self.embedder = None
+        self.dim = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._index = None
+        self._vectors = None
+        self._synced_version = 0
+        self._next_sync = 0
+        self._pending = {}
+        self._last_stats_flush = 0
+        self.counters = {'lookups': 0, 'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'bypassed': 0, 'errors': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('SEMANTIC_CACHE_ENABLED', self.enabled)
+        self.threshold = app.config.get('SEMANTIC_CACHE_THRESHOLD', self.threshold)
+        self.ttl = app.config.get('SEMANTIC_CACHE_TTL', self.ttl)
+        self.max_entries = app.config.get('SEMANTIC_CACHE_MAX_ENTRIES', self.max_entries)
+        self.max_entries_per_user = app.config.get('SEMANTIC_CACHE_MAX_ENTRIES_PER_USER', self.max_entries_per_user)
+        directory = app.config.get('SEMANTIC_CACHE_DIR') or os.path.join(app.instance_path, 'semantic_cache')
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, 'entries.db')
+        self.vector_path = os.path.join(directory, 'vectors.f32')
+        url = app.config.get('SEMANTIC_CACHE_EMBEDDING_URL')
+        if url:
+            self.embedder = RemoteEmbedder(
+                url, app.config.get('SEMANTIC_CACHE_EMBEDDING_MODEL', 'text-embedding-3-small'),
+                app.config.get('SEMANTIC_CACHE_EMBEDDING_KEY'), app.config.get('SEMANTIC_CACHE_EMBEDDING_TIMEOUT', 2)
+            )
+        else:
+            self.embedder = HashingEmbedder(app.config.get('SEMANTIC_CACHE_DIM', 256))
+        if self.enabled and self.threshold < self.embedder.min_threshold:
+            logger.warning(
+                '语义缓存未启用: 本地哈希向量要求 SEMANTIC_CACHE_THRESHOLD 不低于 %s (当前 %s)，'
+                '或配置 SEMANTIC_CACHE_EMBEDDING_URL', self.embedder.min_threshold, self.threshold
+            )
+            self.enabled = False
+        self._local = threading.local()
+        self._pid = None
+        self.dim = None
+        if self.enabled:
+            conn = self._connect()
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS semantic_entries ('
+                'slot INTEGER PRIMARY KEY, version INTEGER, user_id INTEGER NOT NULL, partition TEXT NOT NULL, '
+                'signatures TEXT NOT NULL, value BLOB NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL, '
+                'hits INTEGER NOT NULL DEFAULT 0)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_semantic_entries_version ON semantic_entries (version)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_semantic_entries_user ON semantic_entries (user_id, accessed_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_semantic_entries_accessed ON semantic_entries (accessed_at)')
+            conn.execute('CREATE TABLE IF NOT EXISTS semantic_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS semantic_stats ('
+                'user_id INTEGER NOT NULL, day TEXT NOT NULL, lookups INTEGER NOT NULL, hits INTEGER NOT NULL, '
+                'lookup_seconds REAL NOT NULL, PRIMARY KEY (user_id, day))'
+            )
+            cutoff = (datetime.utcnow() - timedelta(days=self.stats_retention_days)).strftime('%Y-%m-%d')
+            conn.execute('DELETE FROM semantic_stats WHERE day < ?', (cutoff,))
+            # 调小上限后，超出范围的槽位直接丢弃
+            conn.execute('DELETE FROM semantic_entries WHERE slot >= ?', (self.max_entries,))
+        app.extensions['semantic_cache'] = self
+        atexit.register(self._flush_stats)
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _storage(self, conn, dim):
+        # 向量文件按 max_entries 个定长槽位分配，只增不减 (其他进程可能正映射着)；
+        # 向量维度或 embedding 模型变化时清空条目。fork 之后子进程重新映射文件、从头同步索引
+        if self._pid == os.getpid() and self.dim == dim:
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self.dim == dim:
+                return
+            signature = f'{self.embedder.name}:{dim}'
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute("SELECT value FROM semantic_meta WHERE key = 'embedder'").fetchone()
+                if row is None or row[0] != signature:
+                    conn.execute('DELETE FROM semantic_entries')
+                    conn.execute("INSERT OR REPLACE INTO semantic_meta (key, value) VALUES ('embedder', ?)", (signature,))
+                size = self.max_entries * dim * 4
+                with open(self.vector_path, 'a+b') as f:
+                    if os.fstat(f.fileno()).st_size < size:
+                        f.truncate(size)
+                    self._vectors = mmap.mmap(f.fileno(), size)
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            self._index = VectorIndex(dim)
+            self._synced_version = 0
+            self._next_sync = 0
+            self._pending = {}
+            self.dim = dim
+            self._pid = os.getpid()
+
+    def _read(self, slot):
+        size = self.dim * 4
+        return array('f', self._vectors[slot * size:(slot + 1) * size])
+
+    def _write(self, slot, vector):
+        size = self.dim * 4
+        self._vectors[slot * size:(slot + 1) * size] = array('f', vector).tobytes()
+
+    def _sync(self, conn):
+        # 只读取上次同步之后写完的条目；槽位被复用时新版本覆盖旧版本。LSH 签名在写入时算好，同步时不读向量
+        if time.monotonic() < self._next_sync:
+            return
+        with self._lock:
+            if time.monotonic() < self._next_sync:
+                return
+            rows = conn.execute(
+                'SELECT slot, version, partition, signatures FROM semantic_entries WHERE version > ? ORDER BY version',
+                (self._synced_version,)
+            ).fetchall()
+            for slot, version, partition, signatures in rows:
+                self._index.add(slot, version, partition, tuple(map(int, signatures.split(','))))
+                self._synced_version = version
+            self._next_sync = time.monotonic() + self.sync_interval
+
+    def cache_mode(self, stream, cache_control, header=None):
+        # 与响应缓存相同: None 表示不使用，'refresh' 表示跳过读取但写入新结果；请求头 X-Semantic-Cache: off 单独关闭
+        if not self.enabled or stream:
+            return None
+        directives = {d.strip().lower() for d in (cache_control or '').split(',')}
+        if 'no-store' in directives or (header or '').lower() == 'off':
+            self.counters['bypassed'] += 1
+            return None
+        if 'no-cache' in directives:
+            self.counters['bypassed'] += 1
+            return 'refresh'
+        return 'use'
+
+    def probe(self, user_id, model, messages, params=None):
+        # 最后一条用户消息之外的内容 (系统提示词、历史对话) 和其余请求参数 (max_tokens、tools 等) 必须完全相同
+        started = time.perf_counter()
+        text, index = last_user_text(messages)
+        if not text.strip():
+            return None
+        params = {name: value for name, value in (params or {}).items() if name != 'messages'}
+        context = hashlib.sha256(json.dumps(
+            [messages[:index], messages[index + 1:], params], sort_keys=True, ensure_ascii=False
+        ).encode('utf-8')).hexdigest()[:32]
+        try:
+            vector = self.embedder.embed(text)
+        except Exception as e:
+            self.counters['errors'] += 1
+            metrics.inc('gateway_semantic_cache_lookups_total', result='error')
+            logger.warning('语义缓存生成向量失败: %s', e)
+            return None
+        if vector is None:
+            return None
+        return Probe(user_id, f'{user_id}:{model}:{context}', vector, started)
+
+    def lookup(self, probe):
+        hit = None
+        try:
+            conn = self._connect()
+            self._storage(conn, len(probe.vector))
+            self._sync(conn)
+            with self._lock:
+                candidates = self._index.candidates(probe.partition, probe.vector)
+            scored = sorted(
+                ((dot(probe.vector, self._read(slot)), slot, version) for slot, version in candidates), reverse=True
+            )
+            now = time.time()
+            for similarity, slot, version in scored:
+                if similarity < self.threshold:
+                    break
+                # 槽位可能已被其他进程复用，按版本号确认仍是同一条目
+                row = conn.execute(
+                    'SELECT value FROM semantic_entries WHERE slot = ? AND version = ? AND created_at > ?',
+                    (slot, version, now - self.ttl)
+                ).fetchone()
+                if row is not None:
+                    conn.execute(
+                        'UPDATE semantic_entries SET accessed_at = ?, hits = hits + 1 WHERE slot = ? AND version = ?',
+                        (now, slot, version)
+                    )
+                    hit = json.loads(row[0])
+                    hit['similarity'] = similarity
+                    break
+        except Exception as e:
+            self.counters['errors'] += 1
+            logger.warning('语义缓存查询失败: %s', e)
+        self._record_lookup(probe, hit is not None, time.perf_counter() - probe.started)
+        return hit
+
+    def store(self, probe, result):
+        try:
+            conn = self._connect()
+            self._storage(conn, len(probe.vector))
+            value = encode_result(result)
+            signatures = ','.join(map(str, self._index.signatures(probe.vector)))
+            # 先预留槽位 (版本号为空)，写完向量后再分配版本号，读取方只会看到写完的条目
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                now = time.time()
+                slot, evicted = self._allocate(conn, probe.user_id, now)
+                if slot is not None:
+                    conn.execute(
+                        'INSERT OR REPLACE INTO semantic_entries '
+                        '(slot, version, user_id, partition, signatures, value, created_at, accessed_at) '
+                        'VALUES (?, NULL, ?, ?, ?, ?, ?, ?)',
+                        (slot, probe.user_id, probe.partition, signatures, value, now, now)
+                    )
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            if slot is None:
+                return
+            self._write(slot, probe.vector)
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                version = conn.execute('SELECT COALESCE(MAX(version), 0) + 1 FROM semantic_entries').fetchone()[0]
+                conn.execute(
+                    'UPDATE semantic_entries SET version = ? WHERE slot = ? AND version IS NULL AND created_at = ?',
+                    (version, slot, now)
+                )
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            self.counters['stores'] += 1
+            self.counters['evictions'] += evicted
+            self._next_sync = 0
+        except Exception as e:
+            self.counters['errors'] += 1
+            logger.warning('语义缓存写入失败: %s', e)
+
+    def _allocate(self, conn, user_id, now):
+        # 返回 (槽位, 是否淘汰了未过期的条目)。依次复用: 过期条目、该用户最久未访问的条目 (达到单用户上限时)、
+        # 全局最久未访问的条目 (达到总上限时)，否则使用下一个空槽位
+        ready = '(version IS NOT NULL OR created_at < ?)'
+        stale = now - RESERVATION_TIMEOUT
+        row = conn.execute(
+            f'SELECT slot FROM semantic_entries WHERE created_at < ? AND {ready} ORDER BY accessed_at LIMIT 1',
+            (now - self.ttl, stale)
+        ).fetchone()
+        if row is not None:
+            return row[0], False
+        count = conn.execute('SELECT COUNT(*) FROM semantic_entries WHERE user_id = ?', (user_id,)).fetchone()[0]
+        if count >= self.max_entries_per_user:
+            row = conn.execute(
+                f'SELECT slot FROM semantic_entries WHERE user_id = ? AND {ready} ORDER BY accessed_at LIMIT 1',
+                (user_id, stale)
+            ).fetchone()
+            return (row[0], True) if row is not None else (None, False)
+        # 条目从不删除，只复用槽位，已用的槽位始终连续
+        total = conn.execute('SELECT COALESCE(MAX(slot) + 1, 0) FROM semantic_entries').fetchone()[0]
+        if total < self.max_entries:
+            return total, False
+        row = conn.execute(
+            f'SELECT slot FROM semantic_entries WHERE {ready} ORDER BY accessed_at LIMIT 1', (stale,)
+        ).fetchone()
+        return (row[0], True) if row is not None else (None, False)
+
+    def _record_lookup(self, probe, hit, seconds):
+        self.counters['lookups'] += 1
+        self.counters['hits' if hit else 'misses'] += 1
+        metrics.inc('gateway_semantic_cache_lookups_total', result='hit' if hit else 'miss')
+        metrics.observe('gateway_semantic_cache_lookup_seconds', seconds)
+        # 按用户、按天的命中统计先在进程内累计，定期合并到 SQLite
+        key = (probe.user_id, today())
+        with self._lock:
+            pending = self._pending.setdefault(key, [0, 0, 0.0])
+            pending[0] += 1
+            pending[1] += int(hit)
+            pending[2] += seconds
+        if time.monotonic() - self._last_stats_flush >= self.stats_flush_interval:
+            self._flush_stats()
+
+    def _flush_stats(self):
+        self._last_stats_flush = time.monotonic()
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending or self.path is None:
+            return
+        try:
+            self._connect().executemany(
+                'INSERT INTO semantic_stats (user_id, day, lookups, hits, lookup_seconds) VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT (user_id, day) DO UPDATE SET lookups = lookups + excluded.lookups, '
+                'hits = hits + excluded.hits, lookup_seconds = lookup_seconds + excluded.lookup_seconds',
+                [(user_id, day, *values) for (user_id, day), values in pending.items()]
+            )
+        except sqlite3.Error as e:
+            logger.warning('语义缓存统计写入失败: %s', e)
+
+    def user_stats(self, user_id):
+        # 仪表盘使用: 当天的查询次数、命中率、平均查询耗时和该用户的缓存条目数
+        self._flush_stats()
+        conn = self._connect()
+        lookups, hits, seconds = conn.execute(
+            'SELECT lookups, hits, lookup_seconds FROM semantic_stats WHERE user_id = ? AND day = ?',
+            (user_id, today())
+        ).fetchone() or (0, 0, 0.0)
+        entries = conn.execute(
+            'SELECT COUNT(*) FROM semantic_entries WHERE user_id = ? AND version IS NOT NULL AND created_at > ?',
+            (user_id, time.time() - self.ttl)
+        ).fetchone()[0]
+        return {
+            'lookups': lookups,
+            'hits': hits,
+            'hit_rate': round(hits / lookups * 100, 1) if lookups else 0,
+            'avg_lookup_ms': round(seconds / lookups * 1000, 2) if lookups else 0,
+            'entries': entries
+        }
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats.update({
+            'pid': os.getpid(),
+            'enabled': self.enabled,
+            'embedder': self.embedder.name if self.embedder else None,
+            'threshold': self.threshold,
+            'ttl': self.ttl,
+            'max_entries': self.max_entries,
+            'max_entries_per_user': self.max_entries_per_user,
+            'indexed': len(self._index) if self._index is not None else 0
+        })
+        if self.enabled:
+            stats['entries'] = self._connect().execute(
+                'SELECT COUNT(*) FROM semantic_entries WHERE version IS NOT NULL'
+            ).fetchone()[0]
+        return stats
+
+
+semantic_cache = SemanticCache()
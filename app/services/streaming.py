@@ -0,0 +1,215 @@
+import json
+import time
+import uuid
+
+DONE_EVENT = 'data: [DONE]\n\n'
+
+
+def sse_event(payload):
+    return f'data: {json.dumps(payload, ensure_ascii=False)}\n\n'
+
+
+def sse_data(line):
+    if line and line.startswith('data:'):
+        return line[5:].strip()
+    return None
+
+
+def make_chunk(chunk_id, model, delta=None, finish_reason=None, usage=None):
+    chunk = {
+        'id': chunk_id,
+        'object': 'chat.completion.chunk',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [] if delta is None else [{
+            'index': 0,
+            'delta': delta,
+            'finish_reason': finish_reason
+        }]
+    }
+    if usage is not None:
+        chunk['usage'] = usage
+    return chunk
+
+
+class StreamRelay:
+    # 逐个接收上游 SSE 的 data 字段，输出 OpenAI 格式的 SSE 事件
+    def __init__(self, model):
+        self.model = model
+        self.usage = {}
+        self.done = False
+        # 转发的内容事件数，流中断、上游还没发送 usage 时用来估算输出 Token
+        self.events = 0
+        self.chunk_id = f'chatcmpl-{uuid.uuid4().hex}'
+
+    def feed(self, data):
+        return []
+
+    def finish(self):
+        return [DONE_EVENT]
+
+
+class OpenAIStreamRelay(StreamRelay):
+    # OpenAI兼容的提供商直接透传，只在包含usage的事件上解析JSON
+    def feed(self, data):
+        if data == '[DONE]':
+            self.done = True
+            return []
+        self.events += 1
+        if '"usage"' in data:
+            self.update_usage(json.loads(data))
+        return [f'data: {data}\n\n']
+
+    def update_usage(self, event):
+        usage = event.get('usage')
+        if not usage and event.get('choices'):
+            usage = event['choices'][0].get('usage')
+        if usage:
+            self.usage.update(usage)
+
+
+class PassthroughRelay(OpenAIStreamRelay):
+    # 透传模式: 上游的字节原样转发，不按行解码再编码；只解析带有非空 usage 的事件
+    def __init__(self, model):
+        super().__init__(model)
+        self._partial = b''
+
+    def feed_bytes(self, chunk):
+        buffer = self._partial + chunk if self._partial else chunk
+        end = buffer.rfind(b'\n') + 1
+        self._partial = buffer[end:]
+        self.events += chunk.count(b'data:')
+        if buffer.find(b'"usage"', 0, end) >= 0 or buffer.find(b'[DONE]', 0, end) >= 0:
+            for line in buffer[:end].split(b'\n'):
+                if not line.startswith(b'data:'):
+                    continue
+                data = line[5:].strip()
+                if data == b'[DONE]':
+                    self.done = True
+                elif b'"usage"' in data and b'"usage":null' not in data and b'"usage": null' not in data:
+                    self.update_usage(json.loads(data))
+        return chunk
+
+    def finish_bytes(self):
+        # 上游没有发送 [DONE] 时补上
+        return [] if self.done else [DONE_EVENT.encode()]
+
+
+class AnthropicStreamRelay(StreamRelay):
+    prompt_tokens = 0
+    completion_tokens = 0
+
+    def feed(self, data):
+        event = json.loads(data)
+        event_type = event.get('type')
+        if event_type == 'message_start':
+            usage = event['message'].get('usage', {})
+            self.prompt_tokens = usage.get('input_tokens', 0)
+            self.completion_tokens = usage.get('output_tokens', 0)
+            self.update_usage()
+            return [sse_event(make_chunk(self.chunk_id, self.model, {'role': 'assistant', 'content': ''}))]
+        if event_type == 'content_block_delta':
+            text = event.get('delta', {}).get('text')
+            if text:
+                self.events += 1
+                return [sse_event(make_chunk(self.chunk_id, self.model, {'content': text}))]
+        elif event_type == 'message_delta':
+            self.completion_tokens = event.get('usage', {}).get('output_tokens', self.completion_tokens)
+            self.update_usage()
+            stop_reason = event.get('delta', {}).get('stop_reason')
+            finish_reason = 'length' if stop_reason == 'max_tokens' else 'stop'
+            return [sse_event(make_chunk(self.chunk_id, self.model, {}, finish_reason))]
+        elif event_type == 'error':
+            self.done = True
+            return [sse_event({'error': event.get('error', {})})]
+        elif event_type == 'message_stop':
+            self.done = True
+        return []
+
+    def update_usage(self):
+        # 每次收到计数就更新，流中途断开时也有已知的用量
+        self.usage.update({
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+            'total_tokens': self.prompt_tokens + self.completion_tokens
+        })
+
+    def finish(self):
+        self.update_usage()
+        return [sse_event(make_chunk(self.chunk_id, self.model, usage=dict(self.usage))), DONE_EVENT]
+
+
+class QwenStreamRelay(StreamRelay):
+    # 需要开启 incremental_output，DashScope 每个事件只返回新增文本，usage 为累计值
+    def feed(self, data):
+        event = json.loads(data)
+        if 'code' in event and 'output' not in event:
+            self.done = True
+            return [sse_event({'error': {'code': event['code'], 'message': event.get('message')}})]
+        usage = event.get('usage')
+        if usage:
+            prompt_tokens = usage.get('input_tokens', 0)
+            completion_tokens = usage.get('output_tokens', 0)
+            self.usage.update({
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': usage.get('total_tokens', prompt_tokens + completion_tokens)
+            })
+        output = event.get('output', {})
+        finish_reason = output.get('finish_reason')
+        if finish_reason in (None, 'null'):
+            finish_reason = None
+        text = output.get('text')
+        if text:
+            self.events += 1
+        if text or finish_reason:
+            return [sse_event(make_chunk(self.chunk_id, self.model, {'content': text or ''}, finish_reason))]
+        return []
+
+    def finish(self):
+        return [sse_event(make_chunk(self.chunk_id, self.model, usage=dict(self.usage))), DONE_EVENT]
+
+
+def relay_stream(response, relay):
+    try:
+        for line in response.iter_lines(decode_unicode=True):
+            data = sse_data(line)
+            if data is None:
+                continue
+            yield from relay.feed(data)
+            if relay.done:
+                break
+        yield from relay.finish()
+    finally:
+        response.close()
+
+
+def open_stream(response, relay):
+    return {
+        'success': True,
+        'stream': relay_stream(response, relay),
+        'relay': relay,
+        'usage': relay.usage
+    }
+
+
+def passthrough_stream(response, relay):
+    # 分块传输时每收到一块就转发；没有分块的响应按 512 字节读取，与逐行读取时的延迟相同
+    chunk_size = None if getattr(response.raw, 'chunked', False) else 512
+    try:
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            yield relay.feed_bytes(chunk)
+            if relay.done:
+                break
+        yield from relay.finish_bytes()
+    finally:
+        response.close()
+
+
+def open_passthrough_stream(response, relay):
+    return {
+        'success': True,
+        'stream': passthrough_stream(response, relay),
+        'relay': relay,
+        'usage': relay.usage
+    }
@@ -0,0 +1,253 @@
+import json
+import logging
+import math
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# 每条消息的格式开销和回复的起始标记 (与 OpenAI 的计算方式一致)
+MESSAGE_OVERHEAD = 4
+REPLY_OVERHEAD = 3
+# 图片按高清模式的典型值计算
+IMAGE_TOKENS = 765
+
+# 按模型名前缀识别分词器家族，匹配不到时按服务商
+FAMILY_PREFIXES = (
+    ('gpt-4o', 'o200k'), ('gpt-4.1', 'o200k'), ('gpt-5', 'o200k'), ('chatgpt-4o', 'o200k'),
+    ('o1', 'o200k'), ('o3', 'o200k'), ('o4', 'o200k'),
+    ('gpt-', 'cl100k'), ('text-embedding', 'cl100k'),
+    ('claude', 'anthropic'), ('gemini', 'gemini'),
+    ('qwen', 'cjk'), ('deepseek', 'cjk'), ('glm', 'cjk'), ('moonshot', 'cjk'), ('kimi', 'cjk'), ('abab', 'cjk'),
+)
+FAMILY_BY_PROVIDER = {
+    'openai': 'cl100k', 'azure': 'cl100k', 'local': 'cl100k', 'anthropic': 'anthropic', 'google': 'gemini',
+    'moonshot': 'cjk', 'zhipu': 'cjk', 'deepseek': 'cjk', 'qwen': 'cjk', 'minimax': 'cjk'
+}
+
+# 有公开词表的家族用 tiktoken 精确计数
+ENCODINGS = {'cl100k': 'cl100k_base', 'o200k': 'o200k_base'}
+
+# 没有词表时的估算系数: (每个Token对应的ASCII字符数, 每个中日韩字符的Token数, 其他非ASCII字符的Token数)
+# cjk 指针对中文优化过词表的国产模型
+HEURISTICS = {
+    'cl100k': (4.0, 1.2, 1.0),
+    'o200k': (4.2, 0.8, 0.9),
+    'anthropic': (3.5, 1.4, 1.2),
+    'gemini': (4.0, 0.9, 1.0),
+    'cjk': (3.8, 0.65, 1.0),
+}
+
+# 模型上下文长度 (Token)，按最长前缀匹配；宁大勿小，拿不准的模型不做检查
+CONTEXT_WINDOWS = {
+    'gpt-3.5-turbo': 16385, 'gpt-35-turbo': 16385,
+    'gpt-4': 8192, 'gpt-4-32k': 32768, 'gpt-4-turbo': 128000, 'gpt-4-1106': 128000, 'gpt-4-0125': 128000,
+    'gpt-4o': 128000, 'gpt-4.1': 1047576, 'gpt-5': 400000, 'chatgpt-4o': 128000,
+    'o1': 200000, 'o3': 200000, 'o4-mini': 200000,
+    'claude': 200000,
+    'gemini-pro': 32760, 'gemini-1.0-pro': 32760, 'gemini-1.5': 1048576, 'gemini-2': 1048576,
+    'moonshot-v1-8k': 8192, 'moonshot-v1-32k': 32768, 'moonshot-v1-128k': 131072,
+    'glm-4': 128000, 'deepseek': 131072,
+    'qwen-turbo': 131072, 'qwen-plus': 131072, 'qwen-max': 32768, 'qwen-long': 10000000,
+    'abab': 245760,
+}
+
+
+def tiktoken_available():
+    try:
+        import tiktoken  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def parse_windows(value):
+    # "model=tokens,prefix=tokens"
+    windows = {}
+    for item in (value or '').split(','):
+        name, _, tokens = item.partition('=')
+        if name.strip() and tokens.strip():
+            windows[name.strip()] = int(tokens)
+    return windows
+
+
+def text_features(text):
+    # 统计 (ASCII字符数, 中日韩字符数, 其他字符数)。不逐字符扫描，只用 C 实现的编码长度推算:
+    # UTF-8 下 3 字节的字符 (U+0800-U+FFFF) 基本是中日韩文字和全角符号，UTF-16 多出的长度是 4 字节字符的个数
+    if text.isascii():
+        return len(text), 0, 0
+    length = len(text)
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    wide_chars = len(text.encode('utf-16-le')) // 2 - length
+    extra_bytes = len(text.encode('utf-8')) - length
+    # 非 ASCII 字符中: 2 字节的多 1 字节，3 字节的多 2 字节，4 字节的多 3 字节
+    cjk_chars = extra_bytes - 3 * wide_chars - (length - ascii_chars - wide_chars)
+    return ascii_chars, cjk_chars, length - ascii_chars - cjk_chars
+
+
+def message_texts(messages):
+    # 返回 (需要计数的文本, 图片数)
+    texts, images = [], 0
+    for message in messages:
+        if not isinstance(message, dict):
+            continue
+        content = message.get('content')
+        if isinstance(content, str):
+            texts.append(content)
+        elif isinstance(content, list):
+            for part in content:
+                if not isinstance(part, dict):
+                    continue
+                if isinstance(part.get('text'), str):
+                    texts.append(part['text'])
+                elif part.get('type') in ('image_url', 'image', 'input_image'):
+                    images += 1
+        if isinstance(message.get('name'), str):
+            texts.append(message['name'])
+        if message.get('tool_calls'):
+            texts.append(json.dumps(message['tool_calls'], ensure_ascii=False))
+    return texts, images
+
+
+class TokenEstimator:
+    # 网关侧的 Token 估算: 有 tiktoken 时 OpenAI 模型用真实词表计数 (词表首次用到时在后台加载)，
+    # 其余情况按分词器家族的字符类别系数估算。结果用于速率限制、配额预留和上下文长度检查
+    def __init__(self, app=None):
+        self.backend = 'auto'
+        self.default_completion_tokens = 256
+        self.tolerance = 0.1
+        self.cache_size = 4096
+        self.cache_min_chars = 256
+        self.windows = dict(CONTEXT_WINDOWS)
+        self._encodings = {}
+        self._loading = set()
+        self._cache = {}
+        self._window_cache = {}
+        self._lock = threading.Lock()
+        self.counters = {'estimates': 0, 'exact': 0, 'cache_hits': 0, 'keys_skipped': 0, 'context_rejected': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.backend = app.config.get('TOKEN_ESTIMATOR', self.backend)
+        if self.backend == 'auto' and not tiktoken_available():
+            self.backend = 'heuristic'
+        self.default_completion_tokens = app.config.get(
+            'QUOTA_DEFAULT_COMPLETION_TOKENS', self.default_completion_tokens
+        )
+        self.tolerance = app.config.get('TOKEN_ESTIMATE_TOLERANCE', self.tolerance)
+        self.cache_size = app.config.get('TOKEN_CACHE_SIZE', self.cache_size)
+        self.windows = dict(CONTEXT_WINDOWS, **parse_windows(app.config.get('MODEL_CONTEXT_WINDOWS')))
+        self._cache = {}
+        self._window_cache = {}
+        app.extensions['token_estimator'] = self
+
+    @staticmethod
+    def family(provider=None, model=None):
+        name = (model or '').lower()
+        for prefix, family in FAMILY_PREFIXES:
+            if name.startswith(prefix):
+                return family
+        return FAMILY_BY_PROVIDER.get(provider, 'cl100k')
+
+    def _encoding(self, family):
+        # 词表在后台线程加载 (可能需要下载)，加载完成前先用估算
+        name = ENCODINGS.get(family)
+        if name is None or self.backend == 'heuristic':
+            return None
+        encoding = self._encodings.get(name)
+        if encoding is None and name not in self._loading:
+            with self._lock:
+                if name not in self._loading:
+                    self._loading.add(name)
+                    threading.Thread(target=self._load, args=(name,), name='tokenizer-load', daemon=True).start()
+        return encoding
+
+    def _load(self, name):
+        try:
+            import tiktoken
+            self._encodings[name] = tiktoken.get_encoding(name)
+        except Exception as e:
+            logger.warning('无法加载分词器 %s，继续使用估算: %s', name, e)
+
+    def exact(self, family):
+        return self._encoding(family) is not None
+
+    def text_tokens(self, text, family):
+        encoding = self._encoding(family)
+        key = None
+        if len(text) >= self.cache_min_chars:
+            # 长文本 (系统提示词、重试和故障转移时的同一条消息) 按长度和哈希缓存，不持有文本本身
+            key = (encoding.name if encoding is not None else family, len(text), hash(text))
+            tokens = self._cache.get(key)
+            if tokens is not None:
+                self.counters['cache_hits'] += 1
+                return tokens
+        if encoding is not None:
+            tokens = len(encoding.encode(text, disallowed_special=()))
+        else:
+            ascii_chars, cjk_chars, other_chars = text_features(text)
+            chars_per_token, cjk_ratio, other_ratio = HEURISTICS[family]
+            tokens = math.ceil(ascii_chars / chars_per_token + cjk_chars * cjk_ratio + other_chars * other_ratio)
+        if key is not None:
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            self._cache[key] = tokens
+        return tokens
+
+    def prompt_tokens(self, messages, provider=None, model=None):
+        family = self.family(provider, model)
+        texts, images = message_texts(messages)
+        self.counters['estimates'] += 1
+        if self._encoding(family) is not None:
+            self.counters['exact'] += 1
+        return (sum(self.text_tokens(text, family) for text in texts) + images * IMAGE_TOKENS
+                + MESSAGE_OVERHEAD * len(messages) + REPLY_OVERHEAD)
+
+    def estimate(self, messages, max_tokens=None, provider=None, model=None):
+        # 速率限制和配额预留使用: 输入 + 预计的输出长度
+        return self.prompt_tokens(messages, provider, model) + (max_tokens or self.default_completion_tokens)
+
+    def estimate_texts(self, texts, provider=None, model=None):
+        # embeddings 的输入
+        family = self.family(provider, model)
+        self.counters['estimates'] += 1
+        return sum(self.text_tokens(text, family) for text in texts)
+
+    def context_window(self, model):
+        # 最长前缀匹配，未知模型返回 None
+        if not model:
+            return None
+        if model not in self._window_cache:
+            name = model.lower()
+            matches = [prefix for prefix in self.windows if name.startswith(prefix.lower())]
+            self._window_cache[model] = self.windows[max(matches, key=len)] if matches else None
+        return self._window_cache[model]
+
+    def admit(self, messages, max_tokens, provider=None, model=None):
+        # 选Key使用: 输入加上 max_tokens 超过模型上下文长度时返回 None，否则返回配额预留的估算值；
+        # 估算的结果允许 tolerance 的误差，避免误拒
+        prompt_tokens = self.prompt_tokens(messages, provider, model)
+        window = self.context_window(model)
+        if window is not None:
+            limit = window if self.exact(self.family(provider, model)) else window * (1 + self.tolerance)
+            if prompt_tokens + (max_tokens or 0) > limit:
+                return None
+        return prompt_tokens + (max_tokens or self.default_completion_tokens)
+
+    def fits(self, messages, max_tokens, provider=None, model=None):
+        return self.admit(messages, max_tokens, provider, model) is not None
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats.update({
+            'pid': os.getpid(),
+            'backend': self.backend,
+            'loaded_encodings': sorted(self._encodings),
+            'tolerance': self.tolerance,
+            'cached_texts': len(self._cache)
+        })
+        return stats
+
+
+token_estimator = TokenEstimator()
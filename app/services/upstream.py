@@ -0,0 +1,306 @@
+from app.models import APIProvider
+from app.services.streaming import AnthropicStreamRelay, OpenAIStreamRelay, QwenStreamRelay
+
+UPSTREAM_TIMEOUT = 120
+AZURE_API_VERSION = '2024-02-15-preview'
+ADAPTER_CACHE_SIZE = 1024
+
+ADAPTERS = {}
+_adapters = {}
+
+
+def register(*providers):
+    def decorator(cls):
+        for provider in providers:
+            ADAPTERS[provider] = cls
+        return cls
+    return decorator
+
+
+def adapter_for(api_key):
+    # 适配器按Key解析一次后缓存；Key的地址、密钥或模型修改后缓存键随之变化
+    cache_key = (api_key.id, api_key.provider, api_key.api_key, api_key.base_url, api_key.model)
+    adapter = _adapters.get(cache_key)
+    if adapter is None:
+        adapter_class = ADAPTERS.get(api_key.provider)
+        if adapter_class is None:
+            raise ValueError(f'未支持的提供商: {api_key.provider}')
+        if len(_adapters) >= ADAPTER_CACHE_SIZE:
+            _adapters.clear()
+        adapter = _adapters[cache_key] = adapter_class(api_key)
+    return adapter
+
+
+def openai_usage(prompt_tokens, completion_tokens, total_tokens=None):
+    prompt_tokens = prompt_tokens or 0
+    completion_tokens = completion_tokens or 0
+    return {
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'total_tokens': total_tokens or prompt_tokens + completion_tokens
+    }
+
+
+def chat_completion(content, usage):
+    return {
+        'choices': [{
+            'message': {
+                'role': 'assistant',
+                'content': content
+            }
+        }],
+        'usage': usage
+    }
+
+
+class ProviderAdapter:
+    # 请求头和接口地址在构造时算好，每次请求只拼装 payload；响应和用量统一转换为 OpenAI 格式
+    path = '/chat/completions'
+    embeddings_path = None
+    relay_class = OpenAIStreamRelay
+    # 请求体与 OpenAI 格式相同的提供商可以透传客户端的原始请求体；model_in_body 为 False 时模型由地址决定
+    passthrough = False
+    model_in_body = True
+    stream_options = None
+
+    def __init__(self, api_key):
+        info = APIProvider.PROVIDERS.get(api_key.provider, {})
+        self.provider = api_key.provider
+        self.default_model = api_key.model or info.get('default_model')
+        self.base_url = api_key.base_url or info.get('default_url')
+        self.url = f'{self.base_url}{self.path}'
+        self.headers = self.build_headers(api_key)
+        self.stream_headers = self.headers
+
+    def build_headers(self, api_key):
+        return {
+            'Authorization': f'Bearer {api_key.api_key}',
+            'Content-Type': 'application/json'
+        }
+
+    def endpoint(self, model):
+        return self.url
+
+    def payload(self, messages, model, temperature, max_tokens, stream):
+        raise NotImplementedError
+
+    def request(self, messages, model, temperature=0.7, max_tokens=None, stream=False):
+        # 返回 (url, headers, payload)，headers 为共享的预计算字典，调用方不能修改
+        return (
+            self.endpoint(model),
+            self.stream_headers if stream else self.headers,
+            self.payload(messages, model, temperature, max_tokens, stream)
+        )
+
+    def relay(self, model):
+        return self.relay_class(model)
+
+    def passthrough_fields(self, data, model, temperature, max_tokens, stream):
+        # 透传时需要补到客户端请求体里的字段；客户端已有的值与要发送的不同时返回 None，改为重新拼装请求
+        if not self.passthrough:
+            return None
+        fields = {}
+        if self.model_in_body and data.get('model') != model:
+            if 'model' in data:
+                return None
+            fields['model'] = model
+        if 'temperature' not in data:
+            fields['temperature'] = temperature
+        if 'max_tokens' in data and not max_tokens:
+            return None
+        if stream:
+            if data.get('stream') is not True:
+                return None
+            if self.stream_options and not (data.get('stream_options') or {}).get('include_usage'):
+                if 'stream_options' in data:
+                    return None
+                fields['stream_options'] = self.stream_options
+        return fields
+
+    def parse_response(self, result):
+        return {'success': True, 'response': result, 'usage': self.normalize_usage(result.get('usage'))}
+
+    def normalize_usage(self, usage):
+        if not usage:
+            return {}
+        if 'total_tokens' in usage and 'prompt_tokens' in usage:
+            return usage
+        return openai_usage(usage.get('prompt_tokens'), usage.get('completion_tokens'), usage.get('total_tokens'))
+
+    @property
+    def supports_embeddings(self):
+        return self.embeddings_path is not None
+
+    def embeddings_endpoint(self, model):
+        return f'{self.base_url}{self.embeddings_path}'
+
+    def embeddings_request(self, inputs, model):
+        if not self.supports_embeddings:
+            raise ValueError(f'{self.provider} 不支持 embeddings')
+        return self.embeddings_endpoint(model), self.headers, {'model': model, 'input': inputs}
+
+    def parse_embeddings(self, result):
+        # 返回按输入顺序排列的向量列表，拆分合并请求时按位置切片
+        data = sorted(result.get('data', []), key=lambda item: item.get('index', 0))
+        return {
+            'success': True,
+            'data': [item['embedding'] for item in data],
+            'usage': self.normalize_usage(result.get('usage'))
+        }
+
+
+@register('openai', 'moonshot', 'deepseek', 'zhipu', 'local')
+class OpenAIAdapter(ProviderAdapter):
+    embeddings_path = '/embeddings'
+    passthrough = True
+
+    def __init__(self, api_key):
+        super().__init__(api_key)
+        # 只有 OpenAI 和 DeepSeek 支持在流的最后一个事件返回用量
+        self.stream_options = {'include_usage': True} if self.provider in ('openai', 'deepseek') else None
+
+    def payload(self, messages, model, temperature, max_tokens, stream):
+        payload = {
+            'model': model,
+            'messages': messages,
+            'temperature': temperature
+        }
+        if max_tokens:
+            payload['max_tokens'] = max_tokens
+        if stream:
+            payload['stream'] = True
+            if self.stream_options:
+                payload['stream_options'] = self.stream_options
+        return payload
+
+
+@register('anthropic')
+class AnthropicAdapter(ProviderAdapter):
+    path = '/messages'
+    relay_class = AnthropicStreamRelay
+
+    def build_headers(self, api_key):
+        return {
+            'x-api-key': api_key.api_key,
+            'anthropic-version': '2023-06-01',
+            'Content-Type': 'application/json'
+        }
+
+    def payload(self, messages, model, temperature, max_tokens, stream):
+        # Anthropic 的 system 提示是单独的参数，不能放在 messages 中
+        system = [msg['content'] for msg in messages if msg.get('role') == 'system']
+        payload = {
+            'model': model,
+            'messages': [{'role': msg['role'], 'content': msg['content']} for msg in messages if msg.get('role') != 'system'],
+            'max_tokens': max_tokens or 1024,
+            'temperature': temperature
+        }
+        if system:
+            payload['system'] = '\n\n'.join(system)
+        if stream:
+            payload['stream'] = True
+        return payload
+
+    def parse_response(self, result):
+        usage = self.normalize_usage(result.get('usage'))
+        text = ''.join(block.get('text', '') for block in result.get('content', []) if block.get('type', 'text') == 'text')
+        return {'success': True, 'response': chat_completion(text, usage), 'usage': usage}
+
+    def normalize_usage(self, usage):
+        usage = usage or {}
+        return openai_usage(usage.get('input_tokens'), usage.get('output_tokens'))
+
+
+@register('qwen')
+class QwenAdapter(ProviderAdapter):
+    path = '/services/aigc/text-generation/generation'
+    relay_class = QwenStreamRelay
+
+    def __init__(self, api_key):
+        super().__init__(api_key)
+        self.stream_headers = dict(self.headers, **{'X-DashScope-SSE': 'enable'})
+
+    def payload(self, messages, model, temperature, max_tokens, stream):
+        parameters = {'temperature': temperature}
+        if max_tokens:
+            parameters['max_tokens'] = max_tokens
+        if stream:
+            parameters['incremental_output'] = True
+        return {
+            'model': model,
+            'input': {'messages': messages},
+            'parameters': parameters
+        }
+
+    def parse_response(self, result):
+        usage = self.normalize_usage(result.get('usage'))
+        return {'success': True, 'response': chat_completion(result['output']['text'], usage), 'usage': usage}
+
+    def normalize_usage(self, usage):
+        # DashScope 返回 input_tokens/output_tokens，转换后才能正确计入用量和配额
+        usage = usage or {}
+        return openai_usage(usage.get('input_tokens'), usage.get('output_tokens'), usage.get('total_tokens'))
+
+
+@register('minimax')
+class MiniMaxAdapter(ProviderAdapter):
+    path = '/text/chatcompletion_v2'
+
+    def payload(self, messages, model, temperature, max_tokens, stream):
+        payload = {
+            'model': model,
+            'messages': messages,
+            'temperature': temperature
+        }
+        if max_tokens:
+            payload['tokens_to_generate'] = max_tokens
+        if stream:
+            payload['stream'] = True
+        return payload
+
+
+@register('azure')
+class AzureAdapter(ProviderAdapter):
+    embeddings_path = 'embeddings'
+    passthrough = True
+    model_in_body = False
+    stream_options = {'include_usage': True}
+
+    def __init__(self, api_key):
+        super().__init__(api_key)
+        self.default_model = api_key.model or 'gpt-35-turbo'
+        self._urls = {}
+
+    def build_headers(self, api_key):
+        return {
+            'api-key': api_key.api_key,
+            'Content-Type': 'application/json'
+        }
+
+    def deployment_url(self, model, operation):
+        # Azure 按部署名区分模型，每个部署的地址只拼接一次
+        deployment = model or self.default_model
+        url = self._urls.get((deployment, operation))
+        if url is None:
+            url = self._urls[(deployment, operation)] = (
+                f'{self.base_url}/openai/deployments/{deployment}/{operation}?api-version={AZURE_API_VERSION}'
+            )
+        return url
+
+    def endpoint(self, model):
+        return self.deployment_url(model, 'chat/completions')
+
+    def embeddings_endpoint(self, model):
+        return self.deployment_url(model, 'embeddings')
+
+    def payload(self, messages, model, temperature, max_tokens, stream):
+        payload = {
+            'messages': messages,
+            'temperature': temperature
+        }
+        if max_tokens:
+            payload['max_tokens'] = max_tokens
+        if stream:
+            payload['stream'] = True
+            payload['stream_options'] = self.stream_options
+        return payload
@@ -0,0 +1,89 @@
+from datetime import datetime
+
+from sqlalchemy import func, tuple_
+
+from app.models import db, UsageRecord, UsageRollupDaily
+
+
+def day_start(now=None):
+    return (now or datetime.utcnow()).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _user_range(user_id, start):
+    # 与 (user_id, created_at, id) 复合索引的前缀一致，只扫描范围内的行
+    return [UsageRecord.user_id == user_id, UsageRecord.created_at >= start]
+
+
+def _rollup_range(user_id, start):
+    # 汇总统计读取按天预聚合的表，行数只与天数和Key/模型数有关
+    return [UsageRollupDaily.user_id == user_id, UsageRollupDaily.bucket >= day_start(start)]
+
+
+def summarize(user_id, start):
+    row = db.session.query(
+        func.coalesce(func.sum(UsageRollupDaily.total_tokens), 0),
+        func.coalesce(func.sum(UsageRollupDaily.requests), 0),
+        func.coalesce(func.sum(UsageRollupDaily.success_requests), 0),
+        func.coalesce(func.sum(UsageRollupDaily.failed_requests), 0),
+        func.coalesce(func.sum(UsageRollupDaily.cancelled_requests), 0),
+        func.coalesce(func.sum(UsageRollupDaily.saved_tokens), 0)
+    ).filter(*_rollup_range(user_id, start)).one()
+    tokens, requests, success, failed, cancelled, saved_tokens = row
+    return {
+        'tokens': tokens,
+        'requests': requests,
+        'success': success,
+        'failed': failed,
+        'cancelled': cancelled,
+        'saved_tokens': saved_tokens
+    }
+
+
+def provider_breakdown(user_id, start):
+    rows = db.session.query(
+        UsageRollupDaily.provider,
+        func.coalesce(func.sum(UsageRollupDaily.total_tokens), 0),
+        func.coalesce(func.sum(UsageRollupDaily.requests), 0)
+    ).filter(*_rollup_range(user_id, start)).group_by(UsageRollupDaily.provider).all()
+    return {provider: {'tokens': tokens, 'requests': requests} for provider, tokens, requests in rows}
+
+
+def daily_usage(user_id, start):
+    rows = db.session.query(
+        UsageRollupDaily.bucket,
+        UsageRollupDaily.provider,
+        func.coalesce(func.sum(UsageRollupDaily.total_tokens), 0),
+        func.coalesce(func.sum(UsageRollupDaily.requests), 0)
+    ).filter(*_rollup_range(user_id, start)).group_by(UsageRollupDaily.bucket, UsageRollupDaily.provider).all()
+
+    usage = {}
+    for bucket, provider, tokens, requests in rows:
+        entry = usage.setdefault(bucket.strftime('%Y-%m-%d'), {'tokens': 0, 'requests': 0, 'providers': {}})
+        entry['tokens'] += tokens
+        entry['requests'] += requests
+        entry['providers'][provider] = {'tokens': tokens, 'requests': requests}
+    return usage
+
+
+def encode_cursor(record):
+    return f'{record.created_at.isoformat()}_{record.id}'
+
+
+def decode_cursor(cursor):
+    try:
+        created_at, record_id = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(created_at), int(record_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def record_page(user_id, start, cursor=None, limit=50):
+    # 按 (created_at, id) 键集分页，翻页深度不影响查询耗时
+    query = UsageRecord.query.filter(*_user_range(user_id, start))
+    position = decode_cursor(cursor) if cursor else None
+    if position:
+        created_at, record_id = position
+        query = query.filter(tuple_(UsageRecord.created_at, UsageRecord.id) < (created_at, record_id))
+    records = query.order_by(UsageRecord.created_at.desc(), UsageRecord.id.desc()).limit(limit + 1).all()
+    next_cursor = encode_cursor(records[limit - 1]) if len(records) > limit else None
+    return records[:limit], next_cursor
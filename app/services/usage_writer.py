@@ -0,0 +1,332 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from sqlalchemy import case, inspect, or_, update
+
+from app.models import db, APIKey, UsageRecord
+from app.services.metrics import metrics
+from app.services.rollups import apply_rollups, hour_bucket
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class UsageWriter:
+    # 请求线程只负责入队，后台线程按批量大小或时间窗口批量写入 usage_records 和汇总表
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = True
+        self.batch_size = 200
+        self.flush_interval = 1.0
+        self.enqueue_timeout = 0.5
+        self.max_retries = 3
+        self.failure_rate = 20.0
+        self.failure_burst = 100
+        self.error_max_chars = 500
+        self.spill_dir = None
+        self._spilled = False
+        self._queue = queue.Queue(maxsize=10000)
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._failure_tokens = 0.0
+        self._failure_refilled = time.monotonic()
+        self._suppressed = {}
+        self._keyless = None
+        self.counters = {
+            'enqueued': 0, 'written': 0, 'batches': 0, 'sync_writes': 0, 'failed': 0,
+            'failures_recorded': 0, 'failures_sampled_out': 0, 'failures_dropped': 0, 'spilled': 0, 'replayed': 0
+        }
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('USAGE_WRITER_ENABLED', self.enabled)
+        self.batch_size = app.config.get('USAGE_BATCH_SIZE', self.batch_size)
+        self.flush_interval = app.config.get('USAGE_FLUSH_INTERVAL', self.flush_interval)
+        self.enqueue_timeout = app.config.get('USAGE_ENQUEUE_TIMEOUT', self.enqueue_timeout)
+        self._queue = queue.Queue(maxsize=app.config.get('USAGE_QUEUE_SIZE', 10000))
+        self.failure_rate = app.config.get('USAGE_FAILURE_RATE', self.failure_rate)
+        self.failure_burst = app.config.get('USAGE_FAILURE_BURST', self.failure_burst)
+        self.error_max_chars = app.config.get('USAGE_ERROR_MAX_CHARS', self.error_max_chars)
+        self._failure_tokens = float(self.failure_burst)
+        self._keyless = None
+        self.spill_dir = app.config.get('USAGE_SPILL_DIR') or os.path.join(app.instance_path, 'usage_spill')
+        os.makedirs(self.spill_dir, exist_ok=True)
+        # 上次运行留下的批次在第一次成功写入后重放
+        self._spilled = any(name.endswith('.jsonl') for name in os.listdir(self.spill_dir))
+        app.extensions['usage_writer'] = self
+        atexit.register(self.close)
+
+    def _ensure_thread(self):
+        # gunicorn fork 之后线程不会被继承，按进程号懒启动
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='usage-writer', daemon=True)
+                self._thread.start()
+
+    def submit(self, event):
+        event.setdefault('created_at', datetime.utcnow())
+        if not self.enabled:
+            self.write_batch([event])
+            return
+        self._ensure_thread()
+        try:
+            self._queue.put(event, timeout=self.enqueue_timeout)
+            self.counters['enqueued'] += 1
+        except queue.Full:
+            # 队列已满时由调用方同步写入，既限制内存又不丢失记录
+            self.counters['sync_writes'] += 1
+            self.write_batch([event])
+
+    def submit_failure(self, event):
+        # 失败记录不能拖慢错误响应，也不能在上游大面积故障时压垮数据库：
+        # 每秒最多写入 failure_rate 条明细，超出的和队列已满时的失败只累加到汇总表的失败次数，从不阻塞或同步写库
+        event.setdefault('created_at', datetime.utcnow())
+        if event.get('error_message'):
+            event['error_message'] = event['error_message'][:self.error_max_chars]
+        if event['api_key_id'] is None and not self._keyless_supported():
+            self.counters['failures_dropped'] += 1
+            return
+        if not self._take_failure_token():
+            self.counters['failures_sampled_out'] += 1
+            self._suppress(event)
+            return
+        if not self.enabled:
+            self.write_batch([event])
+            self.counters['failures_recorded'] += 1
+            return
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(event)
+            self.counters['enqueued'] += 1
+            self.counters['failures_recorded'] += 1
+        except queue.Full:
+            self.counters['failures_dropped'] += 1
+            self._suppress(event)
+
+    def _take_failure_token(self):
+        with self._lock:
+            now = time.monotonic()
+            self._failure_tokens = min(
+                float(self.failure_burst), self._failure_tokens + (now - self._failure_refilled) * self.failure_rate
+            )
+            self._failure_refilled = now
+            if self._failure_tokens >= 1:
+                self._failure_tokens -= 1
+                return True
+            return False
+
+    def _suppress(self, event):
+        # 未写入明细的失败按 (小时, 用户, Key, 提供商, 模型) 计数，由后台线程合并写入汇总表
+        if event['api_key_id'] is None:
+            return
+        key = (hour_bucket(event['created_at']), event['user_id'], event['api_key_id'], event['provider'], event['model'])
+        with self._lock:
+            entry = self._suppressed.setdefault(key, [0, 0.0])
+            entry[0] += 1
+            entry[1] += event.get('request_time') or 0
+
+    def _drain_suppressed(self):
+        with self._lock:
+            suppressed, self._suppressed = self._suppressed, {}
+        return [
+            {
+                'created_at': bucket, 'user_id': user_id, 'api_key_id': api_key_id, 'provider': provider,
+                'model': model, 'status': 'error', 'count': count, 'request_time': latency, 'sampled': True
+            }
+            for (bucket, user_id, api_key_id, provider, model), (count, latency) in suppressed.items()
+        ]
+
+    def _keyless_supported(self):
+        # 旧版 SQLite 数据库的 api_key_id 仍有 NOT NULL 约束，无法保存未选到Key的失败记录
+        if self._keyless is None:
+            with self.app.app_context():
+                columns = inspect(db.engine).get_columns(UsageRecord.__tablename__)
+            self._keyless = any(c['name'] == 'api_key_id' and c['nullable'] for c in columns)
+            if not self._keyless:
+                logger.warning('usage_records.api_key_id 不允许为空，未选到上游Key的失败请求只计入监控指标')
+        return self._keyless
+
+    def _run(self):
+        while True:
+            try:
+                event = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                # 空闲时也定期写入被采样掉的失败次数，并重放之前写入失败的批次
+                if self._suppressed or self._spilled:
+                    self.write_batch([])
+                continue
+            if event is _STOP:
+                self._queue.task_done()
+                return
+            batch = [event]
+            deadline = time.monotonic() + self.flush_interval
+            stop = False
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    event = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if event is _STOP:
+                    stop = True
+                    break
+                batch.append(event)
+            try:
+                self.write_batch(batch)
+            finally:
+                for _ in range(len(batch) + (1 if stop else 0)):
+                    self._queue.task_done()
+            if stop:
+                return
+
+    def write_batch(self, events):
+        # 被采样掉的失败只有计数，随这一批一起写入汇总表；重试后仍失败的批次连同这些计数一起落盘，
+        # 之后某一批写入成功时重放
+        suppressed = self._drain_suppressed()
+        if not self._write(events, suppressed):
+            self._spill(events + suppressed)
+        elif self._spilled:
+            self._replay()
+
+    def _write(self, events, suppressed):
+        increments = defaultdict(lambda: [0, None])
+        for event in events:
+            if event['api_key_id'] is None:
+                continue
+            counter = increments[event['api_key_id']]
+            counter[0] += event.get('total_tokens') or 0
+            if counter[1] is None or event['created_at'] > counter[1]:
+                counter[1] = event['created_at']
+
+        for attempt in range(self.max_retries):
+            started = time.perf_counter()
+            with self.app.app_context():
+                try:
+                    if events:
+                        db.session.execute(UsageRecord.__table__.insert(), events)
+                    apply_rollups(db.session, events + suppressed)
+                    for key_id, (tokens, last_used_at) in increments.items():
+                        # 上次使用不在同一天时从0开始计数，实现每日自动清零
+                        day_start = last_used_at.replace(hour=0, minute=0, second=0, microsecond=0)
+                        db.session.execute(
+                            update(APIKey).where(APIKey.id == key_id).values(
+                                used_tokens_today=case(
+                                    (or_(APIKey.last_used_at.is_(None), APIKey.last_used_at < day_start), tokens),
+                                    else_=APIKey.used_tokens_today + tokens
+                                ),
+                                last_used_at=last_used_at
+                            )
+                        )
+                    db.session.commit()
+                    metrics.observe('gateway_db_write_seconds', time.perf_counter() - started)
+                    metrics.inc('gateway_db_written_records_total', len(events))
+                    self.counters['written'] += len(events)
+                    self.counters['batches'] += 1
+                    return True
+                except Exception:
+                    db.session.rollback()
+                    logger.exception('写入用量记录失败 (第%d次)', attempt + 1)
+            time.sleep(0.1 * (attempt + 1))
+        return False
+
+    def _spill(self, events):
+        # 每个批次一个文件，先写临时文件再改名，其他进程重放时不会读到写了一半的文件
+        if not events:
+            return
+        name = f'{time.time():.6f}-{os.getpid()}-{threading.get_ident()}'
+        path = os.path.join(self.spill_dir, name + '.jsonl')
+        try:
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                for event in events:
+                    f.write(json.dumps(event, default=datetime.isoformat, ensure_ascii=False) + '\n')
+            os.replace(path + '.tmp', path)
+        except (OSError, TypeError, ValueError):
+            logger.exception('保存写入失败的用量记录失败')
+            self.counters['failed'] += len(events)
+            return
+        self._spilled = True
+        self.counters['spilled'] += len(events)
+
+    def _replay(self):
+        # 先改名认领文件，多个进程同时重放时每个文件只会被写入一次
+        self._spilled = False
+        for name in sorted(os.listdir(self.spill_dir)):
+            if not name.endswith('.jsonl'):
+                continue
+            path = os.path.join(self.spill_dir, name)
+            claimed = f'{path}.{os.getpid()}'
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue
+            try:
+                with open(claimed, encoding='utf-8') as f:
+                    events = [json.loads(line) for line in f if line.strip()]
+                for event in events:
+                    event['created_at'] = datetime.fromisoformat(event['created_at'])
+            except (OSError, ValueError, KeyError):
+                # 无法解析的文件保留认领后的文件名，不再重放
+                logger.exception('无法重放用量记录文件 %s', claimed)
+                continue
+            records = [event for event in events if not event.get('sampled')]
+            if not self._write(records, [event for event in events if event.get('sampled')]):
+                os.rename(claimed, path)
+                self._spilled = True
+                return
+            os.remove(claimed)
+            self.counters['replayed'] += len(events)
+
+    def flush(self):
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.join()
+        if (self._suppressed or self._spilled) and self.app is not None:
+            self.write_batch([])
+
+    def close(self):
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+        self._thread = None
+        # 线程退出后仍留在队列中的记录同步写入
+        remaining = []
+        while True:
+            try:
+                event = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            self._queue.task_done()
+            if event is not _STOP:
+                remaining.append(event)
+        if (remaining or self._suppressed) and self.app is not None:
+            self.write_batch(remaining)
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats.update({
+            'pid': os.getpid(),
+            'queued': self._queue.qsize(),
+            'queue_size': self._queue.maxsize,
+            'batch_size': self.batch_size,
+            'flush_interval': self.flush_interval,
+            'failure_rate': self.failure_rate
+        })
+        return stats
+
+
+usage_writer = UsageWriter()
@@ -0,0 +1,122 @@
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+from benchmarks.common import BENCH_API_KEY, create_bench_app, free_port, seed, spawn, wait_for_port
+
+SERVERS = {
+    'sync': lambda port, workers: [
+        '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}', '--workers', str(workers),
+        '--timeout', '300', 'benchmarks.common:create_bench_app()'
+    ],
+    'async': lambda port, workers: [
+        '-m', 'uvicorn', '--factory', 'benchmarks.common:create_bench_asgi_app',
+        '--host', '127.0.0.1', '--port', str(port), '--workers', str(workers), '--log-level', 'warning'
+    ]
+}
+
+
+async def post_json(port, path, payload, headers):
+    # 极简 HTTP/1.1 客户端，避免压测端自身的连接池开销成为瓶颈
+    body = json.dumps(payload).encode()
+    head = f'POST {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\n'
+    head += f'Content-Length: {len(body)}\r\nConnection: close\r\n'
+    head += ''.join(f'{name}: {value}\r\n' for name, value in headers.items())
+    reader, writer = await asyncio.open_connection('127.0.0.1', port, limit=2 ** 20)
+    try:
+        writer.write(head.encode() + b'\r\n' + body)
+        await writer.drain()
+        response = await reader.read()
+    finally:
+        writer.close()
+    return int(response.split(b' ', 2)[1])
+
+
+async def drive(port, concurrency):
+    latencies = []
+    errors = 0
+
+    async def one():
+        nonlocal errors
+        started = time.perf_counter()
+        try:
+            status = await post_json(
+                port, '/v1/chat',
+                {'messages': [{'role': 'user', 'content': 'ping'}]},
+                {'Authorization': f'Bearer {BENCH_API_KEY}'}
+            )
+        except (OSError, IndexError, ValueError):
+            errors += 1
+            return
+        if status != 200:
+            errors += 1
+            return
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(concurrency)))
+    return time.perf_counter() - started, latencies, errors
+
+
+def run_mode(mode, workers, concurrency, upstream_latency):
+    port = free_port()
+    server = spawn(SERVERS[mode](port, workers))
+    try:
+        wait_for_port(port)
+        wall, latencies, errors = asyncio.run(drive(port, concurrency))
+    finally:
+        server.terminate()
+        server.wait()
+    latencies.sort()
+    return {
+        'mode': mode,
+        'workers': workers,
+        'requests': concurrency,
+        'errors': errors,
+        'wall_seconds': round(wall, 3),
+        'throughput_rps': round(len(latencies) / wall, 2),
+        'effective_concurrency': round(len(latencies) * upstream_latency / wall, 1),
+        'p50_seconds': round(latencies[len(latencies) // 2], 3) if latencies else None,
+        'max_seconds': round(latencies[-1], 3) if latencies else None
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='同步(gunicorn)与异步(uvicorn)模式的并发上限对比')
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--upstream-latency', type=float, default=1.0)
+    parser.add_argument('--sync-workers', type=int, default=4)
+    parser.add_argument('--async-workers', type=int, default=1)
+    parser.add_argument('--modes', default='sync,async')
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='gateway-bench-')
+    os.environ['GATEWAY_BENCH_DB'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+
+    upstream_port = free_port()
+    upstream = spawn(['-m', 'benchmarks.fake_upstream', '--port', str(upstream_port),
+                      '--latency', str(args.upstream_latency)])
+    try:
+        wait_for_port(upstream_port)
+        seed(create_bench_app(), f'http://127.0.0.1:{upstream_port}')
+        results = []
+        for mode in args.modes.split(','):
+            workers = args.sync_workers if mode == 'sync' else args.async_workers
+            result = run_mode(mode, workers, args.concurrency, args.upstream_latency)
+            results.append(result)
+            print(json.dumps(result, ensure_ascii=False))
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import requests
+from requests.adapters import BaseAdapter
+
+from benchmarks.common import BENCH_API_KEY, create_bench_app, seed
+
+UPSTREAM_URL = 'http://upstream.invalid/v1'
+MESSAGES = [
+    {'role': 'system', 'content': 'You are a helpful assistant.'},
+    {'role': 'user', 'content': 'Summarize the following paragraph in one sentence. ' * 8}
+]
+RESPONSES = {
+    'openai': {
+        'id': 'chatcmpl-fake',
+        'object': 'chat.completion',
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': 'ok'}, 'finish_reason': 'stop'}],
+        'usage': {'prompt_tokens': 10, 'completion_tokens': 5, 'total_tokens': 15}
+    },
+    'anthropic': {
+        'content': [{'type': 'text', 'text': 'ok'}],
+        'usage': {'input_tokens': 10, 'output_tokens': 5}
+    },
+    'qwen': {
+        'output': {'text': 'ok', 'finish_reason': 'stop'},
+        'usage': {'input_tokens': 10, 'output_tokens': 5, 'total_tokens': 15}
+    }
+}
+RESPONSES.update({name: RESPONSES['openai'] for name in ('deepseek', 'minimax', 'azure')})
+
+
+class CannedAdapter(BaseAdapter):
+    # 进程内返回固定响应，测量结果不包含网络和上游耗时
+    def __init__(self, body):
+        super().__init__()
+        self.body = json.dumps(body).encode()
+
+    def send(self, request, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        response.headers['Content-Type'] = 'application/json'
+        response._content = self.body
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def bench_adapters(provider, iterations):
+    # 只测量请求拼装和响应/用量转换；uncached 为每次请求重新解析适配器的开销
+    from app.services.upstream import ADAPTERS, adapter_for
+
+    class Key:
+        id = 1
+        api_key = 'sk-upstream'
+        base_url = UPSTREAM_URL
+        model = 'fake-model'
+
+    Key.provider = provider
+    body = RESPONSES[provider]
+    results = {}
+    for label, resolve in (('cached', adapter_for), ('uncached', lambda key: ADAPTERS[key.provider](key))):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            adapter = resolve(Key)
+            adapter.request(MESSAGES, 'fake-model', 0.7, 256, False)
+            adapter.parse_response(body)
+        results[f'{label}_us'] = round((time.perf_counter() - started) / iterations * 1e6, 2)
+    return results
+
+
+def bench_chat(app, provider, iterations):
+    # 完整的 /v1/chat 同步请求路径：认证、选Key、配额预留、熔断、路由、请求拼装、响应转换、用量入队
+    from app.models import db, APIKey
+    from app.services.auth_cache import auth_cache
+    from app.services.http_pool import upstream_pool
+    with app.app_context():
+        key = APIKey.query.first()
+        key.provider = provider
+        db.session.commit()
+    auth_cache.clear()
+    _, session = upstream_pool.session_for(UPSTREAM_URL)
+    session.mount(upstream_pool.pool_key(UPSTREAM_URL), CannedAdapter(RESPONSES[provider]))
+
+    client = app.test_client()
+    headers = {'Authorization': f'Bearer {BENCH_API_KEY}'}
+    payload = {'messages': MESSAGES, 'max_tokens': 256}
+    for _ in range(50):
+        client.post('/v1/chat', json=payload, headers=headers)
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        response = client.post('/v1/chat', json=payload, headers=headers)
+        timings.append(time.perf_counter() - started)
+        assert response.status_code == 200, response.get_data(as_text=True)
+    timings.sort()
+    return {
+        'p50_us': round(timings[len(timings) // 2] * 1e6, 1),
+        'p99_us': round(timings[int(len(timings) * 0.99)] * 1e6, 1),
+        'requests_per_second': round(iterations / sum(timings), 1)
+    }
+
+
+def use_mode(app, mode):
+    # mode 为 "请求处理方式/JSON库"，例如 passthrough/orjson
+    import json as stdlib_json
+    from flask.json.provider import DefaultJSONProvider
+    from app.services.passthrough import passthrough, stdlib_dumps, OrjsonProvider
+    handling, backend = mode.split('/')
+    passthrough.enabled = handling == 'passthrough'
+    if backend == 'orjson':
+        import orjson
+        passthrough._loads, passthrough._dumps, app.json = orjson.loads, orjson.dumps, OrjsonProvider(app)
+    else:
+        passthrough._loads, passthrough._dumps, app.json = stdlib_json.loads, stdlib_dumps, DefaultJSONProvider(app)
+
+
+def bench_large(app, iterations, prompt_kb):
+    # 大请求/大响应下的 /v1/chat：对比重新拼装请求和透传原始字节，以及标准库 json 与 orjson
+    from app.services.passthrough import orjson_available
+    global MESSAGES
+    content = ('大段中文内容与 English text mixed together. ' * 64)[:1024]
+    messages, MESSAGES = MESSAGES, [
+        {'role': 'system', 'content': 'You are a helpful assistant.'},
+        {'role': 'user', 'content': content * prompt_kb}
+    ]
+    response = dict(RESPONSES['openai'])
+    response['choices'] = [{'index': 0, 'message': {'role': 'assistant', 'content': content * prompt_kb},
+                            'finish_reason': 'stop'}]
+    original, RESPONSES['openai'] = RESPONSES['openai'], response
+    modes = ['rebuild/json', 'passthrough/json']
+    if orjson_available():
+        modes += ['rebuild/orjson', 'passthrough/orjson']
+    results = {}
+    try:
+        for mode in modes:
+            use_mode(app, mode)
+            results[mode] = bench_chat(app, 'openai', iterations)
+    finally:
+        MESSAGES, RESPONSES['openai'] = messages, original
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='不含网络的单请求网关开销')
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--providers', default='openai,anthropic,qwen,azure')
+    parser.add_argument('--prompt-kb', type=int, default=64, help='大请求测试中请求和响应各自的大小 (KB)，0 表示跳过')
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='gateway-bench-')
+    os.environ['GATEWAY_BENCH_DB'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    app = create_bench_app()
+    seed(app, UPSTREAM_URL)
+
+    results = {}
+    for provider in args.providers.split(','):
+        results[provider] = {
+            'adapter': bench_adapters(provider, args.iterations * 10),
+            'chat': bench_chat(app, provider, args.iterations)
+        }
+        print(provider, json.dumps(results[provider]))
+    if args.prompt_kb:
+        results['large'] = bench_large(app, max(args.iterations // 10, 20), args.prompt_kb)
+        print('large', json.dumps(results['large']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,408 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from benchmarks.common import BENCH_API_KEY, ROOT, free_port, seed, spawn, wait_for_port
+
+PROVIDERS = ('openai', 'anthropic', 'qwen', 'minimax', 'azure')
+SERVERS = {
+    'sync': lambda port, workers: [
+        '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}', '--workers', str(workers),
+        '--timeout', '300', 'benchmarks.common:create_bench_app()'
+    ],
+    'async': lambda port, workers: [
+        '-m', 'uvicorn', '--factory', 'benchmarks.common:create_bench_asgi_app',
+        '--host', '127.0.0.1', '--port', str(port), '--workers', str(workers), '--log-level', 'warning'
+    ]
+}
+# 与基线对比的指标: (路径, 是否越大越好)
+COMPARED = (
+    ('throughput_rps', True),
+    ('overhead_ms.p50', False),
+    ('overhead_ms.p95', False),
+    ('overhead_ms.p99', False),
+    ('latency_ms.p99', False),
+    ('db.commits_per_request', False),
+    ('memory.worker_rss_mb_max', False),
+)
+
+
+class Client:
+    # 保持连接的极简 HTTP/1.1 客户端，支持 Content-Length 和分块传输的响应
+    def __init__(self, port):
+        self.port = port
+        self.reader = self.writer = None
+
+    async def request(self, method, path, body=b'', headers=None):
+        # 返回 (状态码, 首字节耗时, 总耗时, 响应体)
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port, limit=2 ** 22)
+        head = f'{method} {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Length: {len(body)}\r\n'
+        head += ''.join(f'{name}: {value}\r\n' for name, value in (headers or {}).items())
+        started = time.perf_counter()
+        try:
+            self.writer.write(head.encode() + b'\r\n' + body)
+            await self.writer.drain()
+            status = int((await self.reader.readline()).split(b' ', 2)[1])
+            response_headers = {}
+            while True:
+                line = await self.reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                response_headers[name.strip().lower()] = value.strip()
+            ttfb = None
+            chunks = []
+            if response_headers.get('transfer-encoding', '').lower() == 'chunked':
+                while True:
+                    size = int((await self.reader.readline()).split(b';')[0], 16)
+                    if ttfb is None:
+                        ttfb = time.perf_counter() - started
+                    if size == 0:
+                        await self.reader.readline()
+                        break
+                    chunks.append(await self.reader.readexactly(size))
+                    await self.reader.readline()
+            elif 'content-length' in response_headers:
+                chunks.append(await self.reader.readexactly(int(response_headers['content-length'])))
+            else:
+                chunks.append(await self.reader.read())
+                response_headers['connection'] = 'close'
+        except (OSError, ValueError, IndexError, asyncio.IncompleteReadError):
+            self.close()
+            raise
+        elapsed = time.perf_counter() - started
+        if response_headers.get('connection', '').lower() == 'close':
+            self.close()
+        return status, ttfb if ttfb is not None else elapsed, elapsed, b''.join(chunks)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+async def control(port, path, payload=None):
+    client = Client(port)
+    try:
+        _, _, _, body = await client.request('POST' if payload is not None else 'GET', path,
+                                             json.dumps(payload or {}).encode())
+    finally:
+        client.close()
+    return json.loads(body)
+
+
+async def drive(port, concurrency, total, make_body):
+    # 固定并发的闭环压测: concurrency 个连接各自发完一个请求再发下一个，共 total 个
+    samples, errors = [], {}
+    remaining = total
+    headers = {'Authorization': f'Bearer {BENCH_API_KEY}', 'Content-Type': 'application/json'}
+
+    async def worker():
+        nonlocal remaining
+        client = Client(port)
+        while remaining > 0:
+            remaining -= 1
+            try:
+                status, ttfb, elapsed, _ = await client.request('POST', '/v1/chat', make_body(), headers)
+            except (OSError, ValueError, IndexError, asyncio.IncompleteReadError):
+                errors['connection'] = errors.get('connection', 0) + 1
+                continue
+            if status == 200:
+                samples.append((ttfb, elapsed))
+            else:
+                errors[str(status)] = errors.get(str(status), 0) + 1
+        client.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return time.perf_counter() - started, samples, errors
+
+
+def percentiles(values, scale=1000):
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda p: values[min(len(values) - 1, int(len(values) * p / 100))]
+    result = {f'p{p}': round(pick(p) * scale, 3) for p in (50, 95, 99)}
+    result['max'] = round(values[-1] * scale, 3)
+    return result
+
+
+def process_tree(pid):
+    # 服务进程及其所有子进程 (gunicorn/uvicorn 的 worker)
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(children.get(current, []))
+    return tree
+
+
+def memory_mb(pid):
+    # (常驻内存, 峰值常驻内存)，单位 MB；非 Linux 系统返回 None
+    values = {}
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name in ('VmRSS', 'VmHWM'):
+                    values[name] = round(int(value.split()[0]) / 1024, 1)
+    except OSError:
+        return None
+    return values.get('VmRSS'), values.get('VmHWM')
+
+
+def worker_memory(server_pid):
+    pids = process_tree(server_pid)
+    # 只有一个进程时它本身就是 worker；否则根进程是 master
+    workers = pids[1:] if len(pids) > 1 else pids
+    usage = {pid: memory_mb(pid) for pid in workers}
+    usage = {pid: value for pid, value in usage.items() if value is not None}
+    if not usage:
+        return None
+    rss = [value[0] for value in usage.values()]
+    return {
+        'workers': len(usage),
+        'worker_rss_mb': {str(pid): value[0] for pid, value in usage.items()},
+        'worker_rss_mb_max': max(rss),
+        'worker_rss_mb_mean': round(sum(rss) / len(rss), 1),
+        'worker_peak_rss_mb_max': max(value[1] for value in usage.values())
+    }
+
+
+def db_metrics(directory):
+    # 服务退出时各 worker 把最后的指标快照写入 METRICS_DIR，这里合并读取
+    from app.services.metrics import Metrics
+    collector = Metrics()
+    collector.directory = directory
+    merged = collector.collect()
+
+    def total(name):
+        return sum(
+            sum(value[:-1]) if isinstance(value, list) else value
+            for (metric, _), value in merged.items() if metric == name
+        )
+
+    return {
+        'commits': total('gateway_db_write_seconds'),
+        'records': total('gateway_db_written_records_total'),
+        'upstream_errors': total('gateway_upstream_errors_total'),
+        'upstream_retries': total('gateway_upstream_retries_total')
+    }
+
+
+def gateway_overhead(app):
+    # 网关开销 = 网关记录的请求总耗时 - 上游耗时，取成功的请求
+    from app.models import UsageRecord
+    with app.app_context():
+        rows = UsageRecord.query.with_entities(
+            UsageRecord.status, UsageRecord.request_time, UsageRecord.upstream_time
+        ).all()
+    overhead = [request_time - (upstream_time or 0) for status, request_time, upstream_time in rows
+                if status == 'success' and request_time]
+    return len(rows), overhead
+
+
+def make_body_factory(stream, prompt_chars):
+    # 每个请求的内容不同，避免命中响应缓存
+    rng = random.Random(0)
+    prefix = 'x' * max(prompt_chars - 16, 0)
+
+    def make_body():
+        return json.dumps({
+            'messages': [{'role': 'user', 'content': f'{prefix} {rng.random():.12f}'}],
+            'max_tokens': 64,
+            'stream': stream
+        }).encode()
+    return make_body
+
+
+def run_scenario(app, args, upstream_port, provider, variant, workdir):
+    name = f'{provider}/{variant}'
+    directory = os.path.join(workdir, name.replace('/', '-'))
+    os.makedirs(directory)
+    # 错误场景使用两个Key，观察重试和故障转移
+    seed(app, f'http://127.0.0.1:{upstream_port}', provider=provider, keys=2 if variant == 'errors' else 1)
+    errors = variant == 'errors'
+    asyncio.run(control(upstream_port, '/__config', {
+        'latency': args.latency,
+        'chunk_interval': args.chunk_interval,
+        'stream_chunks': args.stream_chunks,
+        'error_rate': args.error_rate if errors else 0.0,
+        'disconnect_rate': args.disconnect_rate if errors else 0.0
+    }))
+
+    port = free_port()
+    server = spawn(SERVERS[args.mode](port, args.workers), env={'METRICS_DIR': os.path.join(directory, 'metrics')})
+    try:
+        wait_for_port(port)
+        make_body = make_body_factory(variant == 'stream', args.prompt_chars)
+        asyncio.run(drive(port, min(args.concurrency, args.warmup) or 1, args.warmup, make_body))
+        asyncio.run(control(upstream_port, '/__reset', {}))
+        wall, samples, failed = asyncio.run(drive(port, args.concurrency, args.requests, make_body))
+        upstream = asyncio.run(control(upstream_port, '/__stats'))
+        memory = worker_memory(server.pid)
+    finally:
+        server.terminate()
+        server.wait(timeout=60)
+
+    requests_sent = args.warmup + args.requests
+    db = db_metrics(os.path.join(directory, 'metrics'))
+    records, overhead = gateway_overhead(app)
+    return {
+        'name': name,
+        'provider': provider,
+        'variant': variant,
+        'requests': args.requests,
+        'succeeded': len(samples),
+        'errors': failed,
+        'wall_seconds': round(wall, 3),
+        'throughput_rps': round(len(samples) / wall, 2) if wall else 0,
+        'latency_ms': percentiles([elapsed for _, elapsed in samples]),
+        'ttfb_ms': percentiles([ttfb for ttfb, _ in samples]) if variant == 'stream' else None,
+        'overhead_ms': percentiles(overhead),
+        'upstream': {
+            'requests_per_request': round(upstream['total'] / args.requests, 3),
+            'injected_errors': upstream['errors'],
+            'disconnects': upstream['disconnects']
+        },
+        # 包含预热请求；commits 为用量写入的事务数，records 为写入的用量记录数
+        'db': {
+            'commits': db['commits'],
+            'records': db['records'],
+            'usage_rows': records,
+            'commits_per_request': round(db['commits'] / requests_sent, 3),
+            'records_per_request': round(db['records'] / requests_sent, 3),
+            'upstream_retries': db['upstream_retries']
+        },
+        'memory': memory
+    }
+
+
+def lookup(result, path):
+    for part in path.split('.'):
+        if not isinstance(result, dict):
+            return None
+        result = result.get(part)
+    return result
+
+
+def compare(results, baseline, tolerance):
+    # 按场景逐项对比，变差超过 tolerance 的记为回退
+    baseline = {scenario['name']: scenario for scenario in baseline.get('scenarios', [])}
+    regressions = []
+    for scenario in results['scenarios']:
+        base = baseline.get(scenario['name'])
+        if base is None:
+            continue
+        for path, higher_is_better in COMPARED:
+            old, new = lookup(base, path), lookup(scenario, path)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = -change if higher_is_better else change
+            flag = 'REGRESSION' if worse > tolerance else ''
+            print(f'{scenario["name"]:<22} {path:<28} {old:>12} -> {new:<12} {change:+.1%} {flag}')
+            if flag:
+                regressions.append({'scenario': scenario['name'], 'metric': path, 'baseline': old, 'current': new})
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='基于本地假上游的 /v1/chat 压测，输出 JSON 结果并可与基线对比')
+    parser.add_argument('--mode', choices=sorted(SERVERS), default='sync')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--providers', default=','.join(PROVIDERS))
+    parser.add_argument('--variants', default='chat,stream,errors', help='chat: 非流式, stream: 流式, errors: 注入错误')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--prompt-chars', type=int, default=500)
+    parser.add_argument('--latency', default='lognormal:0.05,0.5', help='上游延迟分布，格式见 fake_upstream')
+    parser.add_argument('--chunk-interval', default='0.002')
+    parser.add_argument('--stream-chunks', type=int, default=20)
+    parser.add_argument('--error-rate', type=float, default=0.05)
+    parser.add_argument('--disconnect-rate', type=float, default=0.01)
+    parser.add_argument('--output')
+    parser.add_argument('--compare', help='基线结果 JSON 文件')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='gateway-load-')
+    # 数据库和本机计数文件都放在临时目录，不影响 instance/ 下的数据
+    os.environ.update({
+        'GATEWAY_BENCH_DB': 'sqlite:///' + os.path.join(workdir, 'bench.db'),
+        'QUOTA_STORE_PATH': os.path.join(workdir, 'quota.db'),
+        'RATE_LIMIT_STORE_PATH': os.path.join(workdir, 'ratelimit.db'),
+        'JOB_STORE_PATH': os.path.join(workdir, 'jobs.db'),
+        'METRICS_DIR': os.path.join(workdir, 'metrics'),
+        'SEMANTIC_CACHE_DIR': os.path.join(workdir, 'semantic_cache')
+    })
+    from benchmarks.common import create_bench_app
+    app = create_bench_app()
+
+    upstream_port = free_port()
+    upstream = spawn(['-m', 'benchmarks.fake_upstream', '--port', str(upstream_port), '--seed', '1'])
+    results = {
+        'meta': {
+            'created_at': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'args': vars(args)
+        },
+        'scenarios': []
+    }
+    try:
+        wait_for_port(upstream_port)
+        for provider in args.providers.split(','):
+            for variant in args.variants.split(','):
+                result = run_scenario(app, args, upstream_port, provider, variant, workdir)
+                results['scenarios'].append(result)
+                print(json.dumps(result, ensure_ascii=False))
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f'{len(regressions)} regression(s) over {args.tolerance:.0%}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
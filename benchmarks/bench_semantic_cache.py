@@ -0,0 +1,101 @@
+import argparse
+import json
+import random
+import tempfile
+import time
+
+from flask import Flask
+
+from app.services.semantic_cache import SemanticCache
+
+
+def create_cache(directory, entries):
+    app = Flask(__name__, instance_path=directory)
+    app.config.update(
+        SEMANTIC_CACHE_ENABLED=True,
+        SEMANTIC_CACHE_DIR=directory,
+        SEMANTIC_CACHE_THRESHOLD=0.98,
+        SEMANTIC_CACHE_MAX_ENTRIES=entries,
+        SEMANTIC_CACHE_MAX_ENTRIES_PER_USER=entries
+    )
+    cache = SemanticCache(app)
+    cache.sync_interval = 0
+    return cache
+
+
+def make_prompts(count, seed=1):
+    # 随机抽词拼成的问题，相互之间基本不相似
+    rng = random.Random(seed)
+    words = [f'word{i}' for i in range(5000)]
+    return [' '.join(rng.choice(words) for _ in range(rng.randint(8, 24))) for _ in range(count)]
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return {
+        f'p{p}_ms': round(samples[min(len(samples) - 1, int(len(samples) * p / 100))] * 1000, 3)
+        for p in (50, 90, 99)
+    }
+
+
+def timed(func, items):
+    samples, results = [], []
+    for item in items:
+        started = time.perf_counter()
+        results.append(func(item))
+        samples.append(time.perf_counter() - started)
+    return samples, results
+
+
+def bench_partition(size, queries):
+    # 同一用户、同一模型的一个分区中有 size 条缓存时，写入、首次同步和查询的耗时，以及改写后问题的召回率
+    cache = create_cache(tempfile.mkdtemp(), size)
+    prompts = make_prompts(size)
+
+    def probe(text):
+        return cache.probe(1, 'fake-model', [{'role': 'user', 'content': text}])
+
+    store_samples, _ = timed(lambda text: cache.store(probe(text), {'response': {'text': text}, 'usage': {}}), prompts)
+    started = time.perf_counter()
+    cache.lookup(probe('warm up'))
+    sync_seconds = time.perf_counter() - started
+
+    sample = random.Random(2).sample(prompts, min(queries, size))
+    # 大小写和标点不同: 向量相同
+    hit_samples, hits = timed(lambda text: cache.lookup(probe(text.upper() + '?')), sample)
+    # 末尾多一个词: 多数问题的相似度低于哈希向量的 0.98 阈值，只有较长的问题会命中
+    near_samples, near = timed(lambda text: cache.lookup(probe(text + ' please')), sample)
+    miss_samples, misses = timed(lambda text: cache.lookup(probe(text)), make_prompts(len(sample), seed=3))
+    return {
+        'entries': size,
+        'store': percentiles(store_samples),
+        'sync_ms': round(sync_seconds * 1000, 2),
+        'hit': percentiles(hit_samples),
+        'near': percentiles(near_samples),
+        'miss': percentiles(miss_samples),
+        'recall': round(sum(bool(h) and h['response']['text'] == t for h, t in zip(hits, sample)) / len(sample), 3),
+        'near_recall': round(sum(bool(h) and h['response']['text'] == t for h, t in zip(near, sample)) / len(sample), 3),
+        'false_hits': sum(bool(h) for h in misses)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='语义缓存的写入和查询耗时')
+    parser.add_argument('--sizes', default='100,1000,5000')
+    parser.add_argument('--queries', type=int, default=300)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    results = []
+    for size in (int(s) for s in args.sizes.split(',')):
+        result = bench_partition(size, args.queries)
+        print(json.dumps(result))
+        results.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+import argparse
+import json
+import time
+
+from app.services.tokens import TokenEstimator, tiktoken_available
+
+ENGLISH = 'The quick brown fox jumps over the lazy dog while the gateway counts tokens. '
+CHINESE = '网关在转发请求之前估算输入的Token数，用于配额预留和上下文长度检查。'
+PROMPTS = {
+    'short': [
+        {'role': 'system', 'content': 'You are a helpful assistant.'},
+        {'role': 'user', 'content': 'Summarize the following paragraph in one sentence. ' * 2}
+    ],
+    'long_english': [
+        {'role': 'system', 'content': 'You are a helpful assistant.'},
+        {'role': 'user', 'content': ENGLISH * 400}
+    ],
+    'long_chinese': [
+        {'role': 'system', 'content': '你是一个有帮助的助手。'},
+        {'role': 'user', 'content': CHINESE * 200}
+    ],
+    'multi_turn': [{'role': 'system', 'content': 'You are a helpful assistant. ' * 20}] + [
+        {'role': 'user' if i % 2 == 0 else 'assistant', 'content': (ENGLISH if i % 3 else CHINESE) * 3}
+        for i in range(20)
+    ]
+}
+MODELS = {'openai': 'gpt-3.5-turbo', 'anthropic': 'claude-3-haiku-20240307', 'qwen': 'qwen-turbo'}
+
+
+def legacy_estimate(messages, max_tokens):
+    # 改动前的估算方式，作为耗时和结果的对照
+    prompt_chars = sum(len(str(m.get('content', ''))) for m in messages if isinstance(m, dict))
+    return prompt_chars // 4 + 4 * len(messages) + (max_tokens or 256)
+
+
+def create_estimator(backend):
+    estimator = TokenEstimator()
+    estimator.backend = backend
+    if backend != 'heuristic':
+        # 同步加载词表，测量时不包含后台加载
+        for name in ('cl100k_base', 'o200k_base'):
+            estimator._loading.add(name)
+            estimator._load(name)
+    return estimator
+
+
+def per_request_us(func, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return round((time.perf_counter() - started) / iterations * 1e6, 2)
+
+
+def bench_prompt(estimator, messages, provider, iterations):
+    # cold 为每次请求都重新计数 (新文本)，warm 为重试、故障转移和相同系统提示词命中缓存时的耗时
+    model = MODELS[provider]
+
+    def cold():
+        estimator._cache.clear()
+        estimator.admit(messages, 256, provider, model)
+
+    return {
+        'tokens': estimator.prompt_tokens(messages, provider, model),
+        'cold_us': per_request_us(cold, iterations),
+        'warm_us': per_request_us(lambda: estimator.admit(messages, 256, provider, model), iterations)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Token估算的单请求耗时')
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--providers', default='openai,anthropic,qwen')
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    backends = ['heuristic'] + (['tiktoken'] if tiktoken_available() else [])
+    results = {}
+    for name, messages in PROMPTS.items():
+        results[name] = {'legacy': {
+            'tokens': legacy_estimate(messages, None) - 256,
+            'us': per_request_us(lambda: legacy_estimate(messages, 256), args.iterations)
+        }}
+        for backend in backends:
+            estimator = create_estimator(backend)
+            for provider in args.providers.split(','):
+                results[name][f'{backend}/{provider}'] = bench_prompt(estimator, messages, provider, args.iterations)
+        print(name, json.dumps(results[name]))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
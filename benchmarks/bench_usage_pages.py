@@ -0,0 +1,136 @@
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from benchmarks.common import create_bench_app, seed
+
+PASSWORD = 'benchmark'
+PROVIDERS = ['openai', 'anthropic', 'deepseek', 'qwen']
+PAGES = {
+    'dashboard': '/v1/dashboard',
+    'usage_7d': '/v1/usage?days=7',
+    'usage_30d': '/v1/usage?days=30',
+    'usage_90d': '/v1/usage?days=90'
+}
+
+
+def seed_records(app, rows, users, days, batch=20000):
+    # 第一个用户是压测登录用户，其余用户的记录用来模拟共享的大表
+    from app.models import db, User, UsageRecord
+    from app.routes.auth import bcrypt
+    with app.app_context():
+        bench_user = User.query.first()
+        bench_user.password_hash = bcrypt.generate_password_hash(PASSWORD).decode('utf-8')
+        for i in range(1, users):
+            db.session.add(User(username=f'noise-{i}', email=f'noise-{i}@example.com', password_hash='-', api_key=f'sk-noise-{i}'))
+        db.session.commit()
+        user_ids = [u.id for u in User.query.all()]
+        key_id = bench_user.api_keys[0].id
+
+        now = datetime.utcnow()
+        span = days * 86400
+        rng = random.Random(42)
+        insert = UsageRecord.__table__.insert()
+        for offset in range(0, rows, batch):
+            events = []
+            for _ in range(min(batch, rows - offset)):
+                prompt, completion = rng.randint(10, 2000), rng.randint(10, 1000)
+                events.append({
+                    'user_id': rng.choice(user_ids),
+                    'api_key_id': key_id,
+                    'provider': rng.choice(PROVIDERS),
+                    'model': 'fake-model',
+                    'prompt_tokens': prompt,
+                    'completion_tokens': completion,
+                    'total_tokens': prompt + completion,
+                    'status': 'success' if rng.random() > 0.05 else 'error',
+                    'created_at': now - timedelta(seconds=rng.randint(0, span))
+                })
+            db.session.execute(insert, events)
+            db.session.commit()
+        db.session.execute(text('ANALYZE'))
+        db.session.commit()
+
+
+def measure(client, path, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        response = client.get(path)
+        timings.append(time.perf_counter() - started)
+        assert response.status_code == 200, (path, response.status_code)
+    timings.sort()
+    return {'median_ms': round(timings[len(timings) // 2] * 1000, 2), 'max_ms': round(timings[-1] * 1000, 2)}
+
+
+def run_pages(app, repeat):
+    client = app.test_client()
+    client.post('/auth/login', data={'username': 'bench', 'password': PASSWORD})
+    results = {name: measure(client, path, repeat) for name, path in PAGES.items()}
+
+    # 深翻页：沿着“更早的记录”链接走到第20页
+    path = '/v1/usage?days=90'
+    with app.app_context():
+        from app.services.usage_stats import record_page
+        from app.models import User
+        user_id = User.query.filter_by(username='bench').first().id
+        cursor = None
+        for _ in range(20):
+            _, cursor = record_page(user_id, datetime.utcnow() - timedelta(days=90), cursor, app.config['USAGE_PAGE_SIZE'])
+            if cursor is None:
+                break
+    if cursor:
+        results['usage_90d_page20'] = measure(client, f'{path}&before={cursor}', repeat)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='大用量表下仪表盘和使用统计页面的响应时间')
+    parser.add_argument('--rows', type=int, default=500000)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--compare-without-index', action='store_true')
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='gateway-bench-')
+    os.environ['GATEWAY_BENCH_DB'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+
+    app = create_bench_app()
+    seed(app, 'http://127.0.0.1:9')
+    started = time.perf_counter()
+    seed_records(app, args.rows, args.users, args.days)
+    print(f'seeded {args.rows} rows in {time.perf_counter() - started:.1f}s')
+
+    # 原始记录是直接插入的，汇总表需要回填一次
+    from app.services.rollups import rebuild
+    started = time.perf_counter()
+    with app.app_context():
+        rebuild()
+    print(f'backfilled rollups in {time.perf_counter() - started:.1f}s')
+
+    results = {'rows': args.rows, 'users': args.users, 'with_index': run_pages(app, args.repeat)}
+    print(json.dumps(results['with_index'], ensure_ascii=False))
+
+    if args.compare_without_index:
+        from app.models import db
+        with app.app_context():
+            db.session.execute(text('DROP INDEX ix_usage_records_user_created'))
+            db.session.commit()
+        results['without_index'] = run_pages(app, args.repeat)
+        print(json.dumps(results['without_index'], ensure_ascii=False))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
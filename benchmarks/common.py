@@ -0,0 +1,75 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from app import create_app
+from app.config import Config
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_API_KEY = 'sk-benchmark'
+
+
+def bench_config():
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = os.environ.get('GATEWAY_BENCH_DB', 'sqlite:///gateway_bench.db')
+    return BenchConfig
+
+
+def create_bench_app():
+    return create_app(bench_config())
+
+
+def create_bench_asgi_app():
+    from app.asgi import create_asgi_app
+    return create_asgi_app(bench_config())
+
+
+def seed(app, upstream_url, provider='openai', keys=1):
+    from app.models import db, User, APIKey
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        user = User(username='bench', email='bench@example.com', password_hash='-', api_key=BENCH_API_KEY)
+        db.session.add(user)
+        db.session.commit()
+        for i in range(keys):
+            db.session.add(APIKey(
+                user_id=user.id,
+                name=f'bench-{i}',
+                provider=provider,
+                api_key=f'upstream-{i}',
+                base_url=upstream_url,
+                model='fake-model',
+                priority=keys - i
+            ))
+        db.session.commit()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'port {port} did not open within {timeout}s')
+
+
+def spawn(args, env=None):
+    process_env = dict(os.environ, PYTHONPATH=ROOT, **(env or {}))
+    return subprocess.Popen(
+        [sys.executable] + args,
+        cwd=ROOT,
+        env=process_env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
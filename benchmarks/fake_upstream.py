@@ -0,0 +1,293 @@
+import argparse
+import asyncio
+import json
+import math
+import random
+
+# 按请求路径识别网关调用的是哪种提供商接口
+ROUTES = (
+    ('/openai/deployments/', 'azure'),
+    ('/messages', 'anthropic'),
+    ('/services/aigc/text-generation/generation', 'qwen'),
+    ('/text/chatcompletion_v2', 'minimax'),
+    ('/embeddings', 'embeddings'),
+    ('/chat/completions', 'openai'),
+)
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 429: 'Too Many Requests', 500: 'Internal Server Error',
+           502: 'Bad Gateway', 503: 'Service Unavailable', 504: 'Gateway Timeout'}
+
+
+def parse_latency(spec):
+    # "0.5" 或 "constant:0.5"、"uniform:0.1,0.5"、"normal:0.5,0.1" (均值, 标准差)、
+    # "lognormal:0.3,0.8" (中位数, sigma)、"exponential:0.5" (均值)，单位秒
+    kind, _, params = str(spec).partition(':')
+    if not params:
+        kind, params = 'constant', kind
+    values = [float(v) for v in params.split(',')]
+    samplers = {
+        'constant': lambda rng: values[0],
+        'uniform': lambda rng: rng.uniform(values[0], values[1]),
+        'normal': lambda rng: rng.gauss(values[0], values[1]),
+        'lognormal': lambda rng: rng.lognormvariate(math.log(values[0]), values[1]),
+        'exponential': lambda rng: rng.expovariate(1 / values[0]) if values[0] else 0,
+    }
+    if kind not in samplers:
+        raise ValueError(f'unknown latency distribution: {kind}')
+    sampler = samplers[kind]
+    return lambda rng: max(sampler(rng), 0.0)
+
+
+def provider_for(path):
+    for marker, provider in ROUTES:
+        if marker in path:
+            return provider
+    return None
+
+
+class Behavior:
+    # 假上游的行为，运行中可以通过 POST /__config 修改
+    FIELDS = ('latency', 'chunk_interval', 'stream_chunks', 'response_chars', 'error_rate', 'error_statuses',
+              'disconnect_rate')
+
+    def __init__(self, latency='0', chunk_interval='0', stream_chunks=20, response_chars=2, error_rate=0.0,
+                 error_statuses=(500, 502, 503, 429), disconnect_rate=0.0):
+        self.update({
+            'latency': latency, 'chunk_interval': chunk_interval, 'stream_chunks': stream_chunks,
+            'response_chars': response_chars, 'error_rate': error_rate, 'error_statuses': error_statuses,
+            'disconnect_rate': disconnect_rate
+        })
+
+    def update(self, values):
+        for name in self.FIELDS:
+            if name in values:
+                setattr(self, name, values[name])
+        self.sample_latency = parse_latency(self.latency)
+        self.sample_interval = parse_latency(self.chunk_interval)
+        if isinstance(self.error_statuses, str):
+            self.error_statuses = [int(s) for s in self.error_statuses.split(',') if s]
+
+    def describe(self):
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+
+class FakeUpstream:
+    # 基于 asyncio 的本地假上游，单进程即可同时挂起上千个慢请求。按路径返回 OpenAI / Azure / Anthropic /
+    # Qwen / MiniMax 格式的响应，支持 SSE 流式输出、可配置的延迟分布、错误状态码和中途断开连接
+    def __init__(self, latency=1.0, behavior=None, seed=None):
+        self.behavior = behavior or Behavior(latency=latency)
+        self.rng = random.Random(seed)
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.stats = {'requests': {}, 'streams': 0, 'errors': {}, 'disconnects': 0}
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                method, path = request_line.split()[:2]
+                keep_alive = await self.dispatch(writer, method.decode(), path.decode(), headers, body)
+                await writer.drain()
+                if not keep_alive or headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, writer, method, path, headers, body):
+        # 返回是否保持连接
+        if path.startswith('/__'):
+            writer.write(self.control(method, path, body))
+            return True
+        provider = provider_for(path)
+        if provider is None:
+            writer.write(self.render(404, {'error': {'message': f'unknown path {path}'}}))
+            return True
+        self.requests += 1
+        self.stats['requests'][provider] = self.stats['requests'].get(provider, 0) + 1
+        behavior = self.behavior
+        await asyncio.sleep(behavior.sample_latency(self.rng))
+
+        roll = self.rng.random()
+        if roll < behavior.disconnect_rate:
+            self.stats['disconnects'] += 1
+            return False
+        if roll < behavior.disconnect_rate + behavior.error_rate:
+            status = self.rng.choice(behavior.error_statuses)
+            self.stats['errors'][str(status)] = self.stats['errors'].get(str(status), 0) + 1
+            extra = {'Retry-After': '1'} if status == 429 else None
+            writer.write(self.render(status, {'error': {'message': 'injected error', 'type': 'fake_upstream'}}, extra))
+            return True
+
+        try:
+            payload = json.loads(body or b'{}')
+        except ValueError:
+            writer.write(self.render(400, {'error': {'message': 'invalid JSON'}}))
+            return True
+        prompt_tokens = max(len(body) // 4, 1)
+        if provider == 'embeddings':
+            writer.write(self.render(200, self.embeddings(payload)))
+            return True
+        stream = payload.get('stream') is True or headers.get('x-dashscope-sse') == 'enable'
+        if not stream:
+            writer.write(self.render(200, self.completion(provider, prompt_tokens)))
+            return True
+        self.stats['streams'] += 1
+        return await self.stream(writer, provider, prompt_tokens, payload)
+
+    def control(self, method, path, body):
+        if path == '/__config' and method == 'POST':
+            self.behavior.update(json.loads(body or b'{}'))
+            return self.render(200, self.behavior.describe())
+        if path == '/__reset' and method == 'POST':
+            self.reset()
+            return self.render(200, {})
+        if path == '/__stats':
+            return self.render(200, dict(self.stats, total=self.requests, behavior=self.behavior.describe()))
+        return self.render(404, {'error': {'message': f'unknown path {path}'}})
+
+    def text(self):
+        return 'ok' + 'x' * max(self.behavior.response_chars - 2, 0)
+
+    def completion(self, provider, prompt_tokens):
+        completion_tokens = max(len(self.text()) // 4, 1)
+        if provider == 'anthropic':
+            return {
+                'id': 'msg_fake', 'type': 'message', 'role': 'assistant',
+                'content': [{'type': 'text', 'text': self.text()}], 'stop_reason': 'end_turn',
+                'usage': {'input_tokens': prompt_tokens, 'output_tokens': completion_tokens}
+            }
+        if provider == 'qwen':
+            return {
+                'output': {'text': self.text(), 'finish_reason': 'stop'},
+                'usage': {'input_tokens': prompt_tokens, 'output_tokens': completion_tokens,
+                          'total_tokens': prompt_tokens + completion_tokens},
+                'request_id': 'fake'
+            }
+        return {
+            'id': 'chatcmpl-fake',
+            'object': 'chat.completion',
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': self.text()}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                      'total_tokens': prompt_tokens + completion_tokens}
+        }
+
+    @staticmethod
+    def embeddings(payload):
+        inputs = payload.get('input')
+        inputs = inputs if isinstance(inputs, list) else [inputs]
+        tokens = sum(max(len(str(text)) // 4, 1) for text in inputs)
+        return {
+            'object': 'list',
+            'data': [{'object': 'embedding', 'index': i, 'embedding': [0.0] * 8} for i in range(len(inputs))],
+            'usage': {'prompt_tokens': tokens, 'total_tokens': tokens}
+        }
+
+    def stream_events(self, provider, prompt_tokens, payload):
+        # 每个元素是一个完整的 SSE 事件，各提供商的事件格式与真实接口一致
+        chunks = self.behavior.stream_chunks
+        if provider == 'anthropic':
+            yield {'type': 'message_start', 'message': {'usage': {'input_tokens': prompt_tokens, 'output_tokens': 1}}}
+            for _ in range(chunks):
+                yield {'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': 'ok '}}
+            yield {'type': 'message_delta', 'delta': {'stop_reason': 'end_turn'}, 'usage': {'output_tokens': chunks}}
+            yield {'type': 'message_stop'}
+        elif provider == 'qwen':
+            for i in range(chunks):
+                yield {
+                    'output': {'text': 'ok ', 'finish_reason': 'stop' if i == chunks - 1 else 'null'},
+                    'usage': {'input_tokens': prompt_tokens, 'output_tokens': i + 1, 'total_tokens': prompt_tokens + i + 1}
+                }
+        else:
+            usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': chunks, 'total_tokens': prompt_tokens + chunks}
+            for i in range(chunks):
+                yield {'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk',
+                       'choices': [{'index': 0, 'delta': {'content': 'ok '}, 'finish_reason': None}]}
+            last = {'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk',
+                    'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]}
+            if provider == 'minimax':
+                # MiniMax 在最后一个事件中返回用量
+                last['usage'] = usage
+            yield last
+            if (payload.get('stream_options') or {}).get('include_usage'):
+                yield {'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'choices': [], 'usage': usage}
+            yield '[DONE]'
+
+    async def stream(self, writer, provider, prompt_tokens, payload):
+        head = (
+            'HTTP/1.1 200 OK\r\n'
+            'Content-Type: text/event-stream\r\n'
+            'Transfer-Encoding: chunked\r\n'
+            'Connection: keep-alive\r\n\r\n'
+        )
+        writer.write(head.encode())
+        events = list(self.stream_events(provider, prompt_tokens, payload))
+        # 注入断开时在流的中间断开
+        cut = len(events) // 2 if self.rng.random() < self.behavior.disconnect_rate else None
+        for index, event in enumerate(events):
+            if index == cut:
+                self.stats['disconnects'] += 1
+                return False
+            data = event if isinstance(event, str) else json.dumps(event)
+            chunk = f'data: {data}\n\n'.encode()
+            writer.write(b'%x\r\n' % len(chunk) + chunk + b'\r\n')
+            await writer.drain()
+            interval = self.behavior.sample_interval(self.rng)
+            if interval:
+                await asyncio.sleep(interval)
+        writer.write(b'0\r\n\r\n')
+        return True
+
+    @staticmethod
+    def render(status, payload, extra_headers=None):
+        body = json.dumps(payload).encode()
+        head = (
+            f'HTTP/1.1 {status} {REASONS.get(status, "Error")}\r\n'
+            'Content-Type: application/json\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            'Connection: keep-alive\r\n'
+        )
+        head += ''.join(f'{name}: {value}\r\n' for name, value in (extra_headers or {}).items())
+        return head.encode() + b'\r\n' + body
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port, backlog=4096)
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地假LLM上游')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--latency', default='1.0', help='响应头之前的延迟，如 0.5、uniform:0.1,0.5、lognormal:0.3,0.8')
+    parser.add_argument('--chunk-interval', default='0', help='流式输出相邻事件的间隔，格式同 --latency')
+    parser.add_argument('--stream-chunks', type=int, default=20)
+    parser.add_argument('--response-chars', type=int, default=2)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-statuses', default='500,502,503,429')
+    parser.add_argument('--disconnect-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+    behavior = Behavior(
+        latency=args.latency, chunk_interval=args.chunk_interval, stream_chunks=args.stream_chunks,
+        response_chars=args.response_chars, error_rate=args.error_rate, error_statuses=args.error_statuses,
+        disconnect_rate=args.disconnect_rate
+    )
+    asyncio.run(FakeUpstream(behavior=behavior, seed=args.seed).serve(args.host, args.port))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import asyncio
+import threading
+
+import pytest
+from flask import Flask
+
+from app import create_app
+from app.config import Config
+from app.services.auth_cache import auth_cache
+from app.services.usage_writer import usage_writer
+from benchmarks.common import BENCH_API_KEY, free_port, seed, wait_for_port
+from benchmarks.fake_upstream import Behavior, FakeUpstream
+
+
+@pytest.fixture(scope='session')
+def upstream():
+    # 与压测相同的假上游，在后台线程的事件循环中运行
+    fake = FakeUpstream(behavior=Behavior(), seed=1)
+    port = free_port()
+    threading.Thread(target=lambda: asyncio.run(fake.serve('127.0.0.1', port)), daemon=True).start()
+    wait_for_port(port)
+    fake.url = f'http://127.0.0.1:{port}'
+    return fake
+
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory, upstream):
+    directory = tmp_path_factory.mktemp('gateway')
+
+    class TestConfig(Config):
+        TESTING = True
+        SQLALCHEMY_DATABASE_URI = f'sqlite:///{directory / "gateway.db"}'
+        QUOTA_STORE_PATH = str(directory / 'quota.db')
+        RATE_LIMIT_STORE_PATH = str(directory / 'ratelimit.db')
+        JOB_STORE_PATH = str(directory / 'jobs.db')
+        METRICS_DIR = str(directory / 'metrics')
+        SEMANTIC_CACHE_DIR = str(directory / 'semantic_cache')
+        USAGE_SPILL_DIR = str(directory / 'usage_spill')
+        RESPONSE_CACHE_PATH = str(directory / 'response_cache.db')
+        RETRY_BASE_DELAY = 0
+
+    return create_app(TestConfig)
+
+
+@pytest.fixture
+def gateway(app, upstream):
+    # 每个用例重新建库，两个上游Key都指向假上游
+    seed(app, upstream.url, keys=2)
+    auth_cache.clear()
+    upstream.behavior.update(Behavior().describe())
+    yield app
+    usage_writer.flush()
+
+
+@pytest.fixture
+def client(gateway):
+    return gateway.test_client()
+
+
+@pytest.fixture
+def auth():
+    return {'Authorization': f'Bearer {BENCH_API_KEY}'}
+
+
+@pytest.fixture
+def bare_app(tmp_path):
+    # 只用来初始化单个服务的空应用，instance 目录在临时目录下
+    return Flask(__name__, instance_path=str(tmp_path))
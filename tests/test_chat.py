@@ -0,0 +1,56 @@
+from app.models import UsageRecord
+from app.services.usage_writer import usage_writer
+
+MESSAGES = [{'role': 'user', 'content': 'hello'}]
+
+
+def records(app):
+    usage_writer.flush()
+    with app.app_context():
+        return [(r.status, r.total_tokens) for r in UsageRecord.query.order_by(UsageRecord.id)]
+
+
+def test_chat_relays_the_upstream_response_and_records_usage(client, auth):
+    response = client.post('/v1/chat', json={'messages': MESSAGES}, headers=auth)
+    assert response.status_code == 200
+    payload = response.get_json()
+    assert payload['choices'][0]['message']['content'] == 'ok'
+    assert records(client.application) == [('success', payload['usage']['total_tokens'])]
+
+
+def test_stream_usage_is_recorded_after_the_last_event(client, auth, upstream):
+    upstream.behavior.update({'stream_chunks': 3})
+    response = client.post(
+        '/v1/chat', json={'messages': MESSAGES, 'stream': True, 'stream_options': {'include_usage': True}}, headers=auth
+    )
+    body = response.get_data(as_text=True)
+    assert response.status_code == 200
+    assert body.count('"ok "') == 3
+    assert body.endswith('data: [DONE]\n\n')
+    [(status, tokens)] = records(client.application)
+    assert status == 'success' and tokens > 3
+
+
+def test_client_disconnect_records_partial_stream_usage(client, auth, upstream):
+    upstream.behavior.update({'stream_chunks': 10})
+    response = client.post('/v1/chat', json={'messages': MESSAGES, 'stream': True}, headers=auth, buffered=False)
+    chunks = iter(response.response)
+    next(chunks)
+    next(chunks)
+    response.close()
+    [(status, tokens)] = records(client.application)
+    assert status == 'cancelled' and tokens > 0
+
+
+def test_upstream_errors_fail_over_and_are_recorded(client, auth, upstream):
+    upstream.behavior.update({'error_rate': 1.0, 'error_statuses': '400'})
+    response = client.post('/v1/chat', json={'messages': MESSAGES}, headers=auth)
+    assert response.status_code == 500
+    # 400 不重试，两个Key各失败一次
+    assert [status for status, _ in records(client.application)] == ['error', 'error']
+
+
+def test_request_validation(client, auth):
+    assert client.post('/v1/chat', json={'messages': MESSAGES}).status_code == 401
+    assert client.post('/v1/chat', data=b'{', headers=auth).status_code == 400
+    assert client.post('/v1/chat', json=['not', 'an', 'object'], headers=auth).status_code == 400
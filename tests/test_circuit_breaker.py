@@ -0,0 +1,49 @@
+from app.services import circuit_breaker
+from app.services.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_opens_after_threshold_and_recovers_through_half_open(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(circuit_breaker.time, 'monotonic', clock)
+    breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=30, half_open_max_calls=1)
+
+    breaker.record_failure()
+    assert breaker.state == CLOSED and breaker.available()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.available() and not breaker.acquire()
+    assert breaker.snapshot()['retry_in'] == 30
+
+    # 恢复时间过后进入半开状态，只放行一个探测请求
+    clock.now += 30
+    assert breaker.available()
+    assert breaker.acquire()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.acquire()
+
+    breaker.record_success()
+    assert breaker.state == CLOSED and breaker.failures == 0
+
+
+def test_failed_probe_reopens_and_cancelled_probe_is_returned(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(circuit_breaker.time, 'monotonic', clock)
+    breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=10, half_open_max_calls=1)
+    breaker.record_failure()
+    clock.now += 10
+
+    assert breaker.acquire()
+    breaker.release()
+    assert breaker.acquire()
+
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.acquire()
@@ -0,0 +1,45 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+from flask import current_app
+
+from app.services.hedging import Hedger
+
+
+@pytest.fixture
+def hedger(bare_app):
+    bare_app.config.update(HEDGE_ENABLED=True, HEDGE_DELAY=0.02)
+    return Hedger(bare_app)
+
+
+def test_backup_wins_and_the_slow_loser_is_recorded_with_an_app_context(bare_app, hedger):
+    primary, backup = SimpleNamespace(id=1), SimpleNamespace(id=2)
+    recorded = threading.Event()
+    losers = []
+
+    def call(api_key):
+        if api_key is primary:
+            time.sleep(0.2)
+        return {'success': True, 'usage': {'total_tokens': api_key.id}}
+
+    def on_loser(api_key, result):
+        # 落败的请求在请求返回后才完成，记录时仍需要访问数据库
+        losers.append((api_key, result, current_app.name))
+        recorded.set()
+
+    with bare_app.app_context():
+        api_key, result, hedged = hedger.run(call, primary, backup, on_loser)
+    assert (api_key, hedged) == (backup, True)
+    assert hedger.counters['hedge_wins'] == 1
+
+    assert recorded.wait(2)
+    assert losers == [(primary, {'success': True, 'usage': {'total_tokens': 1}}, bare_app.name)]
+
+
+def test_fast_primary_is_not_hedged(bare_app, hedger):
+    with bare_app.app_context():
+        api_key, _, hedged = hedger.run(lambda key: {'success': True}, SimpleNamespace(id=1), SimpleNamespace(id=2), None)
+    assert api_key.id == 1 and not hedged
+    assert hedger.counters['hedged'] == 0
@@ -0,0 +1,40 @@
+import threading
+
+import pytest
+import requests
+
+from app.services.http_pool import UpstreamPool
+from benchmarks.common import free_port
+
+
+@pytest.fixture
+def pool(bare_app):
+    pool = UpstreamPool(bare_app)
+    yield pool
+    pool.close()
+
+
+def test_concurrent_requests_share_one_pool_per_host_and_are_all_counted(pool, upstream):
+    url = f'{upstream.url}/v1/chat/completions'
+
+    def worker():
+        for _ in range(10):
+            assert pool.post(url, json={'messages': []}, timeout=5).status_code == 200
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    [host] = pool.stats()['hosts'].values()
+    assert (host['requests'], host['errors']) == (80, 0)
+    # 保持连接时连接数不超过并发线程数
+    assert host['connections_opened'] <= 8
+
+
+def test_connection_errors_are_counted(pool):
+    with pytest.raises(requests.ConnectionError):
+        pool.post(f'http://127.0.0.1:{free_port()}/v1/chat/completions', json={}, timeout=1)
+    [host] = pool.stats()['hosts'].values()
+    assert (host['requests'], host['errors']) == (1, 1)
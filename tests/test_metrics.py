@@ -0,0 +1,41 @@
+import shutil
+import threading
+
+import pytest
+
+from app.services.metrics import Metrics
+
+
+@pytest.fixture
+def registry(bare_app, tmp_path):
+    bare_app.config.update(METRICS_DIR=str(tmp_path / 'metrics'), METRICS_FLUSH_INTERVAL=0)
+    return Metrics(bare_app)
+
+
+def test_concurrent_flushes_do_not_fail_requests(registry):
+    errors = []
+
+    def worker():
+        try:
+            for _ in range(200):
+                registry.inc('gateway_upstream_retries_total', provider='openai', reason='exception')
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+    registry.flush()
+    [(key, value)] = registry.collect().items()
+    assert key[0] == 'gateway_upstream_retries_total'
+    assert value == 1600
+
+
+def test_unwritable_metrics_directory_is_only_logged(registry):
+    shutil.rmtree(registry.directory)
+    registry.inc('gateway_upstream_retries_total', provider='openai', reason='exception')
+    registry.flush()
@@ -0,0 +1,52 @@
+import json
+from datetime import datetime
+
+import pytest
+from flask import jsonify
+from flask.json.provider import DefaultJSONProvider
+
+from app.services.passthrough import Passthrough, scan_usage
+
+
+def test_scan_usage_reads_only_the_trailing_usage_object():
+    body = json.dumps({
+        'choices': [{'message': {'content': 'the "usage" field is {not json}'}}],
+        'usage': {'prompt_tokens': 3, 'completion_tokens': 4, 'total_tokens': 7,
+                  'prompt_tokens_details': {'cached_tokens': 1}}
+    }).encode()
+    assert scan_usage(body) == {
+        'prompt_tokens': 3, 'completion_tokens': 4, 'total_tokens': 7, 'prompt_tokens_details': {'cached_tokens': 1}
+    }
+
+
+def test_scan_usage_returns_none_when_the_caller_must_parse():
+    assert scan_usage(b'{"choices": []}') is None
+    assert scan_usage(b'{"usage": null}') is None
+    assert scan_usage(b'{"usage": {"prompt_tokens": 3') is None
+
+
+def test_patch_prepends_missing_fields_and_keeps_the_rest_byte_for_byte():
+    passthrough = Passthrough()
+    raw = b'{"messages": [{"role": "user", "content": "hi"}], "seed": 1}'
+    patched = passthrough.patch(raw, {'model': 'm'})
+    assert patched.endswith(raw[1:])
+    assert json.loads(patched) == {'model': 'm', 'messages': [{'role': 'user', 'content': 'hi'}], 'seed': 1}
+
+    assert json.loads(passthrough.patch(b'{ }', {'model': 'm'})) == {'model': 'm'}
+    assert passthrough.patch(raw, {}) is raw
+
+
+def test_jsonify_serializes_with_orjson(bare_app, monkeypatch):
+    pytest.importorskip('orjson')
+    bare_app.config['JSON_BACKEND'] = 'orjson'
+    Passthrough(bare_app)
+
+    def stdlib_dumps(self, obj, **kwargs):
+        raise AssertionError('jsonify 回退到了标准库 json')
+
+    monkeypatch.setattr(DefaultJSONProvider, 'dumps', stdlib_dumps)
+    with bare_app.app_context():
+        response = jsonify({'text': '你好', 'at': datetime(2024, 5, 1, 10, 30)})
+        assert bare_app.json.dumps([1, {'a': None}], separators=(',', ':')) == '[1,{"a":null}]'
+    assert response.mimetype == 'application/json'
+    assert response.get_data() == '{"at":"Wed, 01 May 2024 10:30:00 GMT","text":"你好"}\n'.encode('utf-8')
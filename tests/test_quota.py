@@ -0,0 +1,71 @@
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+
+from app.services.quota import SCOPE_KEY, SCOPE_USER, QuotaExceeded, QuotaStore
+
+
+def upstream_key(key_id=1, daily_limit=0):
+    return SimpleNamespace(
+        id=key_id, is_free=False, max_tokens_per_day=daily_limit, last_used_at=None, used_tokens_today=0
+    )
+
+
+@pytest.fixture
+def store(bare_app):
+    return QuotaStore(bare_app)
+
+
+def test_reservation_is_replaced_by_actual_usage_on_settle(store):
+    key = upstream_key()
+    first = store.reserve(1, 100, key, 60)
+    with pytest.raises(QuotaExceeded) as exceeded:
+        store.reserve(1, 100, key, 60)
+    assert exceeded.value.scope == SCOPE_USER
+
+    # 实际只用了10个，多预留的50个归还后第二个请求可以放行
+    store.settle(first, 10)
+    second = store.reserve(1, 100, key, 60)
+    assert store.used_today(SCOPE_USER, [1]) == {1: 70}
+    assert store.used_today(SCOPE_KEY, [1]) == {1: 70}
+
+    store.release(second)
+    assert store.used_today(SCOPE_USER, [1]) == {1: 10}
+
+
+def test_key_limit_rejects_and_is_remembered_for_selection(store):
+    key = upstream_key(key_id=2, daily_limit=50)
+    store.reserve(1, 0, key, 40)
+    with pytest.raises(QuotaExceeded) as exceeded:
+        store.reserve(1, 0, key, 20)
+    assert exceeded.value.scope == SCOPE_KEY
+    # 剩余10个: 更大的请求在选Key时直接跳过
+    assert store.exhausted(key, 20)
+    assert not store.exhausted(key, 5)
+    # 被拒绝的预留不计入用户的用量
+    assert store.used_today(SCOPE_USER, [1]) == {1: 40}
+
+
+def test_settle_ignores_missing_reservation(store):
+    store.settle(None, 100)
+    assert store.counters['settled'] == 0
+
+
+def test_failed_settle_leaves_the_connection_usable(store):
+    key = upstream_key()
+    reservation = store.reserve(1, 0, key, 60)
+    conn = store._connect()
+    conn.execute(
+        "CREATE TRIGGER fail_settle BEFORE UPDATE ON quota_counters WHEN NEW.used > 1000 "
+        "BEGIN SELECT RAISE(ABORT, 'settle failed'); END"
+    )
+    with pytest.raises(sqlite3.IntegrityError):
+        store.settle(reservation, 5000)
+    assert not conn.in_transaction
+    assert reservation.amount == 60
+
+    conn.execute('DROP TRIGGER fail_settle')
+    store.settle(reservation, 20)
+    assert store.reserve(1, 0, key, 10)
+    assert store.used_today(SCOPE_USER, [1]) == {1: 30}
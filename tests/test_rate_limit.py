@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+
+from app.services import rate_limit
+from app.services.quota import SCOPE_KEY, SCOPE_USER
+from app.services.rate_limit import RateLimiter
+
+
+@pytest.fixture
+def limiter(bare_app, monkeypatch):
+    clock = [1_000_000.0]
+    monkeypatch.setattr(rate_limit.time, 'time', lambda: clock[0])
+    limiter = RateLimiter(bare_app)
+    limiter.clock = clock
+    return limiter
+
+
+def test_request_bucket_refills_at_the_per_minute_rate(limiter):
+    assert limiter.check(SCOPE_USER, 1, 2, 0, 0).allowed
+    assert limiter.check(SCOPE_USER, 1, 2, 0, 0).allowed
+    state = limiter.check(SCOPE_USER, 1, 2, 0, 0)
+    assert not state.allowed
+    assert state.retry_after == pytest.approx(30)
+    assert state.headers()['Retry-After'] == '30'
+
+    # 每分钟2个请求: 30秒补回1个
+    limiter.clock[0] += 30
+    assert limiter.check(SCOPE_USER, 1, 2, 0, 0).allowed
+    assert not limiter.check(SCOPE_USER, 1, 2, 0, 0).allowed
+
+
+def test_token_bucket_is_charged_after_the_request_and_can_go_negative(limiter):
+    assert limiter.check(SCOPE_KEY, 7, 0, 600, 100).allowed
+    limiter.consume(SCOPE_KEY, 7, 600, 900)
+    state = limiter.check(SCOPE_KEY, 7, 0, 600, 100)
+    assert not state.allowed
+    # 透支300个，还需要再补100个: 每秒补10个
+    assert state.retry_after == pytest.approx(40)
+
+    limiter.clock[0] += 40
+    assert limiter.check(SCOPE_KEY, 7, 0, 600, 100).allowed
+
+
+def test_buckets_are_separate_per_owner_and_unlimited_owners_skip_the_store(limiter):
+    assert limiter.check(SCOPE_USER, 1, 1, 0, 0).allowed
+    assert not limiter.check(SCOPE_USER, 1, 1, 0, 0).allowed
+    assert limiter.check(SCOPE_USER, 2, 1, 0, 0).allowed
+    assert limiter.check(SCOPE_USER, 3, 0, 0, 0) is None
+
+
+def test_acquire_async_checks_in_an_executor(limiter):
+    async def acquire():
+        return await limiter.acquire_async(SCOPE_USER, 1, 1, 0, 0, max_wait=0)
+
+    assert asyncio.run(acquire()).allowed
+    assert not asyncio.run(acquire()).allowed
+    assert asyncio.run(limiter.acquire_async(SCOPE_USER, 1, 0, 0, 0)) is None
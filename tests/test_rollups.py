@@ -0,0 +1,51 @@
+from datetime import datetime
+
+from app.models import db, APIKey, UsageRollupDaily, UsageRollupHourly
+from app.services.rollups import aggregate, rebuild
+from app.services.usage_writer import usage_writer
+
+
+def event(status='success', created_at=datetime(2024, 5, 1, 10, 30), **fields):
+    return dict({
+        'user_id': 1, 'api_key_id': 1, 'provider': 'openai', 'model': 'm', 'status': status,
+        'prompt_tokens': 3, 'completion_tokens': 4, 'total_tokens': 7, 'saved_tokens': 0,
+        'request_time': 0.5, 'created_at': created_at
+    }, **fields)
+
+
+def test_aggregate_groups_by_bucket_and_counts_each_status():
+    events = [
+        event(), event(created_at=datetime(2024, 5, 1, 11, 5)),
+        event('error', total_tokens=0), event('rejected', total_tokens=0), event('cancelled', total_tokens=2),
+        event('error', api_key_id=None)
+    ]
+    rows = aggregate(events)
+    [daily] = rows[UsageRollupDaily]
+    assert daily['bucket'] == datetime(2024, 5, 1)
+    assert (daily['requests'], daily['success_requests'], daily['failed_requests'], daily['cancelled_requests']) == (5, 2, 2, 1)
+    assert daily['total_tokens'] == 16
+    assert daily['latency_sum'] == 2.5
+    assert sorted(row['requests'] for row in rows[UsageRollupHourly]) == [1, 4]
+
+
+def test_rebuild_keeps_failures_that_were_sampled_out(gateway):
+    usage_writer.failure_burst = 1
+    usage_writer._failure_tokens = 1
+    try:
+        with gateway.app_context():
+            key_id = APIKey.query.first().id
+        usage_writer.submit(event(api_key_id=key_id, user_id=1))
+        for _ in range(4):
+            usage_writer.submit_failure(event('error', api_key_id=key_id, user_id=1))
+        usage_writer.flush()
+    finally:
+        usage_writer.failure_burst = gateway.config['USAGE_FAILURE_BURST']
+        usage_writer._failure_tokens = float(usage_writer.failure_burst)
+
+    with gateway.app_context():
+        # 1条成功和1条失败明细写入数据库，其余3条失败只有计数
+        assert rebuild() == 2
+        row = UsageRollupDaily.query.one()
+        assert (row.requests, row.success_requests, row.failed_requests, row.sampled_failures) == (5, 1, 4, 3)
+        assert row.latency_sum == 2.5
+        db.session.remove()
@@ -0,0 +1,56 @@
+import pytest
+
+from app.services.semantic_cache import SemanticCache
+
+
+@pytest.fixture
+def cache(bare_app, tmp_path):
+    bare_app.config.update(
+        SEMANTIC_CACHE_ENABLED=True,
+        SEMANTIC_CACHE_DIR=str(tmp_path / 'semantic_cache'),
+        SEMANTIC_CACHE_THRESHOLD=0.98,
+        SEMANTIC_CACHE_MAX_ENTRIES=2,
+        SEMANTIC_CACHE_MAX_ENTRIES_PER_USER=2
+    )
+    cache = SemanticCache(bare_app)
+    cache.sync_interval = 0
+    return cache
+
+
+def probe(cache, text, user_id=1, **params):
+    return cache.probe(user_id, 'm', [{'role': 'user', 'content': text}], params)
+
+
+def store(cache, text, **params):
+    cache.store(probe(cache, text, **params), {'response': {'text': text}, 'usage': {'total_tokens': 1}})
+
+
+def test_rephrased_question_hits_and_different_parameters_do_not(cache):
+    store(cache, 'What is the capital of France', temperature=0)
+    hit = cache.lookup(probe(cache, 'what is the capital of france?', temperature=0))
+    assert hit['response'] == {'text': 'What is the capital of France'}
+    assert hit['similarity'] == pytest.approx(1.0)
+    assert cache.lookup(probe(cache, 'what is the capital of france?', temperature=0.7)) is None
+    assert cache.lookup(probe(cache, 'what is the capital of france?', user_id=2, temperature=0)) is None
+    assert cache.lookup(probe(cache, 'What is the capital of Italy', temperature=0)) is None
+
+
+def test_full_cache_reuses_the_least_recently_used_slot(cache):
+    store(cache, 'first question about apples')
+    store(cache, 'second question about pears')
+    assert cache.lookup(probe(cache, 'first question about apples'))
+
+    # 达到上限后复用最久未访问的槽位 (second)，旧版本不再可见
+    store(cache, 'third question about plums')
+    assert cache.counters['evictions'] == 1
+    assert cache.lookup(probe(cache, 'second question about pears')) is None
+    assert cache.lookup(probe(cache, 'third question about plums'))['response'] == {'text': 'third question about plums'}
+    assert cache.lookup(probe(cache, 'first question about apples'))
+    assert cache.stats()['indexed'] == 2
+
+
+def test_hashing_embedder_refuses_a_low_threshold(bare_app, tmp_path):
+    bare_app.config.update(
+        SEMANTIC_CACHE_ENABLED=True, SEMANTIC_CACHE_DIR=str(tmp_path / 'low'), SEMANTIC_CACHE_THRESHOLD=0.9
+    )
+    assert not SemanticCache(bare_app).enabled
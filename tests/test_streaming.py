@@ -0,0 +1,52 @@
+import json
+
+from app.services.streaming import AnthropicStreamRelay, OpenAIStreamRelay, PassthroughRelay, QwenStreamRelay
+
+
+def test_openai_relay_forwards_events_and_takes_usage_from_the_last_chunk():
+    relay = OpenAIStreamRelay('m')
+    assert relay.feed('{"choices": [{"delta": {"content": "a"}}]}') == ['data: {"choices": [{"delta": {"content": "a"}}]}\n\n']
+    relay.feed('{"choices": [], "usage": {"prompt_tokens": 5, "completion_tokens": 2, "total_tokens": 7}}')
+    assert relay.feed('[DONE]') == []
+    assert relay.done
+    assert relay.usage == {'prompt_tokens': 5, 'completion_tokens': 2, 'total_tokens': 7}
+    assert relay.events == 2
+
+
+def test_passthrough_relay_finds_usage_split_across_chunks():
+    relay = PassthroughRelay('m')
+    stream = (
+        b'data: {"choices": [{"delta": {"content": "a"}}]}\n\n'
+        b'data: {"choices": [], "usage": {"prompt_tokens": 5, "completion_tokens": 1, "total_tokens": 6}}\n\n'
+        b'data: [DONE]\n\n'
+    )
+    forwarded = b''.join(relay.feed_bytes(stream[i:i + 7]) for i in range(0, len(stream), 7))
+    assert forwarded == stream
+    assert relay.done
+    assert relay.usage['total_tokens'] == 6
+    assert relay.finish_bytes() == []
+
+
+def test_anthropic_relay_keeps_usage_current_before_the_stream_ends():
+    relay = AnthropicStreamRelay('m')
+    relay.feed(json.dumps({'type': 'message_start', 'message': {'usage': {'input_tokens': 9, 'output_tokens': 1}}}))
+    relay.feed(json.dumps({'type': 'content_block_delta', 'delta': {'type': 'text_delta', 'text': 'hi'}}))
+    # 流中途断开时已有输入Token
+    assert relay.usage == {'prompt_tokens': 9, 'completion_tokens': 1, 'total_tokens': 10}
+    relay.feed(json.dumps({'type': 'message_delta', 'delta': {'stop_reason': 'end_turn'}, 'usage': {'output_tokens': 4}}))
+    relay.feed(json.dumps({'type': 'message_stop'}))
+    events = relay.finish()
+    assert relay.usage == {'prompt_tokens': 9, 'completion_tokens': 4, 'total_tokens': 13}
+    assert json.loads(events[0][6:])['usage'] == relay.usage
+    assert events[-1] == 'data: [DONE]\n\n'
+
+
+def test_qwen_relay_uses_cumulative_usage():
+    relay = QwenStreamRelay('m')
+    for i, text in enumerate(['a', 'b']):
+        relay.feed(json.dumps({
+            'output': {'text': text, 'finish_reason': 'stop' if i else 'null'},
+            'usage': {'input_tokens': 5, 'output_tokens': i + 1, 'total_tokens': 6 + i}
+        }))
+    assert relay.usage == {'prompt_tokens': 5, 'completion_tokens': 2, 'total_tokens': 7}
+    assert relay.events == 2